@@ -18,16 +18,39 @@ from sqlite3 import connect
 
 from octoprint.printer import UnknownScript
 from octoprint.events import Events
+from octoprint.access.permissions import Permissions
 
 from . import smuff_core
+from . import smuff_timeouts
+from . import smuff_retry
+from . import smuff_reaction
+from . import smuff_capture
+from . import smuff_logging
+from . import smuff_profile
+from . import smuff_purge
+from . import smuff_jobs
+from . import smuff_estimate
+from . import smuff_routing
+from . import smuff_consumption
+from . import smuff_overlap
+from . import smuff_api
+from . import smuff_history
+from . import smuff_state
+from . import smuff_discovery
+from . import smuff_sampler
 
 import octoprint.plugin
+import flask
 import logging
-import re
+import os
+import threading
+import time
 
 LOGGER			= "octoprint.plugins.SMuFF"
 DEFAULT_BAUD	= 115200
 IS_KLIPPER		= False 				# flag has to be set to True for Klipper
+# printer states while OctoPrint is still looking for / opening the printer's port
+PRINTER_CONNECTING = ( "OPEN_SERIAL", "DETECT_SERIAL", "DETECT_BAUDRATE", "CONNECTING" )
 
 AT_SMUFF 		= "@SMuFF"				# prefix for pseudo GCode for SMuFF functions
 DEBUG			= "DEBUG"
@@ -50,14 +73,44 @@ RESETPURGE 		= "RESETPURGE"
 PURGE 			= "PURGE"
 LOG 			= "LOG"
 FORCERESUME		= "FORCERESUME"
+STATS 			= "STATS"
+CAPTURE			= "CAPTURE"
+APPLYCFG		= "APPLYCFG"
+INFO			= "INFO"
+MATERIALS		= "MATERIALS"
+SWAPS			= "SWAPS"
+LIDMAPPINGS		= "LIDMAPPINGS"
+REPORT			= "REPORT"
+SPOOL			= "SPOOL"
+PROFILE			= "PROFILE"
+PRECUT			= "PRECUT"
 
 T_IGNORE_FORCERESUME = "Printer not pausing, FORCERESUME ignored"
+T_CAPTURE		= "Capturing serial traffic is {0} ({1})"
+T_NO_DATA		= "No data received from SMuFF"
+T_MATERIAL		= "Tool {0} is '{2} {1}' with a purge factor of {3}%"
+T_SWAP			= "Tool {0} is assigned to tray {1}"
+T_LIDMAPPING	= "Tool {0} closed @ {1} deg."
+T_OVERLAP		= "Overlapped tool changes: {0}, not overlapped: {1}, {2} secs. gained (avg. {3} secs.)"
+T_BROKER		= "Command broker: {0} commands, {1} had to wait (avg. {2} ms, p99 {3} ms, max. {4} ms), {5} waiting, held by '{6}' ({7})"
+T_CACHE			= "Query cache: {0} hits, {1} misses, {2} shared, {3} entries"
+T_NO_JOBS		= "No job reports available"
+T_JOB			= "Job '{0}' ({1}): {2} tool change(s) {3}, on hold {4} secs., swaps p50 {5} / p99 {6} secs., {7} retries, {8} escalation(s), {9} jam(s), {12} swap(s) avoided, purged {10} mm in {11} secs."
+T_SPOOL			= "Tool {0}: {1:.0f} mm in total, {2:.0f} mm from spool '{3}'{4}"
+T_SPOOL_LEFT	= ", {0:.0f} mm left"
+T_SPOOL_LOW		= "Spool on tool {0} is running low, {1:.0f} mm left"
+T_PROFILE		= "Profiling SMuFF threads for {0} secs. ({1} samples/sec.)..."
+T_PROFILE_BUSY	= "Profiling is already running"
+T_PROFILE_DONE	= "Profile: {0} samples in {1} secs. ({2}% CPU), top: {3} - written to {4}"
+T_APPLYCFG		= "Profile '{0}': {1} parameter(s) sent, {2} unchanged, {3} failed {4}- took {5:4.2f} secs."
+T_BAD_PROFILE	= "Invalid profile name '{0}' (has to be a file in the plugin's data folder)"
 
 class SmuffPlugin(octoprint.plugin.SettingsPlugin,
                   octoprint.plugin.AssetPlugin,
                   octoprint.plugin.TemplatePlugin,
 				  octoprint.plugin.StartupPlugin,
 				  octoprint.plugin.EventHandlerPlugin,
+				  octoprint.plugin.SimpleApiPlugin,
 				  octoprint.plugin.ShutdownPlugin):
 
 	def __init__(self, logger):
@@ -68,6 +121,21 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 		self._octoprintTool = ""
 		self._purgeAmount = 0
 		self._mustPurgeAfterChange = False
+		self._purgeMatrix = { "A": smuff_purge.PurgeMatrix(), "B": smuff_purge.PurgeMatrix() }
+		self._lastSwap = { "A": None, "B": None }		# (from, to) tool of the last successful swap
+		self.tcRetry = smuff_retry.ToolChangeRetry(logger)
+		self.reactor = None
+		self.jobs = smuff_jobs.JobTracker(logger)
+		self.swapEstimator = smuff_estimate.SwapEstimator(logger)
+		self.router = smuff_routing.ToolRouter(logger)
+		self.filament = smuff_consumption.FilamentCounter(logger)
+		self.failover = smuff_routing.SpoolFailover(logger)
+		self.tcOverlap = smuff_overlap.ToolChangeOverlap(logger)
+		self.apiJobs = smuff_api.CommandJobs(logger)
+		self.discovery = None
+		self.sampler = smuff_sampler.StackSampler(logger)
+		self._clients = 0
+		self.asyncLog = smuff_logging.AsyncLogging(logger)
 		self._reset()
 
 	def _reset(self):
@@ -120,19 +188,34 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 	def on_shutdown(self):
 		self.SCA.close_serial()
 		self.SCB.close_serial()
+		self.swapEstimator.swapTimes.save()
+		self.filament.save()
+		for instance in [ self.SCA, self.SCB ]:
+			if instance.latency:
+				instance.latency.save()
+			if instance.recorder:
+				instance.recorder.stop()
+			if instance.deviceState:
+				instance.deviceState.stop()
+		self.apiJobs.stop()
+		if self.discovery:
+			self.discovery.stop_watching()
+		self.sampler.stop()
 		self._log.debug("Booo... shutting down...")
+		self.asyncLog.stop()
 
 	#
 	# StartupPlugin mixin
 	#
 	def on_after_startup(self):
+		self._setup_logging()
 		self.SCA.serialPort 	= "/dev/{0}".format(self._settings.get(["tty"]))
 		self.SCA.baudrate 		= self._settings.get_int(["baudrate"])
 		self.SCA.cmdTimeout 	= self._settings.get_int(["timeout1"])
 		self.SCA.tcTimeout 		= self._settings.get_int(["timeout2"])
 		self.SCA.wdTimeout 		= self.SCA.tcTimeout * 2
 		self.SCA.timeout 		= self.SCA.tcTimeout * 2
-		self.SCA.connect_SMuFF()
+		instances = [ self.SCA ]
 
 		self.SCB.serialPort 	="/dev/{0}".format(self._settings.get(["ttyB"]))
 		if self.SCB.serialPort and self._settings.get_boolean(["hasIDEX"]):
@@ -141,7 +224,182 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			self.SCB.tcTimeout 		= self.SCA.tcTimeout
 			self.SCB.wdTimeout 		= self.SCA.wdTimeout
 			self.SCB.timeout 		= self.SCA.timeout
-			self.SCB.connect_SMuFF()
+			instances.append(self.SCB)
+
+		self._setup_retry()
+		self.reactor = smuff_reaction.EventReactor(self._log, self._printer)
+		self.reactor.enabled 	= self._settings.get_boolean(["reactOnSignals"])
+		self.reactor.pauseOnJam = self._settings.get_boolean(["pauseOnJam"])
+		self.SCA.signalCB = self._on_signal
+		self.SCB.signalCB = self._on_signal
+		self.jobs = smuff_jobs.JobTracker(self._log, os.path.join(self.get_plugin_data_folder(), "jobs.jsonl"))
+		self.swapEstimator = smuff_estimate.SwapEstimator(self._log, os.path.join(self.get_plugin_data_folder(), "swaptimes.json"))
+		self.swapEstimator.enabled = self._settings.get_boolean(["estimateSwaps"])
+		self.filament = smuff_consumption.FilamentCounter(self._log, os.path.join(self.get_plugin_data_folder(), "consumption.json"))
+		self.filament.warnLength = self._settings.get_float(["spoolWarnLength"])
+		self.filament.warnCB = self._spool_low
+		self.filament.changeCB = self.failover.set_remaining
+		self._update_idle_states()
+		self.apiJobs.limit 		= self._settings.get_int(["apiConcurrency"])
+		self.apiJobs.queueSize 	= self._settings.get_int(["apiQueueSize"])
+		historySize = self._settings.get_int(["historySize"])
+		for instance in [ self.SCA, self.SCB ]:
+			if historySize == None or historySize <= 0:
+				# state history turned off
+				instance.history = None
+			elif instance.history == None or instance.history.size != historySize:
+				instance.history = smuff_history.StateHistory(historySize)
+		self.apiJobs.add_device("A", self.SCA)
+		if self.SCB in instances:
+			self.apiJobs.add_device("B", self.SCB)
+		self._setup_latency(self.SCA, "A")
+		self._setup_latency(self.SCB, "B")
+		self._setup_state(self.SCA, "A")
+		if self.SCB in instances:
+			self._setup_state(self.SCB, "B")
+
+		if self._settings.get_boolean(["autoDiscover"]):
+			# find the ports of the SMuFFs (in the background), then connect
+			self.discovery = smuff_discovery.PortDiscovery(self._log, os.path.join(self.get_plugin_data_folder(), "ports.json"))
+			discover = threading.Thread(target=self._discover_and_connect, args=(instances,), name="TDiscover")
+			discover.daemon = True
+			discover.start()
+			# probe again only if serial devices get plugged in
+			self.discovery.start_watching(self._on_hotplug)
+		elif self._settings.get_boolean(["connectInBackground"]):
+			# connect all SMuFFs concurrently, OctoPrint doesn't have to wait for any of them
+			for instance in instances:
+				instance.connect_SMuFF_async(self.smuffReadyCallback)
+		else:
+			for instance in instances:
+				instance.connect_SMuFF()
+
+	#
+	# Switch between synchronous and background logging, apply the sampling rates
+	#
+	def _setup_logging(self):
+		self.asyncLog.sampler.rates[smuff_logging.CAT_SERIAL] = self._settings.get_int(["logSampleSerial"])
+		if self._settings.get_boolean(["asyncLogging"]):
+			self.asyncLog.start()
+		else:
+			self.asyncLog.stop()
+
+	#
+	# Apply the tool change retry policy from the settings
+	#
+	def _setup_retry(self):
+		self.tcRetry.retries 		= self._settings.get_int(["tcRetries"])
+		self.tcRetry.unjam 			= self._settings.get_boolean(["tcRetryUnjam"])
+		self.tcRetry.reload 		= self._settings.get_boolean(["tcRetryReload"])
+		self.tcRetry.backoff 		= self._settings.get_float(["tcRetryBackoff"])
+		self.tcRetry.pauseOnFail 	= self._settings.get_boolean(["tcRetryPause"])
+
+	#
+	# Attach the (persisted) command latencies used for adaptive timeouts
+	#
+	def _setup_latency(self, instance, inst):
+		fileName = os.path.join(self.get_plugin_data_folder(), "latency{0}.json".format(inst))
+		instance.latency = smuff_timeouts.AdaptiveTimeouts(self._log, fileName, self._settings.get_float(["timeoutFactor"]))
+		instance.latency.enabled = self._settings.get_boolean(["adaptiveTimeouts"])
+
+	#
+	# Port discovery: probe the serial ports for SMuFFs and take over the ports found
+	#
+	def _discover_ports(self, instances):
+		names = [ "A" if instance == self.SCA else "B" for instance in instances ]
+		printerPorts = self._printer_ports()
+		if printerPorts == None:
+			# opening the printer's port would reset it, wait until it's known
+			self._log.info("Printer port not known yet, port discovery postponed until the printer is connected")
+			return False
+		baudrates = [ self._settings.get_int(["baudrate"]) ]
+		if self._settings.get_boolean(["hasIDEX"]) and self._settings.get_int(["baudrateB"]) not in baudrates:
+			baudrates.append(self._settings.get_int(["baudrateB"]))
+		# never probe the printer's port or a port a SMuFF is connected to
+		exclude = printerPorts + [ instance.serialPort for instance in [ self.SCA, self.SCB ] if instance.isConnected ]
+		found = self.discovery.resolve(names, baudrates, self._settings.get_float(["discoveryTimeout"]), exclude)
+		for instance, name in zip(instances, names):
+			entry = found.get(name)
+			if entry == None:
+				self._log.warning("No serial port found for SMuFF [{0}], keeping {1}".format(name, instance.serialPort))
+				continue
+			baudrate = entry.get("baudrate") or instance.baudrate
+			if entry["port"] != instance.serialPort or baudrate != instance.baudrate:
+				self._log.info("SMuFF [{0}] found on {1} @ {2} baud (was {3} @ {4} baud)".format(name, entry["port"], baudrate, instance.serialPort, instance.baudrate))
+			instance.serialPort = entry["port"]
+			instance.baudrate 	= baudrate
+		return True
+
+	def _discover_and_connect(self, instances):
+		self._discover_ports(instances)
+		for instance in instances:
+			instance.connect_SMuFF_async(self.smuffReadyCallback)
+
+	#
+	# Returns the ports the printer is (or is going to be) connected to, None
+	# if they aren't known yet (port set to AUTO or OctoPrint still connecting)
+	#
+	def _printer_ports(self):
+		try:
+			port = self._printer.get_current_connection()[1]
+			if self._printer.get_state_id() in PRINTER_CONNECTING:
+				return None
+			configured = self._settings.global_get(["serial", "port"])
+		except Exception:
+			return None
+		ports = [ p for p in (port, configured) if p and p.upper() != "AUTO" ]
+		if not port and (not configured or configured.upper() == "AUTO"):
+			return None
+		return ports
+
+	#
+	# Called from the hotplug watcher if serial devices have been added / removed
+	#
+	def _on_hotplug(self, added, removed):
+		if not added:
+			return
+		self._rediscover()
+
+	#
+	# Discovers (and connects) the SMuFFs which aren't connected
+	#
+	def _rediscover(self):
+		instances = [ self.SCA, self.SCB ] if self._settings.get_boolean(["hasIDEX"]) else [ self.SCA ]
+		instances = [ instance for instance in instances if not instance.isConnected and instance.connState != smuff_core.CONN_PENDING ]
+		if instances:
+			self._discover_and_connect(instances)
+
+	#
+	# Restore the last known device state (tool, load state, config) saved before a restart
+	#
+	def _setup_state(self, instance, inst):
+		if not self._settings.get_boolean(["persistState"]):
+			instance.deviceState = None
+			return
+		state = smuff_state.DeviceState(self._log, os.path.join(self.get_plugin_data_folder(), "state{0}.json".format(inst)))
+		if state.restore(instance) and instance == self.SCA:
+			# the tool OctoPrint knows and the SMuFF that has got it
+			self._octoprintTool = state.extra.get("octoprintTool", self._octoprintTool)
+			self.activeInstance = state.extra.get("activeInstance", self.activeInstance)
+		instance.deviceState = state
+
+	#
+	# Called from the background connect thread of each SMuFF instance
+	#
+	def smuffReadyCallback(self, instance, success, duration):
+		inst = "A" if instance == self.SCA else "B"
+		self._log.info("SMuFF [{0}] {1} after {2:4.2f} secs.".format(inst, "is ready" if success else "failed to connect", duration))
+		if hasattr(self, "_plugin_manager"):
+			self._plugin_manager.send_plugin_message(self._identifier, {'type': 'ready', 'instance': inst, 'ready': success, 'state': instance.connState, 'duration': duration })
+
+	#
+	# Called from the serial reader thread of each SMuFF instance
+	#
+	def _on_signal(self, instance, signal, received):
+		if signal == smuff_core.SIG_JAM:
+			self.jobs.jam()
+		if self.reactor:
+			self.reactor.on_signal(instance, signal, received)
 
 	#
 	# EventHandler mixin
@@ -153,6 +411,268 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			self.SCA.close_serial()
 			self.SCB.close_serial()
 
+		if event == Events.CLIENT_OPENED:
+			self._clients += 1
+			self._update_idle_states()
+		elif event == Events.CLIENT_CLOSED:
+			self._clients = max(0, self._clients-1)
+			self._update_idle_states()
+		elif event in (Events.PRINT_STARTED, Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+			self._update_idle_states()
+		elif event == Events.CONNECTED and self.discovery:
+			# the printer's port is known now, so the ports left can be probed
+			discover = threading.Thread(target=self._rediscover, name="TDiscover")
+			discover.daemon = True
+			discover.start()
+
+		if event == Events.PRINT_STARTED:
+			self.jobs.start(payload.get("name") if payload else None)
+			self.router.reset_stats()
+			self._index_tool_changes(payload)
+		elif event == Events.PRINT_DONE:
+			self.jobs.finish("done")
+		elif event == Events.PRINT_FAILED:
+			self.jobs.finish("failed")
+		elif event == Events.PRINT_CANCELLED:
+			self.jobs.finish("cancelled")
+		if event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+			self.tcOverlap.discard()
+			self.swapEstimator.end_job()
+			self.filament.save()
+
+		if self.reactor:
+			if event == Events.PRINT_PAUSED:
+				self.reactor.on_paused()
+			elif event in (Events.PRINT_RESUMED, Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+				self.reactor.on_released()
+
+	#
+	# Index the tool changes of the file being printed (in the background, files might be huge)
+	#
+	def _index_tool_changes(self, payload):
+		fileName = None
+		if payload and payload.get("origin") == "local" and self._settings.get_boolean(["estimateSwaps"]):
+			try:
+				fileName = self._file_manager.path_on_disk("local", payload.get("path"))
+			except Exception as err:
+				self._log.error("Can't locate the file being printed: {0}".format(err))
+		toolCountA = self.SCA.toolCount if self._settings.get_boolean(["hasIDEX"]) else 0
+		generation = self.swapEstimator.begin_job()
+		indexer = threading.Thread(target=self.swapEstimator.start_job, args=(fileName, toolCountA, generation), name="TToolIndex")
+		indexer.daemon = True
+		indexer.start()
+
+	#
+	# Print time estimator hook: OctoPrint's estimate plus the remaining tool changes
+	#
+	def get_estimator_factory(self, *args, **kwargs):
+		from octoprint.printer.estimation import PrintTimeEstimator
+		estimator = self.swapEstimator
+
+		class SmuffPrintTimeEstimator(PrintTimeEstimator):
+			def estimate(self, progress, printTime, cleanedPrintTime, statisticalTotalPrintTime, statisticalTotalPrintTimeType):
+				left, origin = PrintTimeEstimator.estimate(self, progress, printTime, cleanedPrintTime, statisticalTotalPrintTime, statisticalTotalPrintTimeType)
+				return estimator.adjust(left, origin, progress), origin
+
+		return SmuffPrintTimeEstimator
+
+	#
+	# Determine the periodical states mode for an idle SMuFF: slow if someone's
+	# watching or a print is running, off otherwise
+	#
+	def _update_idle_states(self):
+		if not self._settings.get_boolean(["adaptiveStates"]):
+			mode = smuff_core.STATES_FAST
+		elif self._clients > 0 or self._printer.is_printing():
+			mode = smuff_core.STATES_SLOW
+		else:
+			mode = smuff_core.STATES_OFF
+		for instance in [ self.SCA, self.SCB ]:
+			instance.statesIntervals[smuff_core.STATES_SLOW] = self._settings.get_int(["statesSlowInterval"])
+			instance.statesIdle = mode
+			if instance.isConnected:
+				# don't block the event handler while waiting for the SMuFF
+				idle = threading.Thread(target=instance.apply_idle_states, name="TStatesMode")
+				idle.daemon = True
+				idle.start()
+
+	#
+	# Apply a configuration profile (file name or dictionary) in an API job,
+	# so neither OctoPrint's comm thread nor the API caller has to wait for it.
+	# Returns the job id.
+	#
+	def _submit_profile(self, instance, profile, name, timeout=None):
+		inst = "A" if instance == self.SCA else "B"
+		return self.apiJobs.submit(inst, "{0} {1}".format(APPLYCFG, name), timeout, lambda instance: self._apply_profile(instance, profile, name))
+
+	#
+	# Apply a configuration profile and report the outcome (runs in an API job)
+	#
+	def _apply_profile(self, instance, profile, name):
+		try:
+			report = smuff_profile.apply_profile(instance, profile)
+		except Exception as err:
+			errmsg = "Can't apply profile '{0}': {1}".format(name, err)
+			self._log.error(errmsg)
+			self._setResponse(errmsg, True, instance)
+			return False, errmsg
+		failed = "({0}) ".format(", ".join(report["failed"])) if len(report["failed"]) else ""
+		self._setResponse(T_APPLYCFG.format(name, report["sent"], report["skipped"], len(report["failed"]), failed, report["elapsed"]), True, instance)
+		return report["success"], report
+
+	#
+	# Returns the path of a profile in the plugin data folder, None if the name
+	# is missing or points somewhere else
+	#
+	def _profile_path(self, fileName):
+		if not fileName or os.sep in fileName or (os.altsep and os.altsep in fileName) or fileName.startswith(".") or ".." in fileName:
+			return None
+		return os.path.join(self.get_plugin_data_folder(), fileName)
+
+	#
+	# Start or stop capturing the serial traffic of a SMuFF instance
+	#
+	def _toggle_capture(self, instance):
+		if instance.recorder and instance.recorder.active:
+			instance.recorder.stop()
+		else:
+			fileName = os.path.join(self.get_plugin_data_folder(), "capture{0}.bin".format("A" if instance == self.SCA else "B"))
+			maxSize = self._settings.get_int(["captureMaxSize"]) * 1024 * 1024
+			instance.recorder = smuff_capture.SerialRecorder(self._log, fileName, maxSize, self._settings.get_int(["captureFiles"]))
+			instance.recorder.start()
+		self._setResponse(T_CAPTURE.format("ON" if instance.recorder.active else "OFF", instance.recorder.fileName), True, instance)
+
+	#
+	# Format a list of values queried from the SMuFF, one line per tool
+	#
+	def _format_list(self, values, fmt):
+		if values == None:
+			return T_NO_DATA
+		return "\n".join(fmt(i, value) for i, value in enumerate(values)) + "\n"
+
+	#
+	# Format the serial traffic / CPU usage statistics per periodical states mode
+	#
+	def _get_states_stats(self, instance):
+		stats = instance.get_states_stats()
+		lines = [ "Periodical states (current mode: {0})".format(instance.statesMode) ]
+		for mode, values in stats.items():
+			lines.append("{0}:\t{1} secs. | {2} lines/h | {3} bytes/h | {4} CPU secs./h".format(mode, values["seconds"], values["linesPerHour"], values["bytesPerHour"], values["cpuSecsPerHour"]))
+		cache = instance.get_cache_stats()
+		lines.append(T_CACHE.format(cache["hits"], cache["misses"], cache["shared"], cache["entries"]))
+		broker = instance.broker.get_stats()
+		lines.append(T_BROKER.format(broker["acquisitions"], broker["contended"], broker["waitAvgMs"], broker["waitP99Ms"], broker["waitMaxMs"], broker["waiting"], broker["holder"], broker["holderThread"]))
+		overlap = self.tcOverlap.get_stats()
+		lines.append(T_OVERLAP.format(overlap["overlapped"], overlap["fallbacks"], overlap["savedSecs"], overlap["avgSavedSecs"]))
+		return "\n".join(lines) + "\n"
+
+	#
+	# Returns the (global) tool number a tool change should go to when routing is enabled
+	#
+	def _route_tool(self, tool):
+		self.router.update(self.SCA.materials, self.SCB.materials, (self.SCA.config.version, self.SCB.config.version))
+		avoided = self.router.avoided
+		inst, slot = self.router.route(tool, self.SCA.toolCount, self._swap_cost)
+		if self.router.avoided != avoided:
+			self.jobs.swap_avoided()
+		return slot if inst == "A" else slot + self.SCA.toolCount
+
+	#
+	# Expected time (in seconds) for changing to a tool on a SMuFF, 0 if it's loaded already
+	#
+	def _swap_cost(self, inst, slot):
+		instance = self.SCA if inst == "A" else self.SCB
+		if not instance.isConnected:
+			return float("inf")
+		current = instance.parse_tool_number(instance.curTool)
+		if current == slot and instance.feeder:
+			return 0.0
+		cost = self.swapEstimator.swapTimes.get(inst, current if current >= 0 else None, slot)
+		if instance.isProcessing:
+			cost += smuff_routing.BUSY_PENALTY
+		return cost
+
+	#
+	# Called (from OctoPrint's comm thread) when the spool of the current tool runs low
+	#
+	def _spool_low(self, tool, left):
+		msg = T_SPOOL_LOW.format(tool, left)
+		self._setResponse(msg, True)
+		if hasattr(self, "_plugin_manager"):
+			self._plugin_manager.send_plugin_message(self._identifier, {'type': 'notify', 'message': msg })
+		if self._settings.get_boolean(["spoolFailover"]):
+			# determine the tool to change to on runout right now
+			inst, _, slot = tool.partition(":")
+			self._update_failover()
+			self.failover.stage(inst, int(slot))
+
+	#
+	# (Re-)build the runout failover index if the materials of a SMuFF have changed
+	#
+	def _update_failover(self):
+		idex = self._settings.get_boolean(["hasIDEX"])
+		self.failover.update(self.SCA.materials, self.SCB.materials if idex else [], (self.SCA.config.version, self.SCB.config.version if idex else None), self.filament.remaining)
+
+	#
+	# Returns the (instance, tool) to change to on a filament runout or None
+	# if there's no other tool with the same material and filament left
+	#
+	def _failover_tool(self, instance, actTool):
+		if not self._settings.get_boolean(["spoolFailover"]) or actTool < 0:
+			return None
+		self._update_failover()
+		target = self.failover.next("A" if instance == self.SCA else "B", actTool)
+		if target == None:
+			return None
+		inst, slot = target
+		return (self.SCA if inst == "A" else self.SCB), smuff_core.TOOL + str(slot)
+
+	#
+	# Register a new spool on a tool or list the filament used per tool
+	#
+	def _set_spool(self, instance, tool, length, name):
+		inst = "A" if instance == self.SCA else "B"
+		if tool != None:
+			try:
+				slot = instance.parse_tool_number(tool)
+				if slot < 0:
+					raise ValueError("no tool given")
+				self.filament.set_spool(inst, slot, name, float(length) if length else None)
+			except ValueError as err:
+				self._setResponse("Invalid spool: {0}".format(err), True, instance)
+				return
+		lines = []
+		for key, values in sorted(self.filament.get_stats().items()):
+			if key.startswith(inst + ":"):
+				left = self.filament.remaining(inst, int(key.partition(":")[2]))
+				lines.append(T_SPOOL.format(key, values["total"], values["used"], values["spool"], T_SPOOL_LEFT.format(left) if left != None else ""))
+		self._setResponse("\n".join(lines) + "\n" if len(lines) else T_NO_DATA, False, instance)
+
+	#
+	# Sample the stacks of the SMuFF / comm threads in the background, report when done
+	#
+	def _start_profile(self, seconds, rate, instance=None):
+		if rate == None:
+			rate = self._settings.get_int(["profileRate"])
+		fileName = os.path.join(self.get_plugin_data_folder(), "profile-{0}.folded".format(time.strftime("%Y%m%d-%H%M%S")))
+		done = lambda result: self._setResponse(T_PROFILE_DONE.format(result["samples"], result["seconds"], result["cpuPct"],
+			", ".join([ "{0} ({1})".format(func, count) for func, count in result["top"] ]), result["fileName"]), False, instance)
+		return self.sampler.start(seconds, rate, fileName, done)
+
+	#
+	# Format the reports of the last print jobs
+	#
+	def _format_jobs(self, limit):
+		jobs = self.jobs.get_jobs(limit)
+		if not len(jobs):
+			return T_NO_JOBS
+		lines = []
+		for job in jobs:
+			perTool = ", ".join("{0}={1}".format(key, count) for key, count in sorted(job["perTool"].items()))
+			lines.append(T_JOB.format(job["name"], job["status"], job["toolChanges"], "[{0}]".format(perTool) if perTool else "", job["holdSecs"],
+				job["p50Secs"], job["p99Secs"], job["retries"], job["escalations"], job["jams"], job["purgeMm"], job["purgeSecs"], job.get("swapsAvoided", 0)))
+		return "\n".join(lines) + "\n"
+
 	#
 	# SettingsPlugin mixin
 	#
@@ -184,7 +704,38 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			revolver_endB	= self.SCB.revolver,
 			feeder_endB		= self.SCB.feeder,
 			feeder2_endB	= self.SCB.feeder2,
-			activeInstance 	= "A"
+			activeInstance 	= "A",
+			connectInBackground	= True,
+			adaptiveTimeouts	= True,
+			timeoutFactor		= smuff_timeouts.DEF_FACTOR,
+			tcRetries			= 2,
+			tcRetryUnjam		= True,
+			tcRetryReload		= True,
+			tcRetryBackoff		= 2.0,
+			tcRetryPause		= True,
+			reactOnSignals		= True,
+			pauseOnJam			= True,
+			adaptiveStates		= True,
+			statesSlowInterval	= 5,
+			captureMaxSize		= 4,
+			captureFiles		= smuff_capture.DEF_FILES,
+			asyncLogging		= True,
+			logSampleSerial		= 1,
+			purgeMatrix			= True,
+			purgeBase			= smuff_purge.DEF_BASE,
+			purgeMin			= smuff_purge.DEF_MIN,
+			estimateSwaps		= True,
+			toolRouting			= False,
+			spoolWarnLength		= smuff_consumption.DEF_WARN_LENGTH,
+			spoolFailover		= True,
+			tcOverlap			= False,
+			apiConcurrency		= smuff_api.DEF_LIMIT,
+			apiQueueSize		= smuff_api.DEF_QUEUE_SIZE,
+			historySize			= smuff_history.DEF_SIZE,
+			profileRate			= smuff_sampler.DEF_RATE,
+			persistState		= True,
+			autoDiscover		= False,
+			discoveryTimeout	= smuff_discovery.DEF_TIMEOUT
 		)
 		return  params
 
@@ -206,6 +757,31 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			# reconnect SMuFF A on the new port (with new baudrate)
 			self.SCA.reconnect_SMuFF()
 
+		if "adaptiveTimeouts" in data or "timeoutFactor" in data:
+			for instance in [ self.SCA, self.SCB ]:
+				if instance.latency:
+					instance.latency.enabled = self._settings.get_boolean(["adaptiveTimeouts"])
+					instance.latency.factor	 = self._settings.get_float(["timeoutFactor"])
+
+		if self.reactor and ("reactOnSignals" in data or "pauseOnJam" in data):
+			self.reactor.enabled 	= self._settings.get_boolean(["reactOnSignals"])
+			self.reactor.pauseOnJam = self._settings.get_boolean(["pauseOnJam"])
+
+		if "spoolWarnLength" in data:
+			self.filament.warnLength = self._settings.get_float(["spoolWarnLength"])
+
+		if "estimateSwaps" in data:
+			self.swapEstimator.enabled = self._settings.get_boolean(["estimateSwaps"])
+
+		if "asyncLogging" in data or "logSampleSerial" in data:
+			self._setup_logging()
+
+		if "adaptiveStates" in data or "statesSlowInterval" in data:
+			self._update_idle_states()
+
+		if any(key.startswith("tcRetry") for key in data):
+			self._setup_retry()
+
 		if "baudrateB" in data or "ttyB" in data:
 			if self._settings.get_boolean(["hasIDEX"]):
 				self.SCB.close_serial()
@@ -242,6 +818,111 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			less=["less/SMuFF.less"]
 		)
 
+	#
+	# SimpleApiPlugin mixin
+	#
+	#	POST {"command": "send", "device": "A", "gcode": "M18", "timeout": 30} -> {"job": "..."}
+	#	POST {"command": "wait", "job": "...", "timeout": 10} 					 -> job
+	#	POST {"command": "apply", "device": "A", "profile": { "Param": value, ... }} -> {"job": "..."}
+	#	GET  ?job=...	(a single job)	/	GET ?limit=20 (the last jobs)
+	#	GET  ?history=A&from=<epoch secs.>&to=<epoch secs.>&points=500 (state history of a SMuFF)
+	#	GET  ?reports&limit=10 (tool change reports of the last print jobs)
+	#
+	def get_api_commands(self):
+		return dict(
+			send=["device", "gcode"],
+			wait=["job"],
+			profile=["seconds"],
+			apply=["device", "profile"]
+		)
+
+	def on_api_command(self, command, data):
+		if not Permissions.CONTROL.can():
+			flask.abort(403)
+		if command == "send":
+			try:
+				timeout = float(data["timeout"]) if "timeout" in data else None
+				jobId = self.apiJobs.submit(str(data["device"]).upper(), str(data["gcode"]).strip(), timeout)
+			except KeyError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 404)
+			except ValueError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 400)
+			except smuff_api.QueueFullError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 429)
+			return flask.make_response(flask.jsonify(job=jobId), 202)
+		if command == "wait":
+			try:
+				timeout = float(data.get("timeout", smuff_api.DEF_WAIT))
+			except ValueError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 400)
+			job = self.apiJobs.wait(data["job"], min(timeout, smuff_api.MAX_WAIT))
+			if job == None:
+				flask.abort(404)
+			return flask.jsonify(job)
+		if command == "profile":
+			try:
+				rate = int(data["rate"]) if "rate" in data else None
+				started = self._start_profile(float(data["seconds"]), rate)
+			except ValueError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 400)
+			if not started:
+				return flask.make_response(flask.jsonify(error=T_PROFILE_BUSY), 409)
+			return flask.make_response(flask.jsonify(self.sampler.get_stats()), 202)
+		if command == "apply":
+			# bulk apply a configuration profile ({ "parameter": value, ... })
+			instance = { "A": self.SCA, "B": self.SCB }.get(str(data["device"]).upper())
+			if instance == None:
+				flask.abort(404)
+			profile = data["profile"]
+			if not isinstance(profile, dict) or not all([ isinstance(value, (str, int, float, bool)) for value in profile.values() ]):
+				return flask.make_response(flask.jsonify(error="profile has to be an object of parameter values"), 400)
+			try:
+				timeout = float(data["timeout"]) if "timeout" in data else None
+				jobId = self._submit_profile(instance, profile, "api", timeout)
+			except KeyError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 404)
+			except ValueError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 400)
+			except smuff_api.QueueFullError as err:
+				return flask.make_response(flask.jsonify(error=str(err)), 429)
+			return flask.make_response(flask.jsonify(job=jobId), 202)
+
+	def on_api_get(self, request):
+		if not Permissions.STATUS.can():
+			flask.abort(403)
+		device = request.args.get("history")
+		if device:
+			instance = { "A": self.SCA, "B": self.SCB }.get(device.upper())
+			if instance == None or instance.history == None:
+				flask.abort(404)
+			try:
+				start = float(request.args["from"]) if "from" in request.args else None
+				end = float(request.args["to"]) if "to" in request.args else None
+				points = max(1, int(request.args.get("points", smuff_history.DEF_POINTS)))
+			except ValueError:
+				flask.abort(400)
+			return flask.jsonify(instance.history.query(start, end, points))
+		if "profile" in request.args:
+			return flask.jsonify(self.sampler.get_stats())
+		if "reports" in request.args:
+			# tool change reports of the last print jobs (newest first, 0 = all kept)
+			try:
+				limit = max(0, int(request.args.get("limit", 10)))
+			except ValueError:
+				flask.abort(400)
+			return flask.jsonify(reports=self.jobs.get_jobs(limit))
+		jobId = request.args.get("job")
+		if jobId:
+			job = self.apiJobs.get(jobId)
+			if job == None:
+				flask.abort(404)
+			return flask.jsonify(job)
+		try:
+			limit = int(request.args.get("limit", 20))
+		except ValueError:
+			flask.abort(400)
+		return flask.jsonify(jobs=self.apiJobs.get_jobs(limit))
+
 	#
 	# Softwareupdate hook
 	#
@@ -290,16 +971,20 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 		#self._log.debug("Processing tool queuing: [ Cmd: {0}, Type: {1}, Tags: {2} ]".format(cmd, str(cmd_type), str(tags)))
 
 		if gcode and gcode.startswith(smuff_core.TOOL):
-			self._log.debug("OctoPrint current tool: {0}".format(comm_instance._currentTool))
+			self._log.debug("OctoPrint current tool: %s", comm_instance._currentTool, extra=smuff_core.LOG_CMD)
 
 			instance = self.SCA
 			toolnew = -1
 			tool = instance.parse_tool_number(cmd)
 			toolcount = instance.toolCount
-			self._log.debug("CMD: {0}; ToolCount [A]: {1}; New Tool: {2}".format(cmd, toolcount, tool))
+			self._log.debug("CMD: %s; ToolCount [A]: %s; New Tool: %s", cmd, toolcount, tool, extra=smuff_core.LOG_CMD)
 			if tool == -1:
 				return
 			self._octoprintTool = cmd
+			if self._settings.get_boolean(["toolRouting"]) and self._settings.get_boolean(["hasIDEX"]):
+				# use the same material on the other SMuFF if that's cheaper
+				tool = self._route_tool(tool)
+				cmd = "{0}{1}".format(smuff_core.TOOL, tool)
 			# is the tool required on the 2nd SMUFF?
 			if tool >= toolcount:
 				#if so, adjust instance and tool number
@@ -312,7 +997,8 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			self.activeInstance = ("A" if instance == self.SCA else "B")
 
 			# if the tool that's already loaded is addressed, ignore the filament change
-			if cmd == instance.curTool and instance.feeder:
+			# (unless the states are outdated, @SMuFF LOAD checks again then)
+			if cmd == instance.curTool and instance.feeder and not instance.statesStale:
 				self._log.info("Current tool {0} equals {1} -- no tool change needed".format(cmd, instance.curTool))
 				self._setResponse("Tool already selected", True, instance)
 				return
@@ -326,7 +1012,7 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 		# handle SMuFF pseudo GCodes
 		if cmd and cmd.startswith(AT_SMUFF):
 			action, v1, v2, v3 = self._split_cmd(cmd)
-			self._log.debug("QUEUE>> Cmd: {0}  Action: {1}  Params: {2}; {3}; {4}".format(cmd, str(action), str(v1), str(v2), str(v3)))
+			self._log.debug("QUEUE>> Cmd: %s  Action: %s  Params: %s; %s; %s", cmd, action, v1, v2, v3, extra=smuff_core.LOG_CMD)
 
 			instance = self.SCA
 			if cmd.startswith(AT_SMUFF+"2"):		# command is @SMUFF2, handle 2nd device
@@ -353,6 +1039,25 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 				self._setResponse(smuff_core.T_DUMP_RAW.format("ON" if instance.dumpRawData else "OFF"), True, instance)
 				return
 
+			# @SMuFF CAPTURE
+			if action and action == CAPTURE:
+				# toggle capturing the raw serial traffic into a binary capture file
+				self._toggle_capture(instance)
+				return
+
+			# @SMuFF APPLYCFG
+			if action and action == APPLYCFG:
+				# send all changed parameters of a profile (JSON file in the plugin data folder)
+				fileName = self._profile_path(v1)
+				if fileName == None:
+					self._setResponse(T_BAD_PROFILE.format(v1), True, instance)
+					return
+				try:
+					self._submit_profile(instance, fileName, v1)
+				except (KeyError, smuff_api.QueueFullError) as err:
+					self._setResponse("Can't apply profile '{0}': {1}".format(v1, err), True, instance)
+				return
+
 			# @SMuFF SERVO
 			if action and action == SERVO:
 				# send a servo command to SMuFF
@@ -400,17 +1105,80 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 				self._setResponse(smuff_core.T_RESET, False, instance)
 				return
 
+			# @SMuFF INFO
+			if action and action == INFO:
+				info = instance.query_fw_info()
+				self._setResponse(smuff_core.T_FW_INFO.format(info) if info != None else T_NO_DATA, False, instance)
+				return
+
+			# @SMuFF MATERIALS
+			if action and action == MATERIALS:
+				materials = instance.query_materials()
+				self._setResponse(self._format_list(materials, lambda i, m: T_MATERIAL.format(i, m[0], m[1], m[2])), False, instance)
+				return
+
+			# @SMuFF SWAPS
+			if action and action == SWAPS:
+				swaps = instance.query_swaps()
+				self._setResponse(self._format_list(swaps, lambda i, s: T_SWAP.format(i, s)), False, instance)
+				return
+
+			# @SMuFF LIDMAPPINGS
+			if action and action == LIDMAPPINGS:
+				mappings = instance.query_lid_mappings()
+				self._setResponse(self._format_list(mappings, lambda i, m: T_LIDMAPPING.format(i, m)), False, instance)
+				return
+
+			# @SMuFF STATS
+			if action and action == STATS:
+				self._setResponse(self._get_states_stats(instance), False, instance)
+				return
+
+			# @SMuFF REPORT
+			if action and action == REPORT:
+				# tool change reports of the last print jobs
+				try:
+					limit = int(v1) if v1 else 1
+				except ValueError:
+					limit = 1
+				self._setResponse(self._format_jobs(limit), False, instance)
+				return
+
+			# @SMuFF PROFILE
+			if action and action == PROFILE:
+				# "@SMuFF PROFILE 30 [rate]" samples the SMuFF / comm threads for 30 seconds
+				try:
+					seconds = float(v1) if v1 else 10
+					rate = int(v2) if v2 else None
+				except ValueError:
+					seconds, rate = 10, None
+				if self._start_profile(seconds, rate, instance):
+					self._setResponse(T_PROFILE.format(seconds, rate if rate else self._settings.get_int(["profileRate"])), True, instance)
+				else:
+					self._setResponse(T_PROFILE_BUSY, True, instance)
+				return
+
+			# @SMuFF SPOOL
+			if action and action == SPOOL:
+				# "@SMuFF SPOOL T1 330000 Red-PLA" registers a new spool, w/o parameters the usage gets listed
+				self._set_spool(instance, v1, v2, v3)
+				return
+
 			# @SMuFF UNLOAD
 			if action and action == UNLOAD:
 				# send a M701 command to SMuFF
+				instance.set_states_mode(smuff_core.STATES_FAST)
 				instance.send_SMuFF_and_wait(smuff_core.UNLOADFIL)
+				instance.apply_idle_states()
 				self._setResponse(smuff_core.T_UNLOADING, False, instance)
 				return
 
 			# @SMuFF RELOAD
 			if action and action == RELOAD:
 				# send a M700 command to SMuFF
+				instance.set_states_mode(smuff_core.STATES_FAST)
 				instance.send_SMuFF_and_wait(smuff_core.LOADFIL)
+				instance.apply_idle_states()
 				self._setResponse(smuff_core.T_RELOADING, False, instance)
 				return
 
@@ -440,8 +1208,13 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			# @SMuFF PURGE
 			if action and action == PURGE:
 				# the real purge command
-				gcode = smuff_core.EXTRUDE.format(self._purgeAmount, v1)
-				self._setResponse(smuff_core.T_PURGING.format(str(self._purgeAmount), v1), True, instance)
+				amount = self._purgeAmount
+				if not self._mustPurgeAfterChange and self._settings.get_boolean(["purgeMatrix"]):
+					# no amount set explicitly, use the one for the last tool swap
+					amount = self._get_purge_length(instance)
+				gcode = smuff_core.EXTRUDE.format(amount, v1)
+				self.jobs.purge(amount, v1)
+				self._setResponse(smuff_core.T_PURGING.format(str(amount), v1), True, instance)
 				self._purgeAmount = 0
 				self._mustPurgeAfterChange = False
 				return gcode
@@ -458,6 +1231,10 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 
 	def extend_tool_sending(self, comm_instance, phase, cmd, cmd_type, gcode, subcode, tags, *args, **kwargs):
 
+		if gcode:
+			# account the filament extruded on the current tool
+			self.filament.feed(gcode, cmd)
+
 		if gcode and gcode.startswith(smuff_core.TOOL):
 			# ignore default Tx commands
 			return
@@ -465,7 +1242,7 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 		# check for the replaced tool change command
 		if cmd and cmd.startswith(AT_SMUFF):
 			action, v1, v2, v3 = self._split_cmd(cmd)
-			self._log.debug("SEND>> Cmd: {0}  Action: {1}  Params: {2}; {3}; {4}".format(cmd, str(action), str(v1), str(v2), str(v3)))
+			self._log.debug("SEND>> Cmd: %s  Action: %s  Params: %s; %s; %s", cmd, action, v1, v2, v3, extra=smuff_core.LOG_CMD)
 
 			instance = self.SCA
 			if cmd.startswith(AT_SMUFF+"2"):		# command is @SMUFF2, handle 2nd device
@@ -483,6 +1260,14 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 				instance.send_SMuFF_and_wait(smuff_core.WIPE)
 				return
 
+			# @SMuFF PRECUT
+			if action and action == PRECUT:
+				# sent after a M400 in 'beforeToolChange', so the printer has retracted by now;
+				# let the SMuFF cut while the printer parks
+				if self._settings.get_boolean(["tcOverlap"]) and str(instance.pendingTool) != str(instance.curTool):
+					self.tcOverlap.start(instance)
+				return
+
 			# @SMuFF FORCERESUME
 			if action and action == FORCERESUME:
 				if self._printer.is_pausing():
@@ -492,6 +1277,7 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 					self._printer.script("afterToolChange")
 					continuePrint = True
 					self._printer.set_job_on_hold(False)
+					self.jobs.hold_stop()
 				else:
 					self._setResponse(T_IGNORE_FORCERESUME, True, instance)
 					self._log.info(T_IGNORE_FORCERESUME)
@@ -501,6 +1287,7 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 			if action and action.startswith(smuff_core.TOOL):
 				try:
 					if self._printer.set_job_on_hold(True, False):
+						self.jobs.hold_start()
 						try:
 							# determine if the current tool is to be incremented or decremented
 							# in order to achieve an automatic tool swap on filament runout
@@ -510,8 +1297,14 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 								try:
 									actTool = instance.get_active_tool()
 									maxTools = instance.toolCount
+									target = self._failover_tool(instance, actTool)
+									if target != None:
+										# same material with the most filament left (might be on the other SMuFF)
+										instance, action = target
+										self.activeInstance = "A" if instance == self.SCA else "B"
+										self._log.info("Runout failover to {0} [{1}]".format(action, self.activeInstance))
 									# on "++" increment the current tool number
-									if action[1:] == "++":
+									elif action[1:] == "++":
 										if actTool+1 == maxTools:
 											# use tool 0 if the active tool is the last one available
 											action = smuff_core.TOOL + "0"
@@ -565,6 +1358,12 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 
 			# @SMuFF LOAD
 			if action and action == LOAD:
+				if self.tcOverlap.pending(instance):
+					# the tool change must not start before the cut has finished
+					self.tcOverlap.finish(instance, instance.tcTimeout)
+				# tool and feeder aren't reported while the states are off (the printer is on hold here)
+				if not instance.refresh_states():
+					self._log.warning("No periodical states from SMuFF, tool and feeder state might be outdated")
 				# no tool change needed if pending tool is -1
 				if instance.pendingTool == -1 or (str(instance.pendingTool) == str(instance.curTool) and instance.feeder):
 					self._log.debug("Tool already set, skipping @SMuFF LOAD request...")
@@ -572,6 +1371,10 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 
 				try:
 					continuePrint = False
+					attempt = 1
+					fromTool = instance.parse_tool_number(instance.curTool)
+					# get the load state reported as quick as possible while changing tools
+					instance.set_states_mode(smuff_core.STATES_FAST)
 					instance.start_tc_timer()
 
 					with self._printer.job_on_hold():
@@ -579,27 +1382,46 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 							self._log.debug("SEND>> LOAD{3}: Feeder:  {0}, Pending: {1}, Current: {2}".format(str(instance.feeder), str(instance.pendingTool), str(instance.curTool), " [A]" if instance == self.SCA else " [B]"))
 
 							autoload = self._settings.get_boolean(["autoload"])
-							# send a tool change command to SMuFF
-							res = instance.send_SMuFF_and_wait(str(instance.pendingTool) + (smuff_core.AUTOLOAD if autoload else ""))
-							# make sure there's no garbage in the received string - filter for 'Tx' only, ignore the rest
-							match = re.search(r'^T\d+', res)
-							if match != None:
-								res = match[0]
-							# do we have the tool requested now?
-							if str(res) == str(instance.pendingTool):
-								instance.set_tool()
-								comm_instance._currentTool = instance.parse_tool_number(self._octoprintTool)
-								# check if filament has been loaded
-								if instance.loadState == 2 or instance.loadState == 3:
+							recovery = None
+							while True:
+								attemptStart = time.monotonic()
+								if recovery == None or recovery.endswith(smuff_retry.R_RESEND):
+									# send a tool change command to SMuFF
+									response = instance.send_SMuFF_request(str(instance.pendingTool) + (smuff_core.AUTOLOAD if autoload else ""))
+									# the tool reported in the response ('Tx' only, garbage is ignored)
+									res = response.tool
+								# do we have the tool requested now?
+								if str(res) == str(instance.pendingTool):
+									if str(instance.curTool) != str(instance.pendingTool):
+										instance.set_tool()
+									comm_instance._currentTool = instance.parse_tool_number(self._octoprintTool)
+									if self.SCA.deviceState:
+										self.SCA.deviceState.set_extra(self.SCA, octoprintTool=self._octoprintTool, activeInstance=self.activeInstance)
+									# check if filament has been loaded
+									if instance.loadState == 2 or instance.loadState == 3:
+										outcome = smuff_retry.A_LOADED
+									else:
+										outcome = smuff_retry.A_NOT_LOADED
+										self._log.warning("Tool load failed ({0} is in feeder state: {1})".format(res, instance.loadState))
+								else:
+									outcome = smuff_retry.A_WRONG_TOOL
+									self._log.warning("Tool change failed (<{0}> not <{1}>, {2})".format(res, instance.pendingTool, response.status))
+								self.tcRetry.record(instance, instance.pendingTool, attempt, outcome, recovery, time.monotonic()-attemptStart)
+
+								if outcome == smuff_retry.A_LOADED:
+									# remember the swap for the purge (curTool / preTool have been updated by the states already)
+									self._lastSwap["A" if instance == self.SCA else "B"] = (fromTool, instance.parse_tool_number(instance.pendingTool))
 									self._log.debug("SEND>> calling script 'afterToolChange'")
 									# send the default OctoPrint "After Tool Change" script to the printer
 									self._printer.script("afterToolChange")
 									continuePrint = True
-								else:
-									self._log.warning("Tool load failed, retrying ({0} is in feeder state: {1})".format(res, instance.loadState))
-							else:
-								# not the result we expected, do it all again
-								self._log.warning("Tool change failed, retrying (<{0}> not <{1}>)".format(res, instance.pendingTool))
+									break
+								if attempt > self.tcRetry.retries:
+									self._escalate_tool_change(instance, attempt, outcome)
+									break
+								self._setResponse("Tool change failed ({0}), retrying {1}/{2}...".format(outcome, attempt, self.tcRetry.retries), True, instance)
+								recovery = self.tcRetry.recover(instance, attempt, outcome)
+								attempt += 1
 
 						except UnknownScript as err:
 							# shouldn't happen at all, since we're using default OctoPrint scripts
@@ -611,10 +1433,17 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 						finally:
 							duration = instance.stop_tc_timer()
 							self._setResponse("Tool change took {:4.2f} secs.".format(duration), True, instance)
+							inst = "A" if instance == self.SCA else "B"
+							self.jobs.tool_change(inst, instance.pendingTool, duration, attempt)
+							if continuePrint:
+								self.filament.set_tool(inst, instance.parse_tool_number(instance.pendingTool))
+								self.swapEstimator.tool_changed(inst, fromTool if fromTool >= 0 else None, instance.parse_tool_number(instance.pendingTool), duration)
+							instance.apply_idle_states()
 							if continuePrint:
 								try:
 									# now is the time to release the hold and continue printing
 									self._printer.set_job_on_hold(False)
+									self.jobs.hold_stop()
 								except RuntimeError as err:
 									# might happen if the printer is offline
 									errmsg = "Can't unpause printer because: {})".format(err)
@@ -626,23 +1455,65 @@ class SmuffPlugin(octoprint.plugin.SettingsPlugin,
 					self._setResponse(errmsg, True, instance)
 					self._log.error(errmsg)
 
+	#
+	# All retries of a tool change have failed, pause the print and notify the user
+	#
+	def _escalate_tool_change(self, instance, attempts, outcome):
+		self.tcRetry.record(instance, instance.pendingTool, attempts, smuff_retry.A_ESCALATED)
+		self.jobs.escalation()
+		errmsg = "Tool change to {0} failed after {1} attempt(s) ({2})".format(instance.pendingTool, attempts, outcome)
+		self._log.error(errmsg)
+		self._setResponse(errmsg, True, instance)
+		if hasattr(self, "_plugin_manager"):
+			self._plugin_manager.send_plugin_message(self._identifier, {'type': 'notify', 'message': errmsg })
+		if self.tcRetry.pauseOnFail:
+			try:
+				self._printer.pause_print()
+			except RuntimeError as err:
+				self._log.error("Can't pause printer because: {0}".format(err))
+
+	#
+	# Returns the purge length for the last tool swap (previous -> current tool).
+	# If the swap isn't known (i.e. no swap yet or loaded into an empty feeder),
+	# the amount set by SETPURGE or the base purge length is used instead.
+	#
+	def _get_purge_length(self, instance):
+		inst = "A" if instance == self.SCA else "B"
+		matrix = self._purgeMatrix[inst]
+		matrix.base 	= self._settings.get_float(["purgeBase"])
+		matrix.minimum 	= self._settings.get_float(["purgeMin"])
+		matrix.update(instance.materials, (instance.config.version, matrix.base, matrix.minimum))
+		swap = self._lastSwap[inst]
+		amount = matrix.get(swap[0], swap[1]) if swap else None
+		if amount == None:
+			amount = self._purgeAmount or matrix.base
+		return amount
+
 	def extend_script_variables(self, comm_instance, script_type, script_name, *args, **kwargs):
-		self._log.debug("Script variable request for type='{0}' and script='{1}'".format(script_type, script_name))
+		self._log.debug("Script variable request for type='%s' and script='%s'", script_type, script_name, extra=smuff_core.LOG_CMD)
+		instance = self.SCB if self.activeInstance == "B" else self.SCA
+		swap = self._lastSwap[self.activeInstance] or (-1, -1)
 		vars = dict(
 			mustPurge=self._mustPurgeAfterChange,
-			purgeAmount=self._purgeAmount
+			purgeAmount=self._purgeAmount,
+			purgeFrom=swap[0],
+			purgeTo=swap[1],
+			purgeLength=self._get_purge_length(instance) if self._settings.get_boolean(["purgeMatrix"]) else None
 			)
-		self._log.debug("Returning: mustPurge='{0}', purgeAmount='{1}'".format(vars["mustPurge"], vars["purgeAmount"]))
+		self._log.debug("Returning: mustPurge='%s', purgeAmount='%s'", vars["mustPurge"], vars["purgeAmount"], extra=smuff_core.LOG_CMD)
 		return None, None, vars
 
 	def extend_gcode_received(self, comm_instance, line, *args, **kwargs):
 		# Refresh the current tool in OctoPrint on each command coming from the printer - just in case
 		# This is needed because OctoPrint manages the current tool itself and it might try to swap
 		# tools because of the wrong information.
-		if self._octoprintTool == -1:
-			comm_instance._currentTool = self.SCA.parse_tool_number(self.SCA.curTool)
+		if self._octoprintTool:
+			tool = self.SCA.parse_tool_number(self._octoprintTool)
 		else:
-			comm_instance._currentTool = self.SCA.parse_tool_number(self._octoprintTool)
+			tool = self.SCA.get_active_tool()
+		if tool >= 0:
+			# never overwrite OctoPrint's tool with an unknown one (i.e. right after a restart)
+			comm_instance._currentTool = tool
 		# don't process any of the GCodes received further
 		return line
 
@@ -695,7 +1566,8 @@ def __plugin_load__():
 		"octoprint.comm.protocol.scripts": 				__plugin_implementation__.extend_script_variables,
 		"octoprint.comm.protocol.gcode.sending": 		__plugin_implementation__.extend_tool_sending,
 		"octoprint.comm.protocol.gcode.queuing": 		__plugin_implementation__.extend_tool_queuing,
-		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
+		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
+		"octoprint.printer.estimation.factory":			__plugin_implementation__.get_estimator_factory
 	}
 
 def __plugin_unload__():
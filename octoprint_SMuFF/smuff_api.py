@@ -0,0 +1,181 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF asynchronous command jobs
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Runs commands for the SMuFF submitted through the plugin's API in worker
+# threads (a limited number per device), so that neither the caller nor
+# OctoPrint's comm thread has to wait for the SMuFF. Each command gets a
+# job id the caller can poll or wait for.
+
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+import queue
+import time
+import uuid
+
+from . import smuff_broker
+
+MAX_JOBS_KEPT 	= 200 					# number of finished jobs kept for polling
+DEF_LIMIT 		= 1 					# default number of commands running concurrently per device
+DEF_QUEUE_SIZE	= 20 					# default max. number of commands waiting per device
+DEF_WAIT 		= 10.0 					# default time (in seconds) an API call waits for a job
+MAX_WAIT 		= 120.0 				# max. time an API call may wait for a job
+
+# Job states
+J_QUEUED 		= "queued"
+J_RUNNING 		= "running"
+J_DONE 			= "done"
+J_FAILED 		= "failed"
+
+class QueueFullError(Exception):
+	pass
+
+class CommandJobs():
+
+	def __init__(self, logger, limit=DEF_LIMIT, queueSize=DEF_QUEUE_SIZE):
+		self._log 		= logger
+		self._lock 		= Lock()
+		self._devices 	= {}			# device name -> dict(instance, queue, workers)
+		self._jobs 		= OrderedDict()	# job id -> job
+		self._events 	= {}			# job id -> Event set when the job has finished
+		self.limit 		= limit 		# number of commands running concurrently per device
+		self.queueSize 	= queueSize		# max. number of commands waiting per device
+
+	#
+	# Registers a SMuFF instance under a device name ("A" / "B")
+	#
+	def add_device(self, name, instance):
+		with self._lock:
+			self._devices[name] = dict(instance=instance, queue=queue.Queue(self.queueSize), workers=[])
+
+	#
+	# Queues a command for a device and returns the id of the job. Instead of
+	# sending the GCode, call(instance) can be run, which has to return a tuple
+	# (ok, result); gcode is just the job's description then.
+	#
+	def submit(self, name, gcode, timeout=None, call=None):
+		with self._lock:
+			device = self._devices.get(name)
+			if device == None:
+				raise KeyError("Unknown device '{0}'".format(name))
+			jobId = uuid.uuid4().hex[:12]
+			job = dict(id=jobId, device=name, command=gcode, state=J_QUEUED, result=None, error=None,
+				created=time.time(), started=None, finished=None)
+			try:
+				device["queue"].put_nowait((job, timeout, call))
+			except queue.Full:
+				raise QueueFullError("Too many commands waiting for device '{0}'".format(name))
+			self._jobs[jobId] = job
+			self._events[jobId] = Event()
+			self._expire()
+			self._start_workers(name, device)
+		return jobId
+
+	#
+	# Returns a copy of the job (None if it's unknown)
+	#
+	def get(self, jobId):
+		with self._lock:
+			job = self._jobs.get(jobId)
+			return dict(job) if job != None else None
+
+	#
+	# Waits until the job has finished (or the timeout has expired) and returns it
+	#
+	def wait(self, jobId, timeout=None):
+		with self._lock:
+			event = self._events.get(jobId)
+		if event == None:
+			return None
+		event.wait(timeout)
+		return self.get(jobId)
+
+	#
+	# Returns the last jobs (newest first)
+	#
+	def get_jobs(self, limit=20):
+		with self._lock:
+			jobs = [ dict(job) for job in self._jobs.values() ]
+		jobs.reverse()
+		return jobs[:limit] if limit else jobs
+
+	def _start_workers(self, name, device):
+		device["workers"] = [ worker for worker in device["workers"] if worker.is_alive() ]
+		while len(device["workers"]) < self.limit:
+			worker = Thread(target=self._worker, args=(device,), name="TApi{0}".format(name))
+			worker.daemon = True
+			worker.start()
+			device["workers"].append(worker)
+
+	def _worker(self, device):
+		while True:
+			job, timeout, call = device["queue"].get()
+			if job == None:
+				break
+			instance = device["instance"]
+			with self._lock:
+				job["state"] = J_RUNNING
+				job["started"] = time.time()
+			try:
+				if not instance.isConnected:
+					raise ConnectionError("SMuFF is not connected")
+				# wait for a tool change or any other command in progress no longer than the job's timeout
+				timeout = timeout if timeout != None else instance.cmdTimeout
+				if call:
+					with instance.broker.access(job["command"], timeout):
+						ok, result = call(instance)
+					state = J_DONE if ok else J_FAILED
+					error = None if ok else "{0} failed".format(job["command"])
+				else:
+					response = instance.send_SMuFF_request(job["command"], timeout)
+					result = response.text
+					state = J_DONE if response.ok else J_FAILED
+					error = None if response.ok else "SMuFF response: {0}".format(response.status)
+			except smuff_broker.BrokerTimeout:
+				result = None
+				state = J_FAILED
+				error = "SMuFF is busy"
+			except Exception as err:
+				result = None
+				state = J_FAILED
+				error = str(err)
+			with self._lock:
+				job["state"] = state
+				job["result"] = result
+				job["error"] = error
+				job["finished"] = time.time()
+				event = self._events.get(job["id"])
+			if event:
+				event.set()
+			if state == J_FAILED:
+				self._log.warning("API job {0} ({1}) failed: {2}".format(job["id"], job["command"], error))
+
+	#
+	# Drops the oldest finished jobs (called with the lock held)
+	#
+	def _expire(self):
+		while len(self._jobs) > MAX_JOBS_KEPT:
+			oldest = next(iter(self._jobs))
+			if self._jobs[oldest]["state"] in (J_QUEUED, J_RUNNING):
+				break
+			del self._jobs[oldest]
+			self._events.pop(oldest, None)
+
+	#
+	# Lets the workers finish the command they're running and stop
+	#
+	def stop(self):
+		with self._lock:
+			devices = list(self._devices.values())
+		for device in devices:
+			for _ in device["workers"]:
+				try:
+					device["queue"].put_nowait((None, None, None))
+				except queue.Full:
+					pass
@@ -0,0 +1,440 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF load / soak benchmark
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Runs the plugin outside of OctoPrint: SmuffPlugin gets stubs for the
+# printer, the settings and the plugin manager and is connected to the
+# SMuFF simulator (pty). A synthetic multi tool GCode stream is replayed
+# through the queuing / sending / received hooks the way OctoPrint's comm
+# layer does it, including the scripts and commands the plugin injects
+# during tool changes. Reports throughput, tool change latencies, thread
+# count, memory and CPU usage periodically, so that it can run for hours.
+#
+# With --startup, measures the time from OctoPrint's startup hook until the
+# UI can proceed and until each SMuFF is reported ready, for one and two
+# SMuFFs being connected, absent or hung.
+#
+# Requires OctoPrint and pySerial to be installed (like the plugin itself):
+#	python -m octoprint_SMuFF.smuff_bench [--duration 3600] [--tools 5] [--tc-secs 0.5] [--idex]
+#	python -m octoprint_SMuFF.smuff_bench --startup
+
+from collections import deque
+from contextlib import contextmanager
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from . import smuff_simulator
+
+REPORT_EVERY 	= 10.0 					# default reporting interval (in seconds)
+CONNECT_WAIT 	= 30.0 					# max. time to wait for the SMuFF init sequence
+MAX_SAMPLES 	= 10000 				# number of latencies kept for the percentiles
+
+# Startup scenarios: SMuFF A (and B) connected ("ok"), absent or hung
+STARTUP_CASES 	= [
+	[ "ok" ], [ "absent" ], [ "hung" ],
+	[ "ok", "ok" ], [ "ok", "absent" ], [ "ok", "hung" ], [ "absent", "absent" ], [ "hung", "hung" ]
+]
+
+# GCode command of a line, like OctoPrint determines it
+GCODE_RE 		= re.compile(r"^\s*([GM]\d+|T\d+)")
+
+SCRIPTS 		= {
+	"beforeToolChange": [ "G1 E-2 F2400", "M400", "@SMuFF PRECUT", "G91", "G1 Z2 F600", "G90", "G1 X10 Y200 F9000", "@SMuFF LOAD" ],
+	"afterToolChange": 	[ "G92 E0", "@SMuFF PURGE 5", "G1 E2 F2400" ]
+}
+
+#------------------------------------------------------------------------------
+# Stubs for the OctoPrint objects the plugin uses
+#------------------------------------------------------------------------------
+
+class StubSettings():
+
+	def __init__(self, defaults, overrides=None):
+		self._values = dict(defaults)
+		self._values.update(overrides or {})
+
+	def get(self, path, **kwargs):
+		return self._values.get(path[0])
+
+	def get_int(self, path, **kwargs):
+		value = self.get(path)
+		return int(value) if value != None else None
+
+	def get_float(self, path, **kwargs):
+		value = self.get(path)
+		return float(value) if value != None else None
+
+	def get_boolean(self, path, **kwargs):
+		return bool(self.get(path))
+
+	def set(self, path, value, **kwargs):
+		self._values[path[0]] = value
+
+	def save(self, **kwargs):
+		pass
+
+#
+# Printer: scripts and commands are put into the pipeline the runner sends from,
+# holds are counted like in OctoPrint's comm layer
+#
+class StubPrinter():
+
+	def __init__(self, pipeline):
+		self._pipeline 	= pipeline
+		self._hold 		= 0
+		self.pauses 	= 0
+
+	@property
+	def on_hold(self):
+		return self._hold > 0
+
+	def set_job_on_hold(self, value, blocking=True):
+		if value:
+			self._hold += 1
+		else:
+			self._hold = max(0, self._hold - 1)
+		return True
+
+	@contextmanager
+	def job_on_hold(self, blocking=True):
+		self.set_job_on_hold(True, blocking)
+		try:
+			yield
+		finally:
+			self.set_job_on_hold(False)
+
+	def script(self, name, *args, **kwargs):
+		self._pipeline.extend(SCRIPTS.get(name, []))
+
+	def commands(self, commands, *args, **kwargs):
+		self._pipeline.extend([ commands ] if isinstance(commands, str) else commands)
+
+	def is_printing(self):
+		return True
+
+	def is_pausing(self):
+		return False
+
+	def pause_print(self, *args, **kwargs):
+		self.pauses += 1
+
+class StubPluginManager():
+
+	def __init__(self):
+		self.messages = 0
+
+	def send_plugin_message(self, identifier, data):
+		self.messages += 1
+
+class StubComm():
+
+	def __init__(self):
+		self._currentTool = 0
+
+#------------------------------------------------------------------------------
+# GCode stream
+#------------------------------------------------------------------------------
+
+#
+# Endless synthetic multi tool print: moves with relative extrusion, fan
+# changes and E resets, a tool change every 'toolEvery' lines
+#
+def synthetic_gcode(tools, toolEvery, seed=0):
+	rnd = random.Random(seed)
+	tool = 0
+	yield "M83"
+	yield "T0"
+	n = 0
+	while True:
+		n += 1
+		x = 100 + 80 * math.sin(n / 50.0)
+		y = 100 + 80 * math.cos(n / 50.0)
+		if n % 20 == 0:
+			yield "G0 X{0:.3f} Y{1:.3f} F9000".format(x, y)
+		else:
+			yield "G1 X{0:.3f} Y{1:.3f} E{2:.5f}".format(x, y, 0.02 + rnd.random() * 0.04)
+		if n % 500 == 0:
+			yield "M106 S{0}".format(rnd.randint(0, 255))
+		if n % 1000 == 0:
+			yield "G92 E0"
+		if n % toolEvery == 0 and tools > 1:
+			tool = (tool + rnd.randint(1, tools - 1)) % tools
+			yield "T{0}".format(tool)
+
+#------------------------------------------------------------------------------
+# Runner
+#------------------------------------------------------------------------------
+
+def _percentile(values, p):
+	if not values:
+		return None
+	return values[min(len(values)-1, int(math.ceil(p * len(values))) - 1)]
+
+def _rss_mb():
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmRSS:"):
+					return int(line.split()[1]) / 1024
+	except OSError:
+		pass
+	# peak instead of current RSS (kB on Linux, bytes on macOS)
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+class SoakBench():
+
+	def __init__(self, args):
+		self.args 		= args
+		self.pipeline 	= deque()		# lines injected by the plugin (scripts / commands)
+		self.comm 		= StubComm()
+		self.lines 		= 0 			# lines sent to the "printer"
+		self.toolChanges= 0
+		self.hookSecs 	= 0.0 			# time spent in the hooks (w/o tool changes)
+		self.tcLatency 	= deque(maxlen=MAX_SAMPLES)	# duration of @SMuFF LOAD (in seconds)
+		self.simulators = []
+		self.plugin 	= None
+		self._dataFolder = None
+
+	#
+	# Creates the plugin with the stubs (on_after_startup hasn't been called yet)
+	#
+	def _make_plugin(self, overrides):
+		from . import SmuffPlugin, LOGGER
+
+		plugin = SmuffPlugin(logging.getLogger(LOGGER))
+		self._dataFolder = tempfile.mkdtemp(prefix="smuff_bench_")
+		plugin._identifier 		= "SMuFF"
+		plugin._data_folder 	= self._dataFolder
+		plugin._settings 		= StubSettings(plugin.get_settings_defaults(), overrides)
+		plugin._printer 		= StubPrinter(self.pipeline)
+		plugin._plugin_manager 	= StubPluginManager()
+		return plugin
+
+	def setup(self):
+		logging.basicConfig(level=getattr(logging, self.args.log_level.upper(), logging.WARNING))
+		overrides = dict(connectInBackground=False, asyncLogging=False, hasIDEX=self.args.idex, tcOverlap=self.args.overlap)
+		for n, key in enumerate([ "tty", "ttyB" ][:2 if self.args.idex else 1]):
+			simulator = smuff_simulator.SmuffSimulator(self.args.tools, self.args.tc_secs, self.args.cmd_secs, self.args.fail_rate, seed=n)
+			overrides[key] = os.path.relpath(simulator.start(), "/dev")
+			self.simulators.append(simulator)
+
+		plugin = self._make_plugin(overrides)
+		plugin.on_after_startup()
+		self.plugin = plugin
+
+		instances = [ plugin.SCA, plugin.SCB ][:len(self.simulators)]
+		endTime = time.monotonic() + CONNECT_WAIT
+		while time.monotonic() < endTime:
+			if all([ instance.isConnected and instance._initState == 0 and instance.fwInfo != "?" for instance in instances ]):
+				return True
+			time.sleep(0.1)
+		return False
+
+	def teardown(self):
+		if self.plugin:
+			self.plugin.on_shutdown()
+		for simulator in self.simulators:
+			simulator.stop()
+		if self._dataFolder:
+			shutil.rmtree(self._dataFolder, ignore_errors=True)
+		self.plugin = None
+		self.simulators = []
+		self._dataFolder = None
+
+	#
+	# Starts the plugin with the SMuFFs given (each "ok", "absent" or "hung") and
+	# returns the time on_after_startup took and the time until each SMuFF was
+	# reported ready / failed (both in seconds)
+	#
+	def startup(self, devices):
+		overrides = dict(connectInBackground=True, autoDiscover=False, asyncLogging=False, hasIDEX=len(devices) > 1)
+		for n, (key, device) in enumerate(zip([ "tty", "ttyB" ], devices)):
+			if device == "absent":
+				overrides[key] = "ttySMuFF_absent{0}".format(n)
+				continue
+			simulator = smuff_simulator.SmuffSimulator(self.args.tools, self.args.tc_secs, seed=n, hung=(device == "hung"))
+			overrides[key] = os.path.relpath(simulator.start(), "/dev")
+			self.simulators.append(simulator)
+
+		plugin = self._make_plugin(overrides)
+		self.plugin = plugin
+		ready = {}
+		done = threading.Event()
+		callback = plugin.smuffReadyCallback
+		def readyCallback(instance, success, duration):
+			ready[instance] = (time.perf_counter() - startTime, success)
+			callback(instance, success, duration)
+			if len(ready) == len(devices):
+				done.set()
+		plugin.smuffReadyCallback = readyCallback
+
+		startTime = time.perf_counter()
+		plugin.on_after_startup()
+		startupSecs = time.perf_counter() - startTime
+		done.wait(CONNECT_WAIT)
+		instances = [ plugin.SCA, plugin.SCB ][:len(devices)]
+		return startupSecs, [ ready.get(instance, (None, False)) for instance in instances ]
+
+	#
+	# Passes a line through a hook and returns the resulting line(s), like OctoPrint
+	# does it: None keeps the line, a string or a list (of strings / tuples) replaces it
+	#
+	def _hook(self, hook, phase, cmd):
+		match = GCODE_RE.match(cmd)
+		gcode = match.group(1) if match else None
+		result = hook(self.comm, phase, cmd, None, gcode, None, set())
+		if result == None:
+			return [ cmd ]
+		if isinstance(result, str):
+			return [ result ]
+		if isinstance(result, tuple):
+			return [ result[0] ]
+		return [ entry[0] if isinstance(entry, tuple) else entry for entry in result ]
+
+	def _send(self, cmd):
+		start = time.perf_counter()
+		isLoad = cmd.startswith("@SMuFF") and cmd.split()[1:2] == [ "LOAD" ]
+		for queued in self._hook(self.plugin.extend_tool_queuing, "queuing", cmd):
+			for sent in self._hook(self.plugin.extend_tool_sending, "sending", queued):
+				self.lines += 1
+				if not sent.startswith("@"):
+					self.plugin.extend_gcode_received(self.comm, "ok\n")
+		elapsed = time.perf_counter() - start
+		if isLoad:
+			self.toolChanges += 1
+			self.tcLatency.append(elapsed)
+		else:
+			self.hookSecs += elapsed
+
+	def run(self):
+		args = self.args
+		from octoprint.events import Events
+
+		tools = args.tools * (2 if args.idex else 1)
+		stream = synthetic_gcode(tools, args.tool_every, args.seed)
+		report = open(args.json, "a") if args.json else None
+		self.plugin.on_event(Events.PRINT_STARTED, dict(name="bench", origin="bench"))
+		jobLines = 0
+		startTime = lastTime = time.monotonic()
+		startCpu = lastCpu = time.process_time()
+		lastLines = 0
+		lastHookSecs = 0.0
+		nextReport = startTime + args.interval
+		try:
+			while True:
+				if self.pipeline:
+					self._send(self.pipeline.popleft())
+					continue
+				now = time.monotonic()
+				if now >= nextReport:
+					cpu = time.process_time()
+					lines = self.lines - lastLines
+					latencies = sorted(self.tcLatency)
+					sample = dict(
+						elapsedSecs 	= round(now - startTime, 1),
+						lines 			= self.lines,
+						linesPerSec 	= round(lines / (now - lastTime)),
+						hookUsPerLine 	= round((self.hookSecs - lastHookSecs) / lines * 1e6, 2) if lines else None,
+						toolChanges 	= self.toolChanges,
+						tcP50Secs 		= round(_percentile(latencies, 0.50), 3) if latencies else None,
+						tcP99Secs 		= round(_percentile(latencies, 0.99), 3) if latencies else None,
+						tcMaxSecs 		= round(latencies[-1], 3) if latencies else None,
+						threads 		= threading.active_count(),
+						rssMB 			= round(_rss_mb(), 1),
+						cpuPct 			= round((cpu - lastCpu) / (now - lastTime) * 100, 1)
+					)
+					print("{elapsedSecs:8.1f}s {lines:10d} lines {linesPerSec:7d} lines/s {hookUsPerLine} us/line | {toolChanges:5d} TC p50 {tcP50Secs} p99 {tcP99Secs} max {tcMaxSecs} s | {threads} threads {rssMB} MB RSS {cpuPct}% CPU".format(**sample))
+					sys.stdout.flush()
+					if report:
+						report.write(json.dumps(sample) + "\n")
+						report.flush()
+					lastTime, lastCpu, lastLines, lastHookSecs = now, cpu, self.lines, self.hookSecs
+					nextReport = now + args.interval
+					if now - startTime >= args.duration:
+						break
+				if self.plugin._printer.on_hold:
+					# a tool change has failed (print paused), the job can't continue
+					print("Printer is still on hold after a tool change, aborting")
+					return 1
+				self._send(next(stream))
+				jobLines += 1
+				if args.job_lines and jobLines >= args.job_lines:
+					# start a new job, so finishing / starting jobs gets exercised as well
+					self.plugin.on_event(Events.PRINT_DONE, dict(name="bench", origin="bench"))
+					self.plugin.on_event(Events.PRINT_STARTED, dict(name="bench", origin="bench"))
+					jobLines = 0
+		finally:
+			self.plugin.on_event(Events.PRINT_DONE, dict(name="bench", origin="bench"))
+			if report:
+				report.close()
+		return 0
+
+#
+# Runs the startup scenarios and prints the time to the UI and to each SMuFF being ready
+#
+def startup_bench(args):
+	logging.basicConfig(level=getattr(logging, args.log_level.upper(), logging.WARNING))
+	print("{0:20s} {1:>10s}  {2}".format("SMuFF(s)", "startup", "ready (A / B)"))
+	for devices in STARTUP_CASES:
+		bench = SoakBench(args)
+		try:
+			startupSecs, ready = bench.startup(devices)
+		finally:
+			bench.teardown()
+		states = [ "{0:6.2f}s {1}".format(secs, "ready" if success else "failed") if secs != None else "timeout" for secs, success in ready ]
+		print("{0:20s} {1:9.1f}ms  {2}".format(" + ".join(devices), startupSecs * 1000, " / ".join(states)))
+		sys.stdout.flush()
+	return 0
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Load / soak test the SMuFF plugin's GCode hooks against simulated SMuFFs")
+	parser.add_argument("--duration", type=float, default=60.0, help="run time (in seconds)")
+	parser.add_argument("--interval", type=float, default=REPORT_EVERY, help="reporting interval (in seconds)")
+	parser.add_argument("--tools", type=int, default=5, help="tools per SMuFF")
+	parser.add_argument("--idex", action="store_true", help="use two SMuFFs")
+	parser.add_argument("--tool-every", type=int, default=5000, help="lines between tool changes")
+	parser.add_argument("--job-lines", type=int, default=0, help="lines per print job (0 = one job)")
+	parser.add_argument("--tc-secs", type=float, default=0.5, help="simulated tool change duration (in seconds)")
+	parser.add_argument("--cmd-secs", type=float, default=0.0, help="simulated duration of other commands (in seconds)")
+	parser.add_argument("--fail-rate", type=float, default=0.0, help="probability of a failing tool change")
+	parser.add_argument("--overlap", action="store_true", help="overlap cutting with the beforeToolChange script")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--json", help="append the samples to this file (JSON lines)")
+	parser.add_argument("--log-level", default="warning")
+	parser.add_argument("--startup", action="store_true", help="measure the startup time with connected / absent / hung SMuFFs")
+	args = parser.parse_args(argv)
+
+	if args.startup:
+		return startup_bench(args)
+
+	bench = SoakBench(args)
+	try:
+		if not bench.setup():
+			print("SMuFF simulator didn't finish the init sequence within {0} secs.".format(CONNECT_WAIT))
+			return 1
+		return bench.run()
+	except KeyboardInterrupt:
+		return 0
+	finally:
+		bench.teardown()
+
+if __name__ == "__main__":
+	sys.exit(main())
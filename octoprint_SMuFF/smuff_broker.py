@@ -0,0 +1,204 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF command broker
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Serializes the access to a SMuFF: only one caller at a time may send a
+# command and wait for its response, callers get served in the order they
+# arrived (FIFO). Keeps track of how long callers had to wait and who's
+# holding the SMuFF right now.
+#
+# Stress test (against a simulated SMuFF):
+#	python -m octoprint_SMuFF.smuff_broker [--threads 16] [--calls 200] [--delay 0.001]
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition, Thread, current_thread, get_ident
+
+import argparse
+import logging
+import math
+import sys
+import time
+
+MAX_WAITS 		= 500 					# number of wait times kept for the percentiles
+
+class BrokerTimeout(Exception):
+	pass
+
+class CommandBroker():
+
+	def __init__(self):
+		self._cond 		= Condition()
+		self._waiters 	= deque()		# tickets of the callers waiting, in order of arrival
+		self._owner 	= None			# thread id of the holder
+		self._depth 	= 0 			# nesting depth of the holder
+		self.holder 	= None			# what the holder is doing (i.e. the GCode sent)
+		self.holderThread = None		# name of the holder's thread
+		self._since 	= None			# time the holder has got the access
+		self.acquisitions = 0 			# number of accesses granted
+		self.contended 	= 0 			# number of accesses which had to wait
+		self.timeouts 	= 0 			# number of callers which gave up waiting
+		self.waitMax 	= 0.0 			# longest wait (in seconds)
+		self.holdMax 	= 0.0 			# longest access (in seconds)
+		self._waits 	= deque(maxlen=MAX_WAITS)
+
+	@property
+	def busy(self):
+		return self._owner != None
+
+	#
+	# Exclusive access to the SMuFF for the caller (re-entrant for the holder).
+	# Raises BrokerTimeout if the access hasn't been granted within the timeout.
+	#
+	@contextmanager
+	def access(self, caller=None, timeout=None):
+		self.acquire(caller, timeout)
+		try:
+			yield self
+		finally:
+			self.release()
+
+	def acquire(self, caller=None, timeout=None):
+		me = get_ident()
+		with self._cond:
+			if self._owner == me:
+				self._depth += 1
+				return
+			start = time.monotonic()
+			if self._owner != None or len(self._waiters):
+				ticket = object()
+				self._waiters.append(ticket)
+				self.contended += 1
+				endTime = None if timeout == None else start + timeout
+				while self._owner != None or self._waiters[0] is not ticket:
+					remaining = None if endTime == None else endTime - time.monotonic()
+					if remaining != None and remaining <= 0:
+						self._waiters.remove(ticket)
+						self.timeouts += 1
+						self._cond.notify_all()
+						raise BrokerTimeout("Waited {0:.1f} secs. for the SMuFF held by '{1}'".format(timeout, self.holder))
+					self._cond.wait(remaining)
+				self._waiters.popleft()
+			waited = time.monotonic() - start
+			self._owner 		= me
+			self._depth 		= 1
+			self.holder 		= caller
+			self.holderThread 	= current_thread().name
+			self._since 		= time.monotonic()
+			self.acquisitions += 1
+			self._waits.append(waited)
+			if waited > self.waitMax:
+				self.waitMax = waited
+			if self._waiters:
+				# the next one in line has to wait for this holder
+				self._cond.notify_all()
+
+	def release(self):
+		with self._cond:
+			if self._owner != get_ident():
+				raise RuntimeError("Releasing a SMuFF access that isn't held")
+			self._depth -= 1
+			if self._depth > 0:
+				return
+			held = time.monotonic() - self._since
+			if held > self.holdMax:
+				self.holdMax = held
+			self._owner 		= None
+			self.holder 		= None
+			self.holderThread 	= None
+			self._since 		= None
+			self._cond.notify_all()
+
+	def get_stats(self):
+		with self._cond:
+			waits = sorted(self._waits)
+			stats = dict(
+				acquisitions 	= self.acquisitions,
+				contended 		= self.contended,
+				timeouts 		= self.timeouts,
+				waiting 		= len(self._waiters),
+				holder 			= self.holder,
+				holderThread 	= self.holderThread,
+				holdingSecs 	= round(time.monotonic() - self._since, 3) if self._since != None else None,
+				holdMaxSecs 	= round(self.holdMax, 3)
+			)
+		stats["waitAvgMs"] = round(sum(waits) / len(waits) * 1000, 2) if len(waits) else None
+		stats["waitP99Ms"] = round(waits[min(len(waits)-1, int(math.ceil(0.99 * len(waits))) - 1)] * 1000, 2) if len(waits) else None
+		stats["waitMaxMs"] = round(self.waitMax * 1000, 2)
+		return stats
+
+#------------------------------------------------------------------------------
+# Stress test
+#------------------------------------------------------------------------------
+
+#
+# Simulated serial port: answers each command with the command itself plus "ok".
+# Counts commands that arrive while the previous one is still being processed.
+#
+class _SimulatedSerial():
+
+	def __init__(self, core, delay):
+		self.is_open 	= True
+		self._core 		= core
+		self._delay 	= delay
+		self._pending 	= 0
+		self.overlaps 	= 0
+		self.commands 	= 0
+
+	def write(self, data):
+		self._pending += 1
+		if self._pending > 1:
+			self.overlaps += 1
+		self.commands += 1
+		responder = Thread(target=self._respond, args=(data.decode("ascii").rstrip("\n"),))
+		responder.daemon = True
+		responder.start()
+		return len(data)
+
+	def _respond(self, cmd):
+		time.sleep(self._delay)
+		self._pending -= 1
+		self._core._parse_serial_data(cmd + "\n")
+		self._core._parse_serial_data("ok\n")
+
+def main(argv=None):
+	from . import smuff_core
+
+	parser = argparse.ArgumentParser(description="Hammer send_SMuFF_and_wait from many threads against a simulated SMuFF")
+	parser.add_argument("--threads", type=int, default=16)
+	parser.add_argument("--calls", type=int, default=200, help="calls per thread")
+	parser.add_argument("--delay", type=float, default=0.001, help="simulated response time (in seconds)")
+	args = parser.parse_args(argv)
+
+	logging.basicConfig(level=logging.WARNING)
+	core = smuff_core.SmuffCore(logging.getLogger("SMuFF.stress"), False, None, None)
+	core._serial = _SimulatedSerial(core, args.delay)
+	core.isConnected = True
+	core.cmdTimeout = 5
+	wrong = [ 0 ]
+
+	def caller(n):
+		for i in range(args.calls):
+			cmd = "M205 P\"T{0}\"S{1}".format(n, i)
+			if core.send_SMuFF_and_wait(cmd) != cmd:
+				wrong[0] += 1
+
+	start = time.monotonic()
+	threads = [ Thread(target=caller, args=(n,)) for n in range(args.threads) ]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	elapsed = time.monotonic() - start
+	total = args.threads * args.calls
+	print("{0} calls from {1} threads in {2:.2f} secs.: {3} wrong result(s), {4} overlapping command(s)".format(total, args.threads, elapsed, wrong[0], core._serial.overlaps))
+	print(core.broker.get_stats())
+	return 1 if wrong[0] or core._serial.overlaps else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,173 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF serial traffic recorder / replay
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Records the raw serial traffic of a SMuFF into a compact binary capture
+# file (rotated when it exceeds its maximum size) and feeds captures back
+# into SmuffCore._parse_serial_data, either in real time or as fast as
+# possible, for reproducing field issues and benchmarking the parser.
+#
+# Usage:
+#	python -m octoprint_SMuFF.smuff_capture [--max] [--dump] capture.bin
+
+from threading import Lock
+
+import argparse
+import logging
+import os
+import struct
+import sys
+import time
+
+from . import smuff_core
+
+MAGIC 			= b"SMCAP1\n"			# file header of a capture file
+RECORD 			= struct.Struct("<BdH")	# direction, monotonic timestamp, length
+DIR_RX 			= smuff_core.CAP_RX		# received from the SMuFF
+DIR_TX 			= smuff_core.CAP_TX		# sent to the SMuFF
+DEF_MAX_SIZE	= 4*1024*1024 			# default maximum size of a capture file
+DEF_FILES 		= 3 					# default number of capture files kept (incl. the current one)
+
+class SerialRecorder():
+
+	def __init__(self, logger, fileName, maxSize=DEF_MAX_SIZE, files=DEF_FILES):
+		self._log 		= logger
+		self._lock 		= Lock()
+		self._file 		= None
+		self._size 		= 0
+		self.fileName 	= fileName		# name of the current capture file
+		self.maxSize 	= maxSize		# rotate the capture file when exceeding this size
+		self.files 		= files			# number of capture files kept
+		self.records 	= 0 			# number of records written
+
+	def start(self):
+		with self._lock:
+			if self._file:
+				return True
+			return self._open()
+
+	def stop(self):
+		with self._lock:
+			self._close()
+
+	@property
+	def active(self):
+		return self._file != None
+
+	#
+	# Appends a record (called from the serial reader thread and the senders)
+	#
+	def record(self, direction, data):
+		if not self._file:
+			return
+		with self._lock:
+			if not self._file:
+				return
+			try:
+				self._file.write(RECORD.pack(direction, time.monotonic(), len(data)))
+				self._file.write(data)
+				self._size += RECORD.size + len(data)
+				self.records += 1
+				if self._size >= self.maxSize:
+					self._rotate()
+			except Exception as err:
+				self._log.error("Writing capture file '{0}' has failed, stopping capture:\n\t{1}".format(self.fileName, err))
+				self._close()
+
+	def _open(self):
+		try:
+			self._file = open(self.fileName, "wb", buffering=64*1024)
+			self._file.write(MAGIC)
+			self._size = len(MAGIC)
+			self._log.info("Capturing serial traffic into '{0}'".format(self.fileName))
+			return True
+		except Exception as err:
+			self._log.error("Can't open capture file '{0}':\n\t{1}".format(self.fileName, err))
+			self._file = None
+		return False
+
+	def _close(self):
+		if self._file:
+			try:
+				self._file.close()
+			except Exception as err:
+				self._log.error("Can't close capture file '{0}':\n\t{1}".format(self.fileName, err))
+			self._file = None
+
+	#
+	# Renames capture.bin -> capture.bin.1 -> capture.bin.2 ... and starts a new file
+	#
+	def _rotate(self):
+		self._close()
+		for i in range(self.files-1, 0, -1):
+			src = self.fileName if i == 1 else "{0}.{1}".format(self.fileName, i-1)
+			if os.path.isfile(src):
+				os.replace(src, "{0}.{1}".format(self.fileName, i))
+		self._open()
+
+#
+# Yields (direction, timestamp, data) for each record in a capture file
+#
+def read_capture(fileName):
+	with open(fileName, "rb") as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise ValueError("'{0}' is not a SMuFF capture file".format(fileName))
+		while True:
+			header = f.read(RECORD.size)
+			if len(header) < RECORD.size:
+				break
+			direction, timestamp, length = RECORD.unpack(header)
+			data = f.read(length)
+			if len(data) < length:
+				break
+			yield direction, timestamp, data
+
+#
+# Feeds the received data of a capture file into the parser of a SmuffCore instance.
+# With realtime set, the original timing between the lines is kept, otherwise
+# the lines are parsed as fast as possible. Returns (lines, elapsed seconds).
+#
+def replay(fileName, core, realtime=False):
+	lines = 0
+	firstTs = None
+	start = time.monotonic()
+	for direction, timestamp, data in read_capture(fileName):
+		if firstTs == None:
+			firstTs = timestamp
+		if direction != DIR_RX:
+			continue
+		if realtime:
+			delay = (timestamp - firstTs) - (time.monotonic() - start)
+			if delay > 0:
+				time.sleep(delay)
+		core._parse_serial_data(data.decode("ascii", errors="ignore"))
+		lines += 1
+	return lines, time.monotonic() - start
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Replay a SMuFF serial capture file")
+	parser.add_argument("capture", help="capture file to replay")
+	parser.add_argument("--max", action="store_true", help="replay as fast as possible instead of real time")
+	parser.add_argument("--dump", action="store_true", help="only print the records")
+	args = parser.parse_args(argv)
+
+	if args.dump:
+		for direction, timestamp, data in read_capture(args.capture):
+			print("{0:12.3f} {1} {2}".format(timestamp, "<" if direction == DIR_RX else ">", data.rstrip(b"\n")))
+		return 0
+
+	logging.basicConfig(level=logging.WARNING)
+	core = smuff_core.SmuffCore(logging.getLogger("SMuFF.replay"), False, None, None)
+	lines, elapsed = replay(args.capture, core, realtime=not args.max)
+	core.isConnected = True
+	print("Replayed {0} lines in {1:.3f} secs. ({2:.0f} lines/s)".format(lines, elapsed, lines/elapsed if elapsed > 0 else 0))
+	print(core.get_states())
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
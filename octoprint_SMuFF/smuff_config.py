@@ -0,0 +1,241 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF configuration model
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Holds the configuration the SMuFF reports via M503 (JSON format), one
+# compact record per tool plus the basic, stepper and TMC driver settings.
+# A category only gets parsed and validated if its JSON differs from the
+# one received last time.
+#
+# Benchmark:
+#	python -m octoprint_SMuFF.smuff_config [--tools 12 24 48] [--runs 2000]
+
+import argparse
+import json
+import sys
+import time
+
+# Keywords sent by the SMuFF as JSON config header (same as smuff_core.C_*)
+C_BASIC 		= "basic"
+C_STEPPERS 		= "steppers"
+C_TMC 			= "tmc driver"
+C_MATERIALS 	= "materials"
+C_SWAPS 		= "tool swaps"
+C_SERVOMAPS 	= "servo mapping"
+C_FEEDSTATE 	= "feed state"
+PER_TOOL 		= ( C_MATERIALS, C_SWAPS, C_SERVOMAPS, C_FEEDSTATE )
+
+class ConfigError(Exception):
+	pass
+
+#
+# Configuration of a single tool
+#
+class ToolConfig():
+	__slots__ = ("material", "color", "pfactor", "swap", "servoClose", "feedState")
+
+	def __init__(self):
+		self.material 	= None		# material name (i.e. "PLA")
+		self.color 		= None		# color name (i.e. "Red")
+		self.pfactor 	= 100 		# purge factor in percent
+		self.swap 		= None		# tray the tool is swapped to
+		self.servoClose	= None		# lid servo closed position (in deg.)
+		self.feedState	= None		# feed state reported by the SMuFF
+
+	def as_dict(self):
+		return { slot: getattr(self, slot) for slot in self.__slots__ }
+
+class SmuffConfig():
+
+	def __init__(self):
+		self._raw 		= {}		# last JSON string received per category
+		self.basic 		= {}		# basic settings (Device, Tools, UseCutter, ...)
+		self.steppers 	= {}		# settings per stepper (Selector, Revolver, Feeder, ...)
+		self.tmc 		= {}		# TMC driver settings per stepper
+		self.tools 		= []		# ToolConfig per tool
+		self.version 	= 0 		# incremented with each change of any category
+		self._parsers 	= {
+			C_BASIC: 		self._parse_basic,
+			C_STEPPERS: 	self._parse_steppers,
+			C_TMC: 			self._parse_tmc,
+			C_MATERIALS: 	self._parse_materials,
+			C_SWAPS: 		self._parse_swaps,
+			C_SERVOMAPS: 	self._parse_servomaps,
+			C_FEEDSTATE: 	self._parse_feedstate
+		}
+
+	@property
+	def toolCount(self):
+		return len(self.tools)
+
+	#
+	# Parses the JSON string of a category. Returns True if the category has
+	# changed, False if it's the same as last time. Raises ConfigError on
+	# invalid data (in which case the current configuration stays untouched).
+	#
+	def update(self, category, data):
+		if self._raw.get(category) == data:
+			return False
+		parser = self._parsers.get(category)
+		if parser == None:
+			raise ConfigError("Unknown configuration category '{0}'".format(category))
+		try:
+			cfg = json.loads(data)
+		except ValueError as err:
+			raise ConfigError("Invalid JSON for category '{0}': {1}".format(category, err))
+		if not isinstance(cfg, dict):
+			raise ConfigError("Category '{0}' isn't a JSON object".format(category))
+		parser(cfg)
+		self._raw[category] = data
+		self.version += 1
+		return True
+
+	#
+	# Returns the JSON strings last received per category
+	#
+	def get_raw(self):
+		return dict(self._raw)
+
+	def invalidate(self, category=None):
+		if category == None:
+			self._raw = {}
+		else:
+			self._raw.pop(category, None)
+
+	def _parse_basic(self, cfg):
+		for key in ("Device", "Tools"):
+			if not key in cfg:
+				raise ConfigError("Basic configuration is missing '{0}'".format(key))
+		tools = cfg["Tools"]
+		if not isinstance(tools, int) or tools < 0:
+			raise ConfigError("Invalid number of tools: {0}".format(tools))
+		self.basic = cfg
+		if tools != len(self.tools):
+			self.tools = self.tools[:tools] + [ ToolConfig() for _ in range(tools - len(self.tools)) ]
+			# the per tool categories have to be parsed again for the new number of tools
+			for category in PER_TOOL:
+				self._raw.pop(category, None)
+
+	def _parse_steppers(self, cfg):
+		self.steppers = self._objects(cfg, C_STEPPERS)
+
+	def _parse_tmc(self, cfg):
+		self.tmc = self._objects(cfg, C_TMC)
+
+	def _parse_materials(self, cfg):
+		values = [ (v["Material"], v["Color"], v["PFactor"]) for v in self._per_tool(cfg, C_MATERIALS) ]
+		for tool, (material, color, pfactor) in zip(self.tools, values):
+			tool.material 	= material
+			tool.color 		= color
+			tool.pfactor 	= pfactor
+
+	def _parse_swaps(self, cfg):
+		for tool, value in zip(self.tools, self._per_tool(cfg, C_SWAPS)):
+			tool.swap = value
+
+	def _parse_servomaps(self, cfg):
+		values = [ v["Close"] for v in self._per_tool(cfg, C_SERVOMAPS) ]
+		for tool, value in zip(self.tools, values):
+			tool.servoClose = value
+
+	def _parse_feedstate(self, cfg):
+		for tool, value in zip(self.tools, self._per_tool(cfg, C_FEEDSTATE)):
+			tool.feedState = value
+
+	#
+	# Returns the values of "T0".."Tn" (validated against the number of tools)
+	#
+	def _per_tool(self, cfg, category):
+		try:
+			return [ cfg["T"+str(i)] for i in range(len(self.tools)) ]
+		except KeyError as err:
+			raise ConfigError("Category '{0}' is missing tool {1}".format(category, err))
+		except TypeError as err:
+			raise ConfigError("Category '{0}' has invalid values: {1}".format(category, err))
+
+	#
+	# Returns a category consisting of named objects (i.e. one per stepper)
+	#
+	def _objects(self, cfg, category):
+		for name, values in cfg.items():
+			if not isinstance(values, dict):
+				raise ConfigError("Category '{0}' has no settings for '{1}'".format(category, name))
+		return cfg
+
+	#
+	# Returns the current value of a parameter or None if it's unknown.
+	# Parameters of the stepper / TMC categories are addressed as "Stepper.Name"
+	# (i.e. "Feeder.MaxSpeed"), all others by their name (i.e. "BowdenLen").
+	#
+	def find(self, name):
+		if name in self.basic:
+			return self.basic[name]
+		group, sep, key = name.partition(".")
+		if sep:
+			for category in (self.steppers, self.tmc):
+				values = category.get(group)
+				if values != None and key in values:
+					return values[key]
+		return None
+
+	#
+	# Legacy representation as used by smuff_core
+	#
+	def get_materials(self):
+		return [ [ t.material, t.color, t.pfactor ] for t in self.tools ]
+
+	def get_swaps(self):
+		return [ t.swap for t in self.tools ]
+
+	def get_servo_maps(self):
+		return [ t.servoClose for t in self.tools ]
+
+	def get_feed_states(self):
+		return [ t.feedState for t in self.tools ]
+
+#------------------------------------------------------------------------------
+# Benchmark
+#------------------------------------------------------------------------------
+
+def _bench_json(tools, seed=0):
+	materials = { "T{0}".format(i): { "Material": "PLA", "Color": "Color{0}".format((i+seed) % 7), "PFactor": 100+i, "Name": "Spool {0}".format(i) } for i in range(tools) }
+	steppers = { name: { "Steps": 400+seed, "Speed": 10, "Accel": 2000, "Invert": False } for name in ("Selector", "Revolver", "Feeder") }
+	return {
+		C_BASIC: 		json.dumps({ "Device": "SMuFF", "Tools": tools, "UseCutter": True, "UseSplitter": False, "UseDDE": False }),
+		C_STEPPERS: 	json.dumps(steppers),
+		C_TMC: 			json.dumps(steppers),
+		C_MATERIALS: 	json.dumps(materials),
+		C_SWAPS: 		json.dumps({ "T{0}".format(i): (i+seed) % tools for i in range(tools) }),
+		C_SERVOMAPS: 	json.dumps({ "T{0}".format(i): { "Close": 90+i } for i in range(tools) }),
+		C_FEEDSTATE: 	json.dumps({ "T{0}".format(i): i % 3 for i in range(tools) })
+	}
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark parsing the SMuFF M503 configuration")
+	parser.add_argument("--tools", type=int, nargs="+", default=[ 12, 24, 48 ])
+	parser.add_argument("--runs", type=int, default=2000)
+	args = parser.parse_args(argv)
+
+	for tools in args.tools:
+		variants = [ _bench_json(tools, seed) for seed in (0, 1) ]
+		config = SmuffConfig()
+		start = time.perf_counter()
+		for run in range(args.runs):
+			for category, data in variants[run % 2].items():
+				config.update(category, data)
+		changed = (time.perf_counter() - start) / args.runs * 1e6
+		start = time.perf_counter()
+		for run in range(args.runs):
+			for category, data in variants[1].items():
+				config.update(category, data)
+		unchanged = (time.perf_counter() - start) / args.runs * 1e6
+		print("{0:3d} tools: {1:8.1f} us per full config (changed), {2:6.1f} us (unchanged)".format(tools, changed, unchanged))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,260 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF filament consumption
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Accounts the filament extruded per SMuFF tool by following the E moves
+# sent to the printer (absolute / relative extrusion and G92 resets).
+# Each tool has a spool with an optional length, so it's known how much
+# is left on it. Only the handful of GCodes that move the extruder get
+# looked at, everything else costs a single dictionary lookup.
+#
+# Benchmark:
+#	python -m octoprint_SMuFF.smuff_consumption [--lines 1000000]
+
+from threading import Lock
+
+import argparse
+import json
+import os
+import sys
+import time
+
+DEF_WARN_LENGTH = 5000.0 				# warn if less than this (in mm) is left on a spool
+CHECK_EVERY 	= 100.0 				# check the spool after this many mm extruded
+
+#
+# Returns the value of the E parameter of a GCode line (None if there's none)
+#
+def _e_value(cmd):
+	i = cmd.find("E", 1)
+	if i < 0:
+		return None
+	j = cmd.find(" ", i)
+	try:
+		return float(cmd[i+1:j] if j > 0 else cmd[i+1:])
+	except ValueError:
+		return None
+
+class FilamentCounter():
+
+	def __init__(self, logger, fileName=None):
+		self._log 		= logger
+		self._fileName 	= fileName		# file the totals are persisted in
+		self._lock 		= Lock()
+		self.tools 		= {}			# "A:0" -> dict(total, spool, used, length, warned)
+		self.tool 		= None			# key of the tool currently loaded
+		self.warnLength = DEF_WARN_LENGTH
+		self.warnCB 	= None 			# called with (tool key, mm left) when a spool runs low
+		self.changeCB 	= None 			# called with (instance, slot, mm left) when the usage of a spool has been booked
+		self._relative 	= False			# relative extrusion (M83 / G91)
+		self._lastE 	= 0.0 			# last absolute E position
+		self._used 		= 0.0 			# extruded since the last flush
+		self._nextCheck	= CHECK_EVERY
+		self._handlers 	= {
+			"G0": 	self._move,
+			"G1": 	self._move,
+			"G2": 	self._move,
+			"G3": 	self._move,
+			"G92": 	self._reset,
+			"M82": 	self._absolute,
+			"M83": 	self._relative_mode,
+			"G90": 	self._absolute,
+			"G91": 	self._relative_mode
+		}
+		self.load()
+
+	#
+	# Called for each GCode sent to the printer
+	#
+	def feed(self, gcode, cmd):
+		handler = self._handlers.get(gcode)
+		if handler != None:
+			handler(cmd)
+
+	def _move(self, cmd):
+		e = _e_value(cmd)
+		if e == None:
+			return
+		if self._relative:
+			self._used += e
+		else:
+			self._used += e - self._lastE
+			self._lastE = e
+		if self._used >= self._nextCheck:
+			self._check()
+
+	def _reset(self, cmd):
+		e = _e_value(cmd)
+		if e != None:
+			self._lastE = e
+		elif cmd.strip() == "G92":
+			self._lastE = 0.0
+
+	def _absolute(self, cmd):
+		self._relative = False
+
+	def _relative_mode(self, cmd):
+		self._relative = True
+
+	def _get_tool(self, key):
+		tool = self.tools.get(key)
+		if tool == None:
+			tool = dict(total=0.0, spool=None, used=0.0, length=None, warned=False)
+			self.tools[key] = tool
+		return tool
+
+	#
+	# Books the filament extruded so far on the current tool
+	#
+	def flush(self):
+		with self._lock:
+			used = self._used
+			self._used = 0.0
+			self._nextCheck = CHECK_EVERY
+			if self.tool == None or used == 0:
+				return
+			tool = self._get_tool(self.tool)
+			tool["total"] += used
+			tool["used"] += used
+			key = self.tool
+		self._changed(key)
+
+	#
+	# Called after a tool change
+	#
+	def set_tool(self, inst, slot):
+		self.flush()
+		with self._lock:
+			self.tool = "{0}:{1}".format(inst, slot)
+		self._check()
+
+	#
+	# Registers a new spool on a tool (length in mm, None if unknown)
+	#
+	def set_spool(self, inst, slot, spool=None, length=None):
+		with self._lock:
+			tool = self._get_tool("{0}:{1}".format(inst, slot))
+			tool["spool"] 	= spool
+			tool["length"] 	= float(length) if length != None else None
+			tool["used"] 	= 0.0
+			tool["warned"] 	= False
+		self._changed("{0}:{1}".format(inst, slot))
+		self.save()
+
+	#
+	# Returns the length (in mm) left on the spool of a tool or None if unknown
+	#
+	def remaining(self, inst, slot):
+		key = "{0}:{1}".format(inst, slot)
+		with self._lock:
+			tool = self.tools.get(key)
+			if tool == None or tool["length"] == None:
+				return None
+			used = tool["used"] + (self._used if key == self.tool else 0.0)
+			return tool["length"] - used
+
+	def _changed(self, key):
+		if self.changeCB:
+			inst, _, slot = key.partition(":")
+			self.changeCB(inst, int(slot), self.remaining(inst, int(slot)))
+
+	def _check(self):
+		self._nextCheck = self._used + CHECK_EVERY
+		if self.tool == None:
+			return
+		inst, _, slot = self.tool.partition(":")
+		left = self.remaining(inst, int(slot))
+		if left == None or left > self.warnLength:
+			return
+		with self._lock:
+			tool = self._get_tool(self.tool)
+			if tool["warned"]:
+				return
+			tool["warned"] = True
+		self._log.warning("Spool on tool {0} is running low, {1:.0f} mm left".format(self.tool, left))
+		if self.warnCB:
+			self.warnCB(self.tool, left)
+
+	def get_stats(self):
+		self.flush()
+		with self._lock:
+			return { key: dict(tool) for key, tool in self.tools.items() }
+
+	def load(self):
+		if not self._fileName or not os.path.isfile(self._fileName):
+			return
+		try:
+			with open(self._fileName, "r") as f:
+				data = json.load(f)
+			with self._lock:
+				self.tools = data
+		except Exception as err:
+			self._log.error("Can't load filament consumption from '{0}':\n\t{1}".format(self._fileName, err))
+
+	#
+	# Persists the totals (write to a temp. file first, then replace the old one)
+	#
+	def save(self):
+		if not self._fileName:
+			return
+		self.flush()
+		with self._lock:
+			data = json.dumps(self.tools)
+		try:
+			tmpName = self._fileName + ".tmp"
+			with open(tmpName, "w") as f:
+				f.write(data)
+			os.replace(tmpName, self._fileName)
+		except Exception as err:
+			self._log.error("Can't save filament consumption to '{0}':\n\t{1}".format(self._fileName, err))
+
+#------------------------------------------------------------------------------
+# Benchmark
+#------------------------------------------------------------------------------
+
+def _bench_lines():
+	lines = []
+	e = 0.0
+	for i in range(1000):
+		e += 0.05
+		lines.append(("G1", "G1 X{0:.3f} Y{1:.3f} E{2:.5f}".format(i*0.1, i*0.2, e)))
+		lines.append(("G0", "G0 X{0:.3f} Y{1:.3f} F9000".format(i*0.1, i*0.2)))
+		if i % 10 == 0:
+			lines.append(("M106", "M106 S255"))
+		if i % 100 == 0:
+			lines.append(("G92", "G92 E0"))
+			e = 0.0
+	return lines
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the per line overhead of the filament consumption tracking")
+	parser.add_argument("--lines", type=int, default=1000000)
+	args = parser.parse_args(argv)
+
+	import logging
+	lines = _bench_lines()
+	counter = FilamentCounter(logging.getLogger("SMuFF.bench"))
+	counter.set_tool("A", 0)
+	runs = max(1, args.lines // len(lines))
+	start = time.perf_counter()
+	for _ in range(runs):
+		for line in lines:
+			pass
+	base = time.perf_counter() - start
+	start = time.perf_counter()
+	for _ in range(runs):
+		for gcode, cmd in lines:
+			counter.feed(gcode, cmd)
+	elapsed = time.perf_counter() - start - base
+	total = runs * len(lines)
+	counter.flush()
+	print("{0} lines: {1:.3f} us per line, {2:.1f} mm extruded".format(total, elapsed / total * 1e6, counter.tools["A:0"]["total"]))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
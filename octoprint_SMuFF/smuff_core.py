@@ -1,13 +1,16 @@
-from threading import Thread, Event
-from pprint import pformat
+from threading import Thread, Event, Condition, Lock
 
-import json
 import re
 import time
 import sys
 import traceback
 import logging
 
+from . import smuff_config
+from . import smuff_history
+from . import smuff_broker
+from . import smuff_response
+
 try:
     import serial
 except ImportError:
@@ -29,6 +32,7 @@ LIDCLOSE		= "M280 R1"				# SMuFF GCode to close lid servo
 TOOL			= "T"					# SMuFF GCode to swap tools
 HOME 			= "G28"					# SMuFF GCode for homing
 GETCONFIG 		= "M503 S{0}W"			# SMuFF Gcode to query configuration settings (in JSON format)
+GETCONFIG_ALL	= "M503 W"				# SMuFF Gcode to query all configuration settings (in JSON format)
 SETPARAM 		= "M205 P\"{0}\"S{1}"	# SMuFF GCode for setting config params
 LOADFIL			= "M700"				# SMuFF GCode to load active tool
 UNLOADFIL		= "M701"				# SMuFF GCode to unload active tool
@@ -188,6 +192,44 @@ ACTION_ABORT	= "ABORT"
 ACTION_PING		= "PING"
 ACTION_PONG		= "PONG"
 
+# Periodical states reporting modes (see set_states_mode)
+STATES_FAST		= "fast"				# during tool changes / loads
+STATES_SLOW		= "slow"				# idle, but someone's watching (or printing)
+STATES_OFF		= "off"					# idle and nobody's watching
+WD_MARGIN		= 3.0 					# time (in seconds) the watchdog allows for late states on top of two intervals
+
+# Direction of the serial traffic handed to the recorder
+CAP_RX			= 0
+CAP_TX			= 1
+
+# Time to live (in seconds) of cached query results
+QUERY_TTL		= {
+	FWINFO: 		3600,
+	CFG_BASIC: 		600,
+	CFG_MATERIALS:	300,
+	CFG_SWAPS: 		300,
+	CFG_SERVOMAPS: 	300,
+	CFG_STEPPERS: 	600,
+	CFG_TMC: 		600,
+	CFG_FEEDSTATE:	5
+}
+DEF_QUERY_TTL	= 60
+
+# Log categories (passed as 'extra' so that chatty categories can be sampled)
+LOG_SERIAL		= { "smuffCat": "serial" }	# raw data / responses, one record per line
+LOG_CMD			= { "smuffCat": "cmd" }		# commands sent and their results
+
+# Signals handed over to the signal callback (besides WAIT, CONTINUE and ABORT)
+SIG_JAM			= "JAM"
+SIG_JAM_CLEARED	= "JAM_CLEARED"
+
+# Connection states (as reported by connect_SMuFF_async)
+CONN_IDLE		= "idle"
+CONN_PENDING	= "connecting"
+CONN_READY		= "ready"
+CONN_FAILED		= "failed"
+CONN_TIMEOUT	= 10.0 					# time (in seconds) the SMuFF has to answer after the port has been opened
+
 # Klipper printer states
 ST_IDLE			= "Idle"
 ST_PRINTING		= "Printing"
@@ -270,23 +312,49 @@ class SmuffCore():
 		self.feedStates			= [] 		# One dimensional array the feed state for each tool
 		self.relay 				= None 		# state of the relay E(xternal) or I(nternal)
 		self.isJammed 			= False 	# flag set when feeder is jammed
+		self.config 			= smuff_config.SmuffConfig()	# configuration as reported by M503
+		self.history 			= smuff_history.StateHistory()	# the last periodical states
+		self.broker 			= smuff_broker.CommandBroker()	# serializes the callers of send_SMuFF_and_wait
+		self.cacheHits 			= 0 		# number of queries answered from the cache
+		self.cacheMisses 		= 0 		# number of queries sent to the SMuFF
+		self.cacheShared 		= 0 		# number of queries that joined a query already in flight
+		self._cache 			= {}		# query key -> (expiry time, result)
+		self._inflight 			= {}		# query key -> [ Event, result ] of queries in flight
+		self._cacheLock 		= Lock()
+		self._cacheGen 			= 0 		# incremented on each invalidation
+		self.connState 			= CONN_IDLE	# state of the (background) connect
+		self.connDuration		= 0.0		# time it took to connect to the SMuFF (in seconds)
+		self.latency 			= None		# AdaptiveTimeouts instance (if adaptive timeouts are being used)
+		self.deviceState 		= None		# DeviceState instance (if the state is being persisted)
+		self.signalCB 			= None		# callback(instance, signal, received) for WAIT/CONTINUE/ABORT/JAM signals
+		self.statesMode 		= STATES_FAST	# current periodical states reporting mode
+		self.statesIdle 		= STATES_FAST	# mode to switch to when the SMuFF has nothing to do
+		self.statesIntervals	= { STATES_FAST: 1, STATES_SLOW: 5, STATES_OFF: 0 }	# M155 intervals (in seconds) per mode
+		self._statesSince 		= time.monotonic()	# time the current states mode has been set
+		self._statesStats 		= {}		# time, lines, bytes and CPU time spent per states mode
+		self._statesChange 		= False 	# set while a M155 rate change is being sent
+		self.recorder 			= None		# SerialRecorder instance (if the serial traffic is being captured)
 
 		self._serial			= None      # serial instance
 		self._lastSerialEvent	= 0 		# last time (in millis) a serial receive took place
-		self._response			= None		# the response string from SMuFF
+		self._response			= None		# the last response completed (Response record)
 		self._isReconnect 	    = False		# set when trying to re-establish serial connection
 		self._autoLoad          = True      # set to load new filament automatically after swapping tools
 		self._serEvent			= Event()	# event raised when a valid response has been received
 		self._serWdEvent		= Event()	# event raised when status data has been received
-		self._lastResponse     	= []		# last response SMuFF has sent (multiline)
+		self._ackCond 			= Condition()	# notified on each response to a pipelined command
+		self._pipeAcks 			= None		# results of pipelined commands (ok/error) while pipelining
+		self._lastResponse     	= smuff_response.Response()	# response being received (lines before the "ok")
 		self._stopSerial 		= False		# flag set when the serial reader / connector / watchdog need to be discarded
 		if self._serial:					# pySerial instance
 			self.close_serial()
 		self._sreader 			= None		# serial reader thread instance
 		self._sconnector		= None		# serial connector thread instance
 		self._swatchdog			= None		# serial watchdog thread instance
+		self._sconnect			= None		# background connect thread instance
 		self._jsonCat 			= None		# category of the last JSON string received
 		self._stCount 			= 0 		# counter for states recevied
+		self.statesStale 		= False 	# no states received since they've been turned off
 		self._tcStartTime 		= 0			# time for tool change duration measurement
 		self._initStartTime		= 0			# time for _init_SMuFF timeout checking
 		self._okTimer 			= None		# (reactor) timer waiting for OK response
@@ -340,9 +408,17 @@ class SmuffCore():
 	def set_tool(self):
 		self.preTool = self.curTool
 		self.curTool = self.pendingTool
+		self._save_state()
+
+	#
+	# Persists the device state (if it has changed)
+	#
+	def _save_state(self):
+		if self.deviceState:
+			self.deviceState.update(self)
 
 	def get_active_tool(self):
-		return self._parse_tool_number(self.curTool)
+		return self.parse_tool_number(self.curTool)
 
 	#
 	# Async basic init
@@ -353,26 +429,30 @@ class SmuffCore():
 		if self._initState == 1:
 			# query some basic configuration settings
 			if self.isProcessing == False:
-				self.send_SMuFF(GETCONFIG.format(CFG_BASIC))
+				self._send_if_idle(GETCONFIG.format(CFG_BASIC))
 		elif self._initState == 2:
 			# query materials configuration
 			if self.isProcessing == False:
-				self.send_SMuFF(GETCONFIG.format(CFG_MATERIALS))
+				self._send_if_idle(GETCONFIG.format(CFG_MATERIALS))
 		elif self._initState == 3:
 			# request firmware info from SMuFF
 			if self.isProcessing == False:
-				self.send_SMuFF(FWINFO)
+				self._send_if_idle(FWINFO)
 		elif self._initState == 4:
 			# query tool swap configuration settings
 			if self.isProcessing == False:
-				self.send_SMuFF(GETCONFIG.format(CFG_SWAPS))
+				self._send_if_idle(GETCONFIG.format(CFG_SWAPS))
 		elif self._initState == 5:
 			# query some lid servo mapping settings
 			if self.isProcessing == False:
-				self.send_SMuFF(GETCONFIG.format(CFG_SERVOMAPS))
+				self._send_if_idle(GETCONFIG.format(CFG_SERVOMAPS))
 		elif self._initState == 6:
 			self._log.info("_async_init done")
 			self._initState = 0
+			# the reader thread mustn't wait for the M155 response, hence let another thread apply the idle mode
+			idle = Thread(target=self.apply_idle_states, name="TStatesMode")
+			idle.daemon = True
+			idle.start()
 		else:
 			self._initState = 0
 
@@ -394,6 +474,63 @@ class SmuffCore():
 			self._log.error("Connecting to SMuFF has thrown an exception:\n\t{0}".format(err))
 		return False
 
+	#
+	# Connects to the SMuFF in a separate thread, so that neither the caller nor
+	# any other SMuFF instance has to wait for a missing or hung device.
+	# The readyCallback gets called with (instance, success, duration) when done.
+	#
+	def connect_SMuFF_async(self, readyCallback=None):
+		if self._sconnect and self._sconnect.is_alive():
+			self._log.info("Background connect to {0} already running".format(self.serialPort))
+			return False
+		self.connState = CONN_PENDING
+		try:
+			self._sconnect = Thread(target=self._async_connector, args=(readyCallback,), name="TConnect")
+			self._sconnect.daemon = True
+			self._sconnect.start()
+			self._log.info("Background connect thread running... ({0})".format(self._sconnect))
+			return True
+		except:
+			exc_type, exc_value, exc_traceback = sys.exc_info()
+			tb = traceback.format_exception(exc_type, exc_value, exc_traceback)
+			self._log.error("Unable to start background connect thread: ".join(tb))
+			self.connState = CONN_FAILED
+		return False
+
+	#
+	# Background connect thread
+	#
+	def _async_connector(self, readyCallback):
+		startTime = self._nowMS()
+		stCount = self._stCount
+		success = self.connect_SMuFF()
+		if success:
+			# an open port doesn't mean the SMuFF is alive, it has to answer the init sequence
+			success = self._wait_alive(stCount, CONN_TIMEOUT)
+			if not success:
+				self._log.error("SMuFF on {0} hasn't answered within {1} secs., it might be hung".format(self.serialPort, CONN_TIMEOUT))
+		self.connDuration = (self._nowMS() - startTime)/1000
+		self.connState = CONN_READY if success else CONN_FAILED
+		self._log.info("Background connect to {0} {1} after {2:4.2f} secs.".format(self.serialPort, "succeeded" if success else "failed", self.connDuration))
+		self._sconnect = None
+		if not readyCallback == None:
+			try:
+				readyCallback(self, success, self.connDuration)
+			except Exception as err:
+				self._log.error("Connect callback has thrown an exception:\n\t{0}".format(err))
+
+	#
+	# Waits for the first sign of life from the SMuFF after _init_SMuFF, i.e. the
+	# response to M155 (init sequence started) or a states line
+	#
+	def _wait_alive(self, stCount, timeout):
+		endTime = time.monotonic() + timeout
+		while time.monotonic() < endTime:
+			if self._stCount != stCount or self._initState > 0:
+				return True
+			time.sleep(0.05)
+		return False
+
 	#
 	# Opens the serial port for the communication with the SMuFF
 	#
@@ -497,9 +634,13 @@ class SmuffCore():
 						try:
 							ln = self._serial.readline() 	# read to EOL
 							if ln:
+								if self.recorder:
+									self.recorder.record(CAP_RX, ln)
 								data = ln.decode("ascii", errors='ignore')
 								if data: 					# don't parse empty strings
+									cpuStart = time.thread_time()
 									self._parse_serial_data(data)
+									self._account_states_line(len(ln), time.thread_time() - cpuStart)
 								else:
 									self._log.error("No valid data received: [{0}]".format(data))
 							else:
@@ -589,6 +730,9 @@ class SmuffCore():
 			is_set = self._serWdEvent.wait(self.wdTimeout)
 			if self._stopSerial:
 				break
+			if is_set == False and self.statesMode == STATES_OFF and self._check_alive():
+				# no periodical states expected, but the SMuFF has answered
+				continue
 			if is_set == False:
 				self._log.info("Serial watchdog timed out... (no sign of life within {0} sec.)".format(self.wdTimeout))
 				reconnect = Thread(target=self.reconnect_SMuFF, name="TReconnect")
@@ -598,6 +742,17 @@ class SmuffCore():
 
 		self._log.info("Shutting down serial watchdog")
 
+	#
+	# Liveness check while the periodical states are turned off (called from the watchdog)
+	#
+	def _check_alive(self):
+		try:
+			with self.broker.access(FWINFO, timeout=0):
+				return self._send_and_wait(FWINFO).ok
+		except smuff_broker.BrokerTimeout:
+			# someone else is talking to the SMuFF right now, that one will notice
+			return True
+
     #
 	# Tries to reconnect serial port to SMuFF
     #
@@ -617,11 +772,21 @@ class SmuffCore():
 			if self._serial.is_open:
 				self._init_SMuFF()
 
+	#
+	# Sends data to SMuFF from within the serial reader thread, which must never
+	# wait for the broker (it would wait for itself). Skipped if the SMuFF is in use.
+	#
+	def _send_if_idle(self, data):
+		try:
+			with self.broker.access(data, timeout=0):
+				return self.send_SMuFF(data)
+		except smuff_broker.BrokerTimeout:
+			return False
 
     #
-	# Sends data to SMuFF
+	# Sends data to SMuFF, the lines received up to the "ok" go into the response given
     #
-	def send_SMuFF(self, data):
+	def send_SMuFF(self, data, response=None):
 		self._set_busy(False)		# reset busy and
 		self._set_error(False)		# error flags
 
@@ -636,25 +801,86 @@ class SmuffCore():
 			# don't log RESET
 			self._lastCmdSent = None
 
+		self._lastResponse = response if response != None else smuff_response.Response(data)
+		return self._write_serial(data)
+
+	#
+	# Writes a single GCode line to the serial port
+	#
+	def _write_serial(self, data):
 		if self._serial and self._serial.is_open:
 			try:
-				b = bytearray(len(data)+2)
 				b = "{0}\n".format(data).encode("ascii")
 				n = self._serial.write(b)
+				if self.recorder:
+					self.recorder.record(CAP_TX, b)
 				if self.dumpRawData:
-					self._log.info("Sent {1} bytes: [{0}]".format(b, n))
+					self._log.info("Sent %s bytes: [%s]", n, b, extra=LOG_SERIAL)
 				return True
 			except (OSError, serial.SerialException) as err:
-				self._log.error("Unable to send command '{0}:\n\t' to SMuFF".format(data, err))
+				self._log.error("Unable to send command '{0}':\n\t{1} to SMuFF".format(data, err))
 				return False
 		else:
 			self._log.error("Serial port is closed, can't send data")
 			return False
 
+	#
+	# Sends a list of GCodes without waiting for each single response, keeping at most
+	# 'window' commands in flight. Returns True (ok), False (error) or None (no response
+	# in time) for each GCode.
+	#
+	def send_SMuFF_pipelined(self, lines, window=4, timeout=None):
+		with self.broker.access("{0} pipelined command(s)".format(len(lines))):
+			return self._send_pipelined(lines, window, timeout)
+
+	def _send_pipelined(self, lines, window, timeout):
+		if timeout == None:
+			timeout = self.cmdTimeout
+		acks = []
+		with self._ackCond:
+			self._pipeAcks = acks
+		self._set_error(False)
+		self._set_processing(True)
+		sent = 0
+		try:
+			while len(acks) < len(lines):
+				while sent < len(lines) and sent - len(acks) < window:
+					if not self._write_serial(lines[sent]):
+						break
+					sent += 1
+				with self._ackCond:
+					if len(acks) >= sent:
+						break	# nothing in flight, writing has failed
+					if len(acks) < sent and not self._ackCond.wait(timeout):
+						self._log.error("Timed out while waiting for {0} pipelined response(s)".format(sent - len(acks)))
+						break
+		finally:
+			with self._ackCond:
+				self._pipeAcks = None
+			self._set_processing(False)
+		return acks + [ None ] * (len(lines) - len(acks))
+
     #
-	# Sends data to SMuFF and will wait for a response (which in most cases is 'ok')
+	# Sends data to SMuFF and will wait for a response (which in most cases is 'ok').
+	# Returns the lines received ("" on error, None on timeout).
+	# Concurrent callers get serialized by the broker, first come first served.
     #
 	def send_SMuFF_and_wait(self, data):
+		response = self.send_SMuFF_request(data)
+		if response.status == smuff_response.RS_OK:
+			return response.text
+		return "" if response.status == smuff_response.RS_ERROR else None
+
+	#
+	# Same as above, but returns the Response record (status, lines, duration).
+	# If timeout is given, BrokerTimeout is raised if the SMuFF hasn't become
+	# available within that time.
+	#
+	def send_SMuFF_request(self, data, timeout=None):
+		with self.broker.access(data, timeout):
+			return self._send_and_wait(data)
+
+	def _send_and_wait(self, data):
 
 		if data.startswith(TOOL):
 			timeout = self.tcTimeout 	# wait max. 90 seconds for a response while swapping tools
@@ -662,46 +888,227 @@ class SmuffCore():
 		else:
 			timeout = self.cmdTimeout	# wait max. 25 seconds for other operations
 			tmName = "command"
-		self.wdTimeout = timeout
-		done = False
-		result = None
-
-		if self.send_SMuFF(data) == False:
+		# the watchdog keeps the static timeout, an adaptive one might be shorter than the states interval
+		self.wdTimeout = max(timeout, 2 * self.statesIntervals[self.statesMode] + WD_MARGIN)
+		cmdClass = None
+		if self.latency:
+			# shorten the timeout according to the latencies observed so far
+			cmdClass = self.latency.get_class(data)
+			timeout = self.latency.get_timeout(cmdClass, timeout)
+		response = smuff_response.Response(data)
+
+		if self.send_SMuFF(data, response) == False:
 			self._log.error("Failed to send command to SMuFF, aborting 'send_SMuFF_and_wait'")
-			return None
+			response.finish(smuff_response.RS_FAILED)
+			return response
 		self._set_processing(True)	# SMuFF is currently doing something
 
-		while not done:
+		while not response.done:
 			self._serEvent.clear()
+			if response.done:
+				break
 			is_set = self._serEvent.wait(timeout)
+			if response.done:
+				break
 			if is_set == True:
-				self._log.info("To [{0}] SMuFF says [{1}]  {2}".format(data, self._response, "(Error reported)" if self.isError else "(Ok)"))
-				result = self._response
-				if self._response == None or self.isError:
-					done = True
-				elif not self._response.startswith(R_ECHO):
-					done = True
-
-				self._response = None
+				# woken up w/o a response (i.e. the SMuFF has restarted or the serial port has failed)
+				response.finish(smuff_response.RS_FAILED)
 			else:
 				resp = "*** Timed out *** while waiting for a response on cmd '{0}'. Try increasing the {1} timeout (={2} sec.).".format(data, tmName, timeout)
 				if not self._responseCB == None:
 					self._responseCB(resp)
 				self._log.info(resp)
 				if self.isBusy == False:
-					done = True
-					self._set_processing(False)
+					response.finish(smuff_response.RS_TIMEOUT)
+		self._log.info("To [%s] SMuFF says [%s]  (%s)", data, response.text, response.status, extra=LOG_CMD)
 
+		if cmdClass and response.ok:
+			self.latency.add_sample(cmdClass, response.duration)
+		# a timed out command gets sampled when its late "ok" arrives (see _set_response)
 		self._set_processing(False)	# SMuFF is not supposed to do anything
 		self.wdTimeout = self._wdTimeoutDef
+		return response
+
+	#
+	# Waits until the next periodical states have been received (or the timeout
+	# has expired), so that load state and endstops are up to date
+	#
+	def wait_for_states(self, timeout=3.0):
+		stCount = self._stCount
+		endTime = time.monotonic() + timeout
+		while self._stCount == stCount and time.monotonic() < endTime:
+			time.sleep(0.05)
+		return self._stCount != stCount
+
+	#
+	# Makes sure the states are up to date if they've been turned off in the
+	# meantime (the tool or the feeder might have been changed manually)
+	#
+	def refresh_states(self):
+		if not self.statesStale:
+			return True
+		if self.statesMode == STATES_OFF and not self.set_states_mode(STATES_SLOW):
+			return False
+		return self.wait_for_states(self.statesIntervals[self.statesMode] + 1.0)
+
+	#
+	# Changes the interval of the periodical states sent by the SMuFF.
+	# Must not be called from within the serial reader thread, since it waits for the response.
+	#
+	def set_states_mode(self, mode):
+		if mode == self.statesMode:
+			return True
+		if mode == STATES_OFF and self._initState > 0:
+			# the init sequence is driven by the periodical states
+			return False
+		self._statesChange = True
+		try:
+			res = self.send_SMuFF_and_wait("{0} S{1}".format(PERSTATE, self.statesIntervals[mode]))
+		finally:
+			self._statesChange = False
+		if res == None or self.isError:
+			self._log.error("Can't switch periodical states to mode '{0}'".format(mode))
+			return False
+		self._account_states_mode(mode)
+		if self.dumpRawData:
+			self._log.info("Periodical states mode is now '{0}'".format(mode))
+		return True
+
+	#
+	# Switches the periodical states to the idle mode (unless the SMuFF is busy)
+	#
+	def apply_idle_states(self):
+		if self.isProcessing or not self.isConnected:
+			return False
+		if not self.set_states_mode(self.statesIdle):
+			return False
+		if self.statesMode != STATES_OFF:
+			# turned on again, get the tool and feeder state (i.e. at the start of a job)
+			self.refresh_states()
+		return True
+
+	#
+	# Adds up the time spent in the current states mode and switches to the new one
+	#
+	def _account_states_mode(self, mode):
+		now = time.monotonic()
+		self._get_states_stats(self.statesMode)[0] += now - self._statesSince
+		self._statesSince = now
+		self.statesMode = mode
+		if mode == STATES_OFF:
+			self.statesStale = True
+
+	#
+	# Adds up the lines, bytes and CPU time for the current states mode
+	#
+	def _account_states_line(self, size, cpu):
+		stats = self._get_states_stats(self.statesMode)
+		stats[1] += 1
+		stats[2] += size
+		stats[3] += cpu
+
+	def _get_states_stats(self, mode):
+		stats = self._statesStats.get(mode)
+		if stats == None:
+			stats = [ 0.0, 0, 0, 0.0 ]		# seconds, lines, bytes, CPU seconds
+			self._statesStats[mode] = stats
+		return stats
+
+	#
+	# Returns the serial traffic and CPU usage per hour for each states mode
+	#
+	def get_states_stats(self):
+		result = {}
+		for mode in [ STATES_FAST, STATES_SLOW, STATES_OFF ]:
+			secs, lines, size, cpu = self._get_states_stats(mode)
+			if mode == self.statesMode:
+				secs += time.monotonic() - self._statesSince
+			hours = secs / 3600
+			result[mode] = dict(
+				seconds 		= round(secs, 1),
+				linesPerHour	= round(lines / hours) if hours > 0 else 0,
+				bytesPerHour	= round(size / hours) if hours > 0 else 0,
+				cpuSecsPerHour	= round(cpu / hours, 3) if hours > 0 else 0
+			)
 		return result
 
+	#
+	# Sends a query to the SMuFF unless its result is cached and still valid.
+	# Concurrent identical queries share a single request. 'getter' returns
+	# the result after the SMuFF has answered (i.e. the values parsed).
+	#
+	def cached_query(self, key, gcode, getter, ttl=None):
+		if ttl == None:
+			ttl = QUERY_TTL.get(key, DEF_QUERY_TTL)
+		now = time.monotonic()
+		with self._cacheLock:
+			entry = self._cache.get(key)
+			if entry != None and entry[0] > now:
+				self.cacheHits += 1
+				return entry[1]
+			flight = self._inflight.get(key)
+			owner = flight == None
+			if owner:
+				flight = [ Event(), None ]
+				self._inflight[key] = flight
+				self.cacheMisses += 1
+				generation = self._cacheGen
+			else:
+				self.cacheShared += 1
+		if not owner:
+			flight[0].wait(self.cmdTimeout if self.cmdTimeout > 0 else None)
+			return flight[1]
+		value = None
+		try:
+			res = self.send_SMuFF_and_wait(gcode)
+			if res != None and not self.isError:
+				value = getter()
+		finally:
+			with self._cacheLock:
+				# don't cache results which have been invalidated while in flight
+				if value != None and generation == self._cacheGen:
+					self._cache[key] = (time.monotonic() + ttl, value)
+				del self._inflight[key]
+			flight[1] = value
+			flight[0].set()
+		return value
+
+	def query_fw_info(self):
+		return self.cached_query(FWINFO, FWINFO, lambda: self.fwInfo)
+
+	def query_materials(self):
+		return self.cached_query(CFG_MATERIALS, GETCONFIG.format(CFG_MATERIALS), lambda: list(self.materials))
+
+	def query_swaps(self):
+		return self.cached_query(CFG_SWAPS, GETCONFIG.format(CFG_SWAPS), lambda: list(self.swaps))
+
+	def query_lid_mappings(self):
+		return self.cached_query(CFG_SERVOMAPS, GETCONFIG.format(CFG_SERVOMAPS), lambda: list(self.servoMaps))
+
+	def query_feed_states(self):
+		return self.cached_query(CFG_FEEDSTATE, GETCONFIG.format(CFG_FEEDSTATE), lambda: list(self.feedStates))
+
+	#
+	# Drops all cached query results (on config change, reconnect or new firmware)
+	#
+	def invalidate_cache(self):
+		with self._cacheLock:
+			self._cache = {}
+			self._cacheGen += 1
+		self.config.invalidate()
+
+	def get_cache_stats(self):
+		with self._cacheLock:
+			return dict(hits=self.cacheHits, misses=self.cacheMisses, shared=self.cacheShared, entries=len(self._cache))
+
 	#
 	# Initializes data of this module by requesting runtime setting from the SMuFF
 	#
 	def _init_SMuFF(self):
 		self._log.info("Sending SMuFF init...")
+		self.invalidate_cache()
 		# turn on sending of periodical states
+		self._account_states_mode(STATES_FAST)
 		self.send_SMuFF(PERSTATE + OPT_ON)
 
 	#
@@ -723,17 +1130,21 @@ class SmuffCore():
 		self.isError = error
 
 	#
-	# set last response received (i.e. everything below the GCode and above the "ok\n")
+	# Completes the response being received (i.e. everything below the GCode and above the "ok\n")
 	#
-	def _set_response(self, response):
-		if not response == None:
-			if response.rstrip("\n") == RESET:
-				self._response = ""
-			else:
-				self._response = response.rstrip("\n")
-		else:
-			self._response = ""
-		self._lastResponse = []
+	def _set_response(self, status):
+		response = self._lastResponse
+		if response.text == RESET:
+			response.lines = []
+		if not response.finish(status) and response.status == smuff_response.RS_TIMEOUT and status == smuff_response.RS_OK:
+			# late "ok" for a command that has timed out, sample the real latency
+			# so that a timeout which has become too tight grows again
+			if self.latency and response.command:
+				latency = time.monotonic() - response.sent
+				self.latency.add_sample(self.latency.get_class(response.command), latency)
+				self._log.info("Late response to '{0}' after {1:.2f} secs.".format(response.command, latency))
+		self._response = response
+		self._lastResponse = smuff_response.Response()
 
 	#
 	# Dump string s as a hex string (for debugging only)
@@ -749,94 +1160,39 @@ class SmuffCore():
 		if category == None or data == None:
 			return
 		if self.dumpRawData:
-			self._log.info("Parse JSON (category '{1}'):\n\t[{0}]".format(data, category))
+			self._log.info("Parse JSON (category '%s'):\n\t[%s]", category, data, extra=LOG_SERIAL)
 
 		if data:
-			resp = ""
 			try:
-				cfg = json.loads(data)
-				if cfg == None:
-					return
-				# basic configuration
-				if category == C_BASIC:
-					self.device 		= cfg["Device"]
-					self.toolCount 		= cfg["Tools"]
-					self.hasCutter		= cfg["UseCutter"]
-					self.hasSplitter 	= cfg["UseSplitter"]
-					self.isDDE 			= cfg["UseDDE"]
-					self._initState += 1
-
-				# stepper configuration
-				if category == C_STEPPERS:
-					pass
-
-				# TMC driver configuration
-				if category == C_TMC:
-					pass
-
-				# materials configuration
-				if category == C_MATERIALS:
-					try:
-						self.materials = []
-						for i in range(self.toolCount):
-							t = "T"+str(i)
-							material = [ cfg[t]["Material"], cfg[t]["Color"], cfg[t]["PFactor"] ]
-							self.materials.append(material)
-							#resp += "Tool {0} is '{2} {1}' with a purge factor of {3}%\n".format(i, material[0], material[1], material[2])
-						self._initState += 1
-					except Exception as err:
-						self._log.error("Parsing materials has thrown an exception:\n\t{0}".format(err))
-
-				# tool swapping configuration
-				if category == C_SWAPS:
-					try:
-						self.swaps = []
-						for i in range(self.toolCount):
-							t = "T"+str(i)
-							swap = cfg[t]
-							self.swaps.append(swap)
-							#resp += "Tool {0} is assigned to tray {1}\n".format(i, swap)
-						self._initState += 1
-					except Exception as err:
-						self._log.error("Parsing tool swaps has thrown an exception:\n\t{0}".format(err))
-
-				# servo mapping configuration
-				if category == C_SERVOMAPS:
-					try:
-						self.servoMaps = []
-						for i in range(self.toolCount):
-							t = "T"+str(i)
-							servoMap = cfg[t]["Close"]
-							self.servoMaps.append(servoMap)
-							#resp += "Tool {0} closed @ {1} deg.\n".format(i, servoMap)
-						self._initState += 1
-					except Exception as err:
-						self._log.error("Parsing lid mappings has thrown an exception:\n\t{0}".format(err))
-
-				# feeder states
-				if category == C_FEEDSTATE:
-					try:
-						self.feedStates = []
-						for i in range(self.toolCount):
-							t = "T"+str(i)
-							feedState = cfg[t]
-							self.feedStates.append(feedState)
-							#resp += "Tool load state {0}\n".format(i, feedState)
-					except Exception as err:
-						self._log.error("Parsing feed states has thrown an exception:\n\t{0}".format(err))
-
-				if len(resp) and self._isKlipper:
-					try:
-						self.gcode.respond_info(resp)
-					except Exception as err:
-						self._log.error("Sending response to Klipper has thrown an exception:\n\t{0}".format(err))
-				else:
-					if not self._responseCB == None:
-						self._responseCB(resp)
-
-
+				changed = self.config.update(category, data)
 			except Exception as err:
-				self._log.error("Parse JSON for category {1} has thrown an exception:\n\t{0}\n\t[{1}]".format(err, self._jsonCat, data))
+				self._log.error("Parse JSON for category {1} has thrown an exception:\n\t{0}\n\t[{2}]".format(err, category, data))
+				return
+			if changed:
+				self._apply_config(category)
+			if category in (C_BASIC, C_MATERIALS, C_SWAPS, C_SERVOMAPS) and self._initState > 0:
+				self._initState += 1
+
+	#
+	# Takes over the (changed) configuration category into the status values
+	#
+	def _apply_config(self, category):
+		if category == C_BASIC:
+			basic = self.config.basic
+			self.device 		= basic["Device"]
+			self.toolCount 		= basic["Tools"]
+			self.hasCutter		= basic.get("UseCutter", False)
+			self.hasSplitter 	= basic.get("UseSplitter", False)
+			self.isDDE 			= basic.get("UseDDE", False)
+		elif category == C_MATERIALS:
+			self.materials 		= self.config.get_materials()
+		elif category == C_SWAPS:
+			self.swaps 			= self.config.get_swaps()
+		elif category == C_SERVOMAPS:
+			self.servoMaps 		= self.config.get_servo_maps()
+		elif category == C_FEEDSTATE:
+			self.feedStates 	= self.config.get_feed_states()
+		self._save_state()
 
 	#
 	# Parses the states periodically sent by the SMuFF
@@ -862,7 +1218,10 @@ class SmuffCore():
 			elif m[0] == "SD:":                         # SD-Card state
 				self.sdcard        = m[1].strip() == T_ON.lower()
 			elif m[0] == "SC:":                         # Settings Changed
-				self.cfgChange     = m[1].strip() == T_ON.lower()
+				cfgChange = m[1].strip() == T_ON.lower()
+				if cfgChange and not self.cfgChange:
+					self.invalidate_cache()
+				self.cfgChange     = cfgChange
 			elif m[0] == "LID:":                        # Lid state
 				self.lid           = m[1].strip() == T_ON.lower()
 			elif m[0] == "I:":                          # Idle state
@@ -887,16 +1246,30 @@ class SmuffCore():
 			elif m[0] == "RLY:":                        # Relay state (E/I)
 				self.relay = m[1].strip()
 			elif m[0] == "JAM:":                        # Feeder jammed flag
-				self.isJammed = m[1].strip() == T_ON.lower()
+				jammed = m[1].strip() == T_ON.lower()
+				if jammed != self.isJammed:
+					self.isJammed = jammed
+					self._signal(SIG_JAM if jammed else SIG_JAM_CLEARED)
 
 			#else:
 				#	self._log.error("Unknown state: [" + m[0] + "]")
 
+		if self.history:
+			self.history.add(self.parse_tool_number(self.curTool), self.loadState, self.selector, self.feeder, self.feeder2, self.isJammed, self.lid, self.isIdle)
+
+		if self.deviceState:
+			if self.deviceState.restored != None:
+				# first states after a restart, check the state restored
+				self.deviceState.reconcile(self)
+			else:
+				self.deviceState.update(self)
+
 		if not self._statusCB == None:
 			self._statusCB(active=True)
 
 		self._serWdEvent.set()
 		self._stCount += 1
+		self.statesStale = False
 		if self._initState > 0:
 			self._async_init()
 		return True
@@ -922,7 +1295,7 @@ class SmuffCore():
 			return
 
 		if self.dumpRawData:
-			self._log.info("Raw data: [{0}]".format(data.rstrip("\n")))
+			self._log.info("Raw data: [%s]", data.rstrip("\n"), extra=LOG_SERIAL)
 
 		self._lastSerialEvent = self._nowMS()
 		self._serEvent.clear()
@@ -935,6 +1308,9 @@ class SmuffCore():
 			return
 
 		if data.startswith(PERSTATE):
+			if self._statesChange:
+				# only the reporting interval has changed, no need to init again
+				return
 			if self.dumpRawData:
 				self._log.info("Periodical states sending is ON")
 			self._initState = 1
@@ -968,11 +1344,14 @@ class SmuffCore():
 					if not self._responseCB == None:
 						self._responseCB(err)
 				self._set_busy(True)
+				if not self._lastResponse.done:
+					self._lastResponse.status = smuff_response.RS_BUSY
 			return
 
 		if data.startswith(R_ERROR):
 			err = "SMuFF has sent an error response: [{0}]".format(data.rstrip())
 			self._log.info(err)
+			self._lastResponse.add(data)
 			if self._isKlipper:
 				self.gcode.respond_info(err)
 			else:
@@ -980,7 +1359,7 @@ class SmuffCore():
 					self._responseCB(err)
 			index = len(R_ERROR)+1
 			# maybe the SMuFF has received garbage
-			if data[index:].startswith(R_UNKNOWNCMD):
+			if data[index:].startswith(R_UNKNOWNCMD) and self._serial:	# (no serial port while replaying a capture)
 				self._serial.reset_output_buffer()
 				self._serial.reset_input_buffer()
 			self._set_error(True)
@@ -990,11 +1369,11 @@ class SmuffCore():
 			return
 
 		if data.startswith(ACTION_CMD):
-			self._log.debug("SMuFF has sent an action request: [{0}]".format(data.rstrip()))
+			self._log.debug("SMuFF has sent an action request: [%s]", data.rstrip(), extra=LOG_CMD)
 			index = len(ACTION_CMD)
 			# what action is it? is it a tool change?
 			if data[index:].startswith(TOOL):
-				tool = self._parse_tool_number(data[10:])
+				tool = self.parse_tool_number(data[10:])
 				# only if the printer isn't printing
 				if self._is_printing() == False:
 					# query the heater
@@ -1003,30 +1382,33 @@ class SmuffCore():
 						if heater.extruder.can_extrude:
 							self._log.debug("Extruder is up to temp.")
 							self._printer.change_tool("tool{0}".format(tool))
-							self.send_SMuFF("{0} T: OK".format(ACTION_CMD))
+							self._write_serial("{0} T: OK".format(ACTION_CMD))
 						else:
 							self._log.error("Can't change to tool {0}, nozzle not up to temperature".format(tool))
-							self.send_SMuFF("{0} T: \"Nozzle too cold\"".format(ACTION_CMD))
+							self._write_serial("{0} T: \"Nozzle too cold\"".format(ACTION_CMD))
 					except:
 						self._log.error("Can't query temperatures. Aborting.")
-						self.send_SMuFF("{0} T: \"No nozzle temp. avail.\"".format(ACTION_CMD))
+						self._write_serial("{0} T: \"No nozzle temp. avail.\"".format(ACTION_CMD))
 				else:
 					self._log.error("Can't change to tool {0}, printer not ready or printing".format(tool))
-					self.send_SMuFF("{0} T: \"Printer not ready\"".format(ACTION_CMD))
+					self._write_serial("{0} T: \"Printer not ready\"".format(ACTION_CMD))
 
 			if data[index:].startswith(ACTION_WAIT):
 				self.waitRequested = True
 				self._log.info("Waiting for SMuFF to come clear... (ACTION_WAIT)")
+				self._signal(ACTION_WAIT)
 
 			if data[index:].startswith(ACTION_CONTINUE):
 				self.waitRequested = False
 				self.abortRequested = False
 				self._log.info("Continuing after SMuFF cleared... (ACTION_CONTINUE)")
+				self._signal(ACTION_CONTINUE)
 
 			if data[index:].startswith(ACTION_ABORT):
 				self.waitRequested = False
 				self.abortRequested = True
 				self._log.info("SMuFF is aborting action operation... (ACTION_ABORT)")
+				self._signal(ACTION_ABORT)
 
 			if data[index:].startswith(ACTION_PONG):
 				self._log.info("PONG received from SMuFF (ACTION_PONG)")
@@ -1042,6 +1424,9 @@ class SmuffCore():
 			return
 
 		if data.startswith(R_FWINFO):
+			if self.fwInfo != "?" and self.fwInfo != data.rstrip("\n"):
+				# firmware has changed, cached results are stale
+				self.invalidate_cache()
 			self.fwInfo = data.rstrip("\n")
 			if self._isKlipper:
 				self.gcode.respond_info(T_FW_INFO.format(self.fwInfo))
@@ -1057,19 +1442,28 @@ class SmuffCore():
 					self.fwOptions 	= arr[0][5]
 			except Exception as err:
 				self._log.error("Can't regex firmware info:\n\t{0}".format(err))
-			self._initState += 1
+			if self._initState > 0:
+				self._initState += 1
 			return
 
 		if data.startswith(R_OK):
+			if self._pipeAcks != None:
+				# response to a pipelined command
+				with self._ackCond:
+					self._pipeAcks.append(not self.isError)
+					self._ackCond.notify()
+				self._set_error(False)
+				self._lastResponse = smuff_response.Response()
+				return
 			if self.isError:
-				self._set_response(None)
+				self._set_response(smuff_response.RS_ERROR)
 				self._lastCmdSent = None
 				self._lastCmdDone = True
 			else:
 				if self.dumpRawData:
-					self._log.info("[OK->] LastCommand '{0}'   LastResponse {1}".format(self._lastCmdSent, pformat(self._lastResponse)))
+					self._log.info("[OK->] LastCommand '%s'   LastResponse %s", self._lastCmdSent, tuple(self._lastResponse.lines), extra=LOG_SERIAL)
 
-				firstResponse = self._lastResponse[0].rstrip("\n") if len(self._lastResponse) else None
+				firstResponse = self._lastResponse.lines[0] if len(self._lastResponse.lines) else None
 
 				if firstResponse == RESET:
 					firstResponse = None
@@ -1082,17 +1476,27 @@ class SmuffCore():
 						self._lastCmdDone = True
 
 				if self.dumpRawData and self._lastCmdSent:
-					self._log.info("lastCmdDone is {0}".format(self._lastCmdDone))
-				self._set_response("".join(self._lastResponse))
+					self._log.info("lastCmdDone is %s", self._lastCmdDone, extra=LOG_SERIAL)
+				self._set_response(smuff_response.RS_OK)
 			self._lastCmdSent = None
 			# set serEvent only after a ok was received
 			self._serEvent.set()
 			return
 
-		# store all responses before the "ok"
-		if data:
-			self._lastResponse.append(str(data))
-		self._log.debug("Last response received: [{0}]".format(self._lastResponse[len(self._lastResponse)-1]))
+		# store all responses before the "ok" (up to the limits of a response)
+		if data and not self._lastResponse.add(str(data)) and self._lastResponse.dropped == 1:
+			self._log.warning("Response to '{0}' exceeds {1} lines / {2} chars, dropping the rest".format(self._lastResponse.command, smuff_response.MAX_LINES, smuff_response.MAX_CHARS))
+		self._log.debug("Last response received: [%s]", data, extra=LOG_SERIAL)
+
+	#
+	# Hands a signal (WAIT, CONTINUE, ABORT, JAM, JAM_CLEARED) over to the signal callback
+	#
+	def _signal(self, signal):
+		if not self.signalCB == None:
+			try:
+				self.signalCB(self, signal, time.monotonic())
+			except Exception as err:
+				self._log.error("Signal callback has thrown an exception:\n\t{0}".format(err))
 
 	#
 	# Helper function to retrieve time in milliseconds
@@ -1154,8 +1558,10 @@ class SmuffCore():
 	def stop_tc_timer(self):
 		duration = (self._nowMS()-self._tcStartTime)/1000
 		self.durationTotal += duration
+		self._save_state()
 		return duration
 
 	def reset_avg(self):
 		self.tcCount = 0
 		self.durationTotal = 0
+		self._save_state()
@@ -0,0 +1,218 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF serial port discovery
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Finds the serial ports the SMuFFs are connected to, so that a changed USB
+# enumeration order doesn't leave the plugin disconnected. The candidate
+# ports (/dev/serial/by-id, ttyACM, ttyUSB) are probed concurrently with
+# M115 / M503 within a short deadline, SMuFFs are identified by their
+# FIRMWARE_NAME and told apart by their device name. The mapping device ->
+# port gets cached, so that only ports which have appeared since need to be
+# probed. A hotplug watcher only compares the list of serial devices, the
+# ports are probed again only if that list has changed.
+
+from threading import Event, Lock, Thread
+
+import glob
+import json
+import logging
+import os
+import time
+
+try:
+    import serial
+except ImportError:
+    logging.critical("SMuFF: Python library 'pySerial' is missing. Please use 'pip install pyserial' first!")
+
+PORT_PATTERNS 	= [ "/dev/serial/by-id/*", "/dev/ttyACM*", "/dev/ttyUSB*" ]
+STABLE_PORTS 	= ( "/dev/serial/by-id/", "/dev/serial/by-path/" )
+FW_MATCH 		= "SMuFF"				# FIRMWARE_NAME of a SMuFF contains this
+PROBE 			= b"M115\nM503 S1W\n"	# firmware info and basic configuration (device name)
+DEF_TIMEOUT 	= 3.0 					# default probing deadline (in seconds)
+HOTPLUG_CHECK 	= 2.0 					# interval for comparing the list of serial devices (in seconds)
+
+#
+# Returns the serial ports which might have a SMuFF connected, the by-id names
+# preferred (they don't change with the enumeration order)
+#
+def candidate_ports(exclude=()):
+	excluded = set([ os.path.realpath(port) for port in exclude if port ])
+	ports = {}
+	for pattern in PORT_PATTERNS:
+		for port in sorted(glob.glob(pattern)):
+			real = os.path.realpath(port)
+			if real not in excluded and real not in ports:
+				ports[real] = port
+	return list(ports.values())
+
+#
+# Sends M115 / M503 to the port and returns dict(port, baudrate, fwInfo, device)
+# if a SMuFF has answered before the deadline, None otherwise
+#
+def probe(port, baudrates, timeout=DEF_TIMEOUT):
+	endTime = time.monotonic() + timeout
+	for n, baudrate in enumerate(baudrates):
+		# each baudrate gets an equal share of the time left
+		deadline = time.monotonic() + (endTime - time.monotonic()) / (len(baudrates) - n)
+		try:
+			# exclusive: skip ports opened by another process (i.e. Klipper's MCU port)
+			with serial.Serial(port, baudrate, timeout=0.1, write_timeout=0.5, exclusive=True) as ser:
+				ser.reset_input_buffer()
+				ser.write(PROBE)
+				result = dict(port=port, baudrate=baudrate, fwInfo=None, device=None)
+				jsonCat = None
+				while time.monotonic() < deadline:
+					line = ser.readline().decode("ascii", errors="ignore").strip()
+					if not line:
+						continue
+					if line.startswith("start"):
+						# the device has just been reset by opening the port
+						ser.write(PROBE)
+					elif line.startswith("FIRMWARE_NAME"):
+						result["fwInfo"] = line
+						if FW_MATCH not in line:
+							return None
+					elif line.startswith("/*"):
+						jsonCat = line[2:].rstrip("*/").strip().lower()
+					elif line.startswith("{") and jsonCat == "basic":
+						try:
+							result["device"] = json.loads(line).get("Device")
+						except ValueError:
+							pass
+					if result["fwInfo"] and result["device"] != None:
+						break
+				if result["fwInfo"]:
+					return result
+		except (OSError, ValueError, serial.SerialException):
+			return None
+	return None
+
+class PortDiscovery():
+
+	def __init__(self, logger, fileName=None):
+		self._log 		= logger
+		self._fileName 	= fileName		# file the mapping is cached in
+		self._lock 		= Lock()
+		self.mapping 	= {}			# instance ("A" / "B") -> dict(port, baudrate, fwInfo, device)
+		self.probes 	= 0 			# number of ports probed
+		self.lastProbe 	= None			# duration of the last probing (in seconds)
+		self._watcher 	= None
+		self._stopWatch = Event()
+		self.load()
+
+	#
+	# Probes the ports concurrently, returns the SMuFFs found (within the deadline)
+	#
+	def probe_all(self, ports, baudrates, timeout=DEF_TIMEOUT):
+		results = {}
+
+		def prober(port):
+			results[port] = probe(port, baudrates, timeout)
+
+		start = time.monotonic()
+		threads = [ Thread(target=prober, args=(port,), name="TProbe") for port in ports ]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		for thread in threads:
+			thread.join(max(0.0, start + timeout + 0.5 - time.monotonic()))
+		self.probes += len(ports)
+		self.lastProbe = time.monotonic() - start
+		found = [ results[port] for port in ports if results.get(port) ]
+		self._log.info("Probed {0} port(s) in {1:.2f} secs., found {2} SMuFF(s): {3}".format(len(ports), self.lastProbe, len(found), ", ".join([ "{0} ({1})".format(r["port"], r["device"]) for r in found ])))
+		return found
+
+	#
+	# Determines the port (and baudrate) for each of the instances given, returns
+	# instance -> dict(port, baudrate, fwInfo, device). Cached ports which still
+	# exist are taken as they are, all other candidates get probed. A SMuFF found
+	# goes to the instance it has been assigned to before (same device name),
+	# the rest is assigned in the order of the port names.
+	#
+	def resolve(self, names, baudrates, timeout=DEF_TIMEOUT, exclude=()):
+		with self._lock:
+			mapping = { name: dict(self.mapping[name]) for name in names if name in self.mapping }
+		# ttyACMn / ttyUSBn might be another device after a reboot, the by-id names won't
+		resolved = { name: entry for name, entry in mapping.items() if entry["port"].startswith(STABLE_PORTS) and os.path.exists(entry["port"]) }
+		missing = [ name for name in names if name not in resolved ]
+		if missing:
+			inUse = list(exclude) + [ entry["port"] for entry in resolved.values() ]
+			found = self.probe_all(candidate_ports(inUse), baudrates, timeout)
+			for name in missing:
+				device = mapping.get(name, {}).get("device")
+				match = [ r for r in found if device != None and r["device"] == device ]
+				if match:
+					resolved[name] = match[0]
+					found.remove(match[0])
+			for name in missing:
+				if name not in resolved and found:
+					# not seen before (or replaced), take the next one
+					resolved[name] = found.pop(0)
+			with self._lock:
+				self.mapping.update(resolved)
+			self.save()
+		return { name: dict(entry) for name, entry in resolved.items() }
+
+	def forget(self, name):
+		with self._lock:
+			self.mapping.pop(name, None)
+		self.save()
+
+	#
+	# Calls changeCB(added, removed) whenever serial devices appear or disappear
+	#
+	def start_watching(self, changeCB, interval=HOTPLUG_CHECK):
+		if self._watcher and self._watcher.is_alive():
+			return
+		self._stopWatch.clear()
+		self._watcher = Thread(target=self._watch, args=(changeCB, interval), name="THotplug")
+		self._watcher.daemon = True
+		self._watcher.start()
+
+	def stop_watching(self):
+		self._stopWatch.set()
+
+	def _watch(self, changeCB, interval):
+		ports = set(candidate_ports())
+		while not self._stopWatch.wait(interval):
+			current = set(candidate_ports())
+			if current != ports:
+				added, removed = sorted(current - ports), sorted(ports - current)
+				ports = current
+				self._log.info("Serial devices changed (added: {0}, removed: {1})".format(added, removed))
+				try:
+					changeCB(added, removed)
+				except Exception as err:
+					self._log.error("Hotplug callback has thrown an exception:\n\t{0}".format(err))
+
+	def load(self):
+		if not self._fileName or not os.path.isfile(self._fileName):
+			return
+		try:
+			with open(self._fileName, "r") as f:
+				data = json.load(f)
+			with self._lock:
+				self.mapping = data
+		except Exception as err:
+			self._log.error("Can't load SMuFF port mapping from '{0}':\n\t{1}".format(self._fileName, err))
+
+	#
+	# Persists the mapping (write to a temp. file first, then replace the old one)
+	#
+	def save(self):
+		if not self._fileName:
+			return
+		with self._lock:
+			data = json.dumps(self.mapping)
+		try:
+			tmpName = self._fileName + ".tmp"
+			with open(tmpName, "w") as f:
+				f.write(data)
+			os.replace(tmpName, self._fileName)
+		except Exception as err:
+			self._log.error("Can't save SMuFF port mapping to '{0}':\n\t{1}".format(self._fileName, err))
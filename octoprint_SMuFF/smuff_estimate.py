@@ -0,0 +1,229 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF print time estimation
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Adds the time the SMuFF needs for the remaining tool changes of a print
+# job to OctoPrint's estimate of the print time left. The tool changes of
+# a file get indexed once (byte offset of each T command), the expected
+# duration of each swap comes from the durations measured so far for the
+# very same pair of tools.
+
+from bisect import bisect_right
+from threading import Lock
+
+import json
+import os
+import re
+
+ALPHA 			= 0.3 					# weight of a new duration in the running average of a tool pair
+DEF_SWAP_TIME 	= 30.0 					# expected duration of a tool change (in seconds) without any data
+SAVE_EVERY 		= 5 					# persist the durations after this many tool changes
+
+# Origins of OctoPrint's estimate (see octoprint.printer.estimation)
+O_ANALYSIS 		= ( "analysis", "mixed-analysis" )	# slicer / GCode analysis, knows nothing about tool changes
+O_LINEAR 		= ( "linear", "estimate" )			# extrapolated from the time elapsed, includes the tool changes so far
+
+TOOL_CMD 		= re.compile(rb'^\s*T(\d+)')
+
+#
+# Returns the key of a tool pair on a SMuFF instance (i.e. "A:0>3")
+#
+def pair_key(inst, src, dst):
+	return "{0}:{1}>{2}".format(inst, src, dst)
+
+#
+# Running average of the tool change duration per pair of tools
+#
+class SwapTimes():
+
+	def __init__(self, logger, fileName=None):
+		self._log 		= logger
+		self._fileName 	= fileName		# file the durations are persisted in
+		self._lock 		= Lock()
+		self._pairs 	= {}			# pair key -> [ average duration, count ]
+		self._unsaved 	= 0
+		self.version 	= 0 			# incremented with each new duration
+		self.load()
+
+	def add(self, inst, src, dst, duration):
+		key = pair_key(inst, src, dst)
+		with self._lock:
+			pair = self._pairs.get(key)
+			if pair == None:
+				self._pairs[key] = [ round(duration, 2), 1 ]
+			else:
+				pair[0] = round(pair[0] + ALPHA * (duration - pair[0]), 2)
+				pair[1] += 1
+			self.version += 1
+			self._unsaved += 1
+			mustSave = self._unsaved >= SAVE_EVERY
+		if mustSave:
+			self.save()
+
+	#
+	# Returns the expected duration for a pair of tools. Unknown pairs get the
+	# average of all pairs of the same instance (or the default).
+	#
+	def get(self, inst, src, dst):
+		with self._lock:
+			pair = self._pairs.get(pair_key(inst, src, dst))
+			if pair != None:
+				return pair[0]
+			prefix = inst + ":"
+			known = [ p[0] for key, p in self._pairs.items() if key.startswith(prefix) ]
+		return sum(known) / len(known) if len(known) else DEF_SWAP_TIME
+
+	def get_stats(self):
+		with self._lock:
+			return { key: dict(avgSecs=pair[0], count=pair[1]) for key, pair in self._pairs.items() }
+
+	def load(self):
+		if not self._fileName or not os.path.isfile(self._fileName):
+			return
+		try:
+			with open(self._fileName, "r") as f:
+				data = json.load(f)
+			with self._lock:
+				self._pairs = { key: list(pair) for key, pair in data.items() }
+		except Exception as err:
+			self._log.error("Can't load tool change durations from '{0}':\n\t{1}".format(self._fileName, err))
+
+	#
+	# Persists the durations (write to a temp. file first, then replace the old one)
+	#
+	def save(self):
+		if not self._fileName:
+			return
+		with self._lock:
+			data = { key: list(pair) for key, pair in self._pairs.items() }
+			self._unsaved = 0
+		try:
+			tmpName = self._fileName + ".tmp"
+			with open(tmpName, "w") as f:
+				json.dump(data, f)
+			os.replace(tmpName, self._fileName)
+		except Exception as err:
+			self._log.error("Can't save tool change durations to '{0}':\n\t{1}".format(self._fileName, err))
+
+#
+# Byte offset and tool pair of every tool change in a GCode file
+#
+class ToolIndex():
+
+	def __init__(self, fileName, toolCountA):
+		self.fileName 	= fileName
+		self.size 		= 0 			# file size (for converting the progress into a position)
+		self.offsets 	= []			# byte offset of each tool change
+		self.pairs 		= []			# (instance, from, to) of each tool change
+		self._suffix 	= None 			# expected time of all tool changes from index i to the end
+		self._version 	= None			# SwapTimes version the suffix sums have been built for
+		self._build(toolCountA)
+
+	#
+	# Scans the file once. Tools beyond the tool count of SMuFF A are on SMuFF B.
+	# Selecting the tool that's already active on an instance isn't a tool change.
+	#
+	def _build(self, toolCountA):
+		current = { "A": None, "B": None }
+		offset = 0
+		with open(self.fileName, "rb") as f:
+			for line in f:
+				match = TOOL_CMD.match(line)
+				if match:
+					tool = int(match.group(1))
+					inst = "A" if tool < toolCountA or toolCountA <= 0 else "B"
+					if inst == "B":
+						tool -= toolCountA
+					if current[inst] != tool:
+						self.offsets.append(offset)
+						self.pairs.append((inst, current[inst], tool))
+						current[inst] = tool
+				offset += len(line)
+		self.size = offset
+
+	#
+	# Returns (number of tool changes, expected seconds) after the file position given
+	#
+	def remaining(self, position, swapTimes):
+		if self._version != swapTimes.version:
+			suffix = [ 0.0 ] * (len(self.pairs) + 1)
+			for i in range(len(self.pairs)-1, -1, -1):
+				suffix[i] = suffix[i+1] + swapTimes.get(*self.pairs[i])
+			self._suffix = suffix
+			self._version = swapTimes.version
+		index = bisect_right(self.offsets, position)
+		return len(self.pairs) - index, self._suffix[index]
+
+class SwapEstimator():
+
+	def __init__(self, logger, fileName=None):
+		self._log 		= logger
+		self._lock 		= Lock()
+		self.swapTimes 	= SwapTimes(logger, fileName)
+		self.index 		= None 			# ToolIndex of the file being printed
+		self.spent 		= 0.0 			# time spent in tool changes of the current job
+		self.enabled 	= True
+		self._generation= 0 			# incremented whenever a job starts or ends
+
+	#
+	# Called when a new print job starts, returns the generation start_job needs
+	#
+	def begin_job(self):
+		with self._lock:
+			self._generation += 1
+			self.index = None
+			self.spent = 0.0
+			return self._generation
+
+	#
+	# Indexes the file of a new print job (None if it's not a local file).
+	# The index is dropped if the job has ended (or another one has started) meanwhile.
+	#
+	def start_job(self, fileName, toolCountA, generation):
+		index = None
+		if fileName:
+			try:
+				index = ToolIndex(fileName, toolCountA)
+				self._log.info("Indexed {0} tool change(s) in '{1}'".format(len(index.pairs), fileName))
+			except Exception as err:
+				self._log.error("Can't index tool changes of '{0}':\n\t{1}".format(fileName, err))
+		with self._lock:
+			if generation == self._generation:
+				self.index = index
+
+	def end_job(self):
+		with self._lock:
+			self._generation += 1
+			self.index = None
+			self.spent = 0.0
+		self.swapTimes.save()
+
+	def tool_changed(self, inst, src, dst, duration):
+		self.swapTimes.add(inst, src, dst, duration)
+		with self._lock:
+			self.spent += duration
+
+	#
+	# Adjusts OctoPrint's estimate of the print time left (in seconds)
+	#
+	def adjust(self, left, origin, progress):
+		if not self.enabled or left == None:
+			return left
+		with self._lock:
+			index = self.index
+			spent = self.spent
+			if index == None or progress == None:
+				return left
+			_, expected = index.remaining(int(progress * index.size), self.swapTimes)
+		if origin in O_ANALYSIS:
+			return left + expected
+		if origin in O_LINEAR and progress > 0:
+			# take the tool changes so far out of the extrapolation, add the ones still to come
+			return max(0, left - spent * (1.0 - progress) / progress) + expected
+		# historical print times of the same file already contain the tool changes
+		return left
@@ -0,0 +1,122 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF state history
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Keeps the last n periodical states of a SMuFF (tool, endstops, load
+# state, jam, lid, idle) in preallocated arrays used as a ring buffer, so
+# that recording a sample doesn't allocate anything and a failed tool
+# change can be diagnosed afterwards (i.e. "Feeder never triggered").
+
+from array import array
+from threading import Lock
+
+import time
+
+DEF_SIZE 		= 3600 					# number of samples kept (one hour at one sample per second)
+DEF_POINTS 		= 500 					# max. number of samples returned by a query
+
+# Bits of the flags stored per sample
+F_SELECTOR 		= 0x01
+F_FEEDER 		= 0x02
+F_FEEDER2 		= 0x04
+F_JAM 			= 0x08
+F_LID 			= 0x10
+F_IDLE 			= 0x20
+FLAGS 			= ( ("selector", F_SELECTOR), ("feeder", F_FEEDER), ("feeder2", F_FEEDER2), ("jam", F_JAM), ("lid", F_LID), ("idle", F_IDLE) )
+
+class StateHistory():
+
+	def __init__(self, size=DEF_SIZE):
+		self._lock 		= Lock()
+		self.size 		= size
+		self._time 		= array("d", bytes(8 * size))	# timestamp (seconds since the epoch)
+		self._tool 		= array("h", bytes(2 * size))	# tool number (-1 = none)
+		self._load 		= array("b", bytes(size))		# load state
+		self._flags 	= array("B", bytes(size))		# F_* bits
+		self._head 		= 0 			# next slot to write to
+		self._count 	= 0 			# number of valid samples
+
+	def add(self, tool, loadState, selector, feeder, feeder2, jam, lid, idle, timestamp=None):
+		flags = (F_SELECTOR if selector else 0) | (F_FEEDER if feeder else 0) | (F_FEEDER2 if feeder2 else 0) | \
+				(F_JAM if jam else 0) | (F_LID if lid else 0) | (F_IDLE if idle else 0)
+		with self._lock:
+			i = self._head
+			self._time[i] 	= timestamp if timestamp != None else time.time()
+			self._tool[i] 	= tool
+			self._load[i] 	= loadState
+			self._flags[i] 	= flags
+			self._head 		= (i + 1) % self.size
+			if self._count < self.size:
+				self._count += 1
+
+	def clear(self):
+		with self._lock:
+			self._head = 0
+			self._count = 0
+
+	#
+	# Physical index of the n-th oldest sample (called with the lock held)
+	#
+	def _index(self, n):
+		return (self._head - self._count + n) % self.size
+
+	#
+	# Number of samples older than the timestamp given (binary search, called with the lock held)
+	#
+	def _bisect(self, timestamp):
+		lo, hi = 0, self._count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._time[self._index(mid)] < timestamp:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	#
+	# Returns the samples within the time window given (columns of equal length).
+	# If there are more than 'points' samples, the samples where the state has
+	# changed are returned plus every n-th sample in between (up to 'points' in total).
+	# With 'points' being None or <= 0 all samples get returned.
+	#
+	def query(self, start=None, end=None, points=DEF_POINTS):
+		if points == None or points <= 0:
+			points = 0
+		with self._lock:
+			first = self._bisect(start) if start != None else 0
+			last = self._bisect(end + 1e-6) if end != None else self._count
+			count = max(0, last - first)
+			step = max(1, -(-count // points)) if points else 1
+			changes = []
+			others = []
+			prev = None
+			for n in range(first, last):
+				i = self._index(n)
+				state = (self._tool[i], self._load[i], self._flags[i])
+				if state != prev:
+					changes.append((self._time[i],) + state)
+				elif (n - first) % step == 0:
+					others.append((self._time[i],) + state)
+				prev = state
+		if points and len(changes) + len(others) > points:
+			# state changes take precedence over the samples in between
+			if len(changes) >= points:
+				changes = changes[::-(-len(changes) // points)]
+				others = []
+			else:
+				others = others[::-(-len(others) // (points - len(changes)))]
+		selected = sorted(changes + others)
+		result = dict(
+			count 		= count,
+			time 		= [ round(s[0], 3) for s in selected ],
+			tool 		= [ s[1] for s in selected ],
+			loadState 	= [ s[2] for s in selected ]
+		)
+		for name, bit in FLAGS:
+			result[name] = [ bool(s[3] & bit) for s in selected ]
+		return result
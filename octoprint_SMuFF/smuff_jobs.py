@@ -0,0 +1,194 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF per job tool change report
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Collects the tool changes, hold times, retries, jams and purges of the
+# running print job as they happen and stores one compact report per job
+# (one JSON line in the jobs file) as soon as the job has finished.
+
+from collections import deque
+from threading import Lock
+
+import json
+import math
+import os
+import time
+
+MAX_JOBS_KEPT 	= 50 					# number of job reports kept in memory for queries
+
+#
+# Returns the p-th percentile (0..100) of an already sorted list of values
+#
+def _percentile(ordered, p):
+	if not len(ordered):
+		return None
+	index = min(len(ordered)-1, int(math.ceil(p / 100.0 * len(ordered))) - 1)
+	return ordered[max(index, 0)]
+
+class JobTracker():
+
+	def __init__(self, logger, fileName=None):
+		self._log 		= logger
+		self._fileName 	= fileName		# file the job reports are appended to
+		self._lock 		= Lock()
+		self._job 		= None			# report of the running job
+		self._durations	= []			# tool change durations of the running job
+		self._holdStart	= None			# time the current hold has started
+		self.jobs 		= deque(maxlen=MAX_JOBS_KEPT)	# reports of the last jobs
+		self.load()
+
+	@property
+	def active(self):
+		return self._job != None
+
+	#
+	# Called when a print job has been started
+	#
+	def start(self, name):
+		with self._lock:
+			self._durations = []
+			self._holdStart = None
+			self._job = dict(
+				name 		= name,
+				started 	= time.time(),
+				finished	= None,
+				status		= None,
+				toolChanges	= 0,
+				perTool 	= {},		# number of tool changes per "A:T0", "B:T3", ...
+				holdSecs 	= 0.0,
+				p50Secs 	= None,
+				p99Secs 	= None,
+				maxSecs 	= None,
+				retries 	= 0,
+				escalations	= 0,
+				jams 		= 0,
+				swapsAvoided= 0,
+				purgeMm 	= 0.0,
+				purgeSecs 	= 0.0
+			)
+
+	#
+	# Adds a finished tool change (duration in seconds, number of attempts needed)
+	#
+	def tool_change(self, inst, tool, duration, attempts=1):
+		with self._lock:
+			if not self._job:
+				return
+			key = "{0}:{1}".format(inst, tool)
+			self._job["toolChanges"] += 1
+			self._job["perTool"][key] = self._job["perTool"].get(key, 0) + 1
+			self._job["retries"] += max(0, attempts-1)
+			self._durations.append(duration)
+
+	def escalation(self):
+		with self._lock:
+			if self._job:
+				self._job["escalations"] += 1
+
+	def jam(self):
+		with self._lock:
+			if self._job:
+				self._job["jams"] += 1
+
+	#
+	# A tool change has been avoided by routing it to the other SMuFF
+	#
+	def swap_avoided(self):
+		with self._lock:
+			if self._job:
+				self._job["swapsAvoided"] += 1
+
+	#
+	# Adds a purge (length in mm, feed rate in mm/min as used in G1)
+	#
+	def purge(self, length, feedrate):
+		try:
+			length = float(length)
+			secs = length / (float(feedrate) / 60.0) if feedrate else 0.0
+		except (TypeError, ValueError, ZeroDivisionError):
+			return
+		with self._lock:
+			if self._job:
+				self._job["purgeMm"] += length
+				self._job["purgeSecs"] += secs
+
+	#
+	# Time the job is put on hold for a tool change
+	#
+	def hold_start(self):
+		with self._lock:
+			if self._job and self._holdStart == None:
+				self._holdStart = time.monotonic()
+
+	def hold_stop(self):
+		with self._lock:
+			if self._job and self._holdStart != None:
+				self._job["holdSecs"] += time.monotonic() - self._holdStart
+				self._holdStart = None
+
+	#
+	# Called when the job is done, has failed or has been cancelled.
+	# Finalizes the report, stores it and returns it.
+	#
+	def finish(self, status):
+		with self._lock:
+			job = self._job
+			if not job:
+				return None
+			if self._holdStart != None:
+				job["holdSecs"] += time.monotonic() - self._holdStart
+			ordered = sorted(self._durations)
+			job["finished"] = time.time()
+			job["status"] 	= status
+			job["p50Secs"] 	= _percentile(ordered, 50)
+			job["p99Secs"] 	= _percentile(ordered, 99)
+			job["maxSecs"] 	= ordered[-1] if len(ordered) else None
+			for key in ("holdSecs", "p50Secs", "p99Secs", "maxSecs", "purgeMm", "purgeSecs"):
+				if job[key] != None:
+					job[key] = round(job[key], 2)
+			self.jobs.append(job)
+			self._job = None
+			self._durations = []
+			self._holdStart = None
+		self._save(job)
+		self._log.info("Job '{0}' {1}: {2} tool change(s), {3} retries, {4} jam(s), on hold for {5} secs.".format(job["name"], status, job["toolChanges"], job["retries"], job["jams"], job["holdSecs"]))
+		return job
+
+	#
+	# Returns the reports of the last jobs (newest first)
+	#
+	def get_jobs(self, limit=10):
+		with self._lock:
+			jobs = list(self.jobs)
+		jobs.reverse()
+		return jobs[:limit] if limit else jobs
+
+	#
+	# Loads the most recent job reports (if any)
+	#
+	def load(self):
+		if not self._fileName or not os.path.isfile(self._fileName):
+			return
+		try:
+			with open(self._fileName, "r") as f:
+				lines = deque(f, maxlen=MAX_JOBS_KEPT)
+			with self._lock:
+				for line in lines:
+					if line.strip():
+						self.jobs.append(json.loads(line))
+		except Exception as err:
+			self._log.error("Can't load job reports from '{0}':\n\t{1}".format(self._fileName, err))
+
+	def _save(self, job):
+		if not self._fileName:
+			return
+		try:
+			with open(self._fileName, "a") as f:
+				f.write(json.dumps(job, separators=(",", ":")) + "\n")
+		except Exception as err:
+			self._log.error("Can't save job report to '{0}':\n\t{1}".format(self._fileName, err))
@@ -0,0 +1,123 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF non-blocking logging
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Hands the log records of the SMuFF logger over to a background writer
+# thread, so that neither the serial reader nor OctoPrint's comm thread
+# have to wait for file I/O. Messages get formatted lazily (in the writer
+# thread) and chatty categories can be sampled.
+
+from itertools import count
+from threading import Lock
+
+import logging
+import logging.handlers
+import queue
+
+from . import smuff_core
+
+# Categories passed along with the log records (see smuff_core.LOG_*)
+CAT_SERIAL 		= smuff_core.LOG_SERIAL["smuffCat"]
+CAT_CMD 		= smuff_core.LOG_CMD["smuffCat"]
+
+QUEUE_SIZE 		= 10000 				# max. number of records waiting for the writer
+
+#
+# Lets pass only every n-th record of a category. Warnings and errors always pass.
+#
+class SamplingFilter(logging.Filter):
+
+	def __init__(self, rates=None):
+		super().__init__()
+		self._lock 		= Lock()
+		self._counters 	= {}
+		self.rates 		= rates if rates != None else {}	# category -> n
+		self.dropped 	= 0
+
+	def filter(self, record):
+		if record.levelno >= logging.WARNING:
+			return True
+		cat = getattr(record, "smuffCat", None)
+		rate = self.rates.get(cat, 1) if cat != None else 1
+		if rate <= 1:
+			return True
+		with self._lock:
+			counter = self._counters.get(cat)
+			if counter == None:
+				counter = count()
+				self._counters[cat] = counter
+			passed = next(counter) % rate == 0
+			if not passed:
+				self.dropped += 1
+		return passed
+
+#
+# Queue handler that doesn't format the message in the calling thread
+#
+class LazyQueueHandler(logging.handlers.QueueHandler):
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			# rather lose a record than block the serial reader
+			pass
+
+	def prepare(self, record):
+		return record
+
+#
+# Forwards the records coming from the queue to the handlers of the parent logger
+#
+class _ParentHandler(logging.Handler):
+
+	def __init__(self, parent):
+		super().__init__()
+		self._parent = parent
+
+	def emit(self, record):
+		self._parent.handle(record)
+
+class AsyncLogging():
+
+	def __init__(self, logger):
+		self._log 		= logger
+		self._listener 	= None
+		self._handler 	= None
+		self.sampler 	= SamplingFilter()
+
+	@property
+	def active(self):
+		return self._listener != None
+
+	#
+	# Routes all records of the SMuFF logger through the background writer
+	#
+	def start(self):
+		if self._listener:
+			return
+		parent = self._log.parent if self._log.parent else logging.getLogger()
+		logQueue = queue.Queue(QUEUE_SIZE)
+		self._handler = LazyQueueHandler(logQueue)
+		self._handler.addFilter(self.sampler)
+		self._listener = logging.handlers.QueueListener(logQueue, _ParentHandler(parent))
+		self._listener.start()
+		self._log.addHandler(self._handler)
+		self._log.propagate = False
+
+	#
+	# Back to synchronous logging (writes the records still queued first)
+	#
+	def stop(self):
+		if not self._listener:
+			return
+		self._log.removeHandler(self._handler)
+		self._log.propagate = True
+		self._listener.stop()
+		self._listener = None
+		self._handler = None
@@ -0,0 +1,140 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF overlapped tool change phases
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Cuts the current filament (G12 C) while the printer is still busy with
+# the 'beforeToolChange' script, so that the tool change command doesn't
+# have to wait for the Cutter. The cut starts when '@SMuFF PRECUT' gets
+# sent to the printer, which has to be put into the script after the
+# retraction, right behind a M400:
+#
+#	G1 E-2 F2400
+#	M400
+#	@SMuFF PRECUT
+#	(park moves)
+#
+# OctoPrint sends the marker only after the M400 has been acknowledged, so
+# the printer has stopped extruding and retracted by then; the park moves
+# overlap with the cut. Unloading the filament is left to the tool change
+# command, since the printer might still hold it. Each phase is recorded
+# as a time span, the time gained per tool change is derived from them.
+
+from collections import deque
+from threading import Lock, Thread
+
+import time
+
+from . import smuff_core
+
+MAX_SPANS 		= 50 					# number of tool changes whose spans are kept
+
+# Phases recorded
+P_CUT 			= "cut"					# SMuFF cutting while the printer runs the rest of beforeToolChange
+P_SCRIPT 		= "script"				# @SMuFF PRECUT sent -> @SMuFF LOAD reached
+P_WAIT 			= "wait"				# @SMuFF LOAD waiting for the cut to finish
+
+class ToolChangeOverlap():
+
+	def __init__(self, logger):
+		self._log 		= logger
+		self._lock 		= Lock()
+		self._pending 	= {}			# instance -> dict(thread, start, end, ok)
+		self.spans 		= deque(maxlen=MAX_SPANS)	# phases (name -> (start, end)) per tool change
+		self.overlapped	= 0 			# tool changes with the cut overlapped
+		self.fallbacks 	= 0 			# tool changes where an interlock prevented the overlap
+		self.savedSecs 	= 0.0 			# time gained in total
+
+	#
+	# Safety interlocks: the SMuFF must be idle, have a Cutter and the filament in
+	# its feeder. With a direct drive extruder (DDE) the printer's extruder still
+	# holds the filament, so it isn't cut before the SMuFF has taken it back.
+	#
+	def can_start(self, instance):
+		return instance.isConnected and instance.hasCutter and not instance.isProcessing and not instance.isJammed and instance.feeder and not (instance.isDDE and instance.feeder2)
+
+	#
+	# Called when @SMuFF PRECUT has been sent to the printer. Returns True if
+	# the cut has been started.
+	#
+	def start(self, instance):
+		if not self.can_start(instance):
+			with self._lock:
+				self.fallbacks += 1
+			self._log.info("Tool change not overlapped (Cutter: {0}, Feeder: {1}, Feeder2: {2}, DDE: {3}, jammed: {4})".format(instance.hasCutter, instance.feeder, instance.feeder2, instance.isDDE, instance.isJammed))
+			return False
+		phase = dict(start=time.monotonic(), end=None, ok=False)
+		phase["thread"] = Thread(target=self._cut, args=(instance, phase), name="TPrecut")
+		phase["thread"].daemon = True
+		with self._lock:
+			if instance in self._pending:
+				# the last cut hasn't been consumed by a tool change
+				self.fallbacks += 1
+				self._log.warning("Tool change not overlapped, a cut in advance is still pending")
+				return False
+			self._pending[instance] = phase
+		phase["thread"].start()
+		return True
+
+	def _cut(self, instance, phase):
+		try:
+			instance.set_states_mode(smuff_core.STATES_FAST)
+			phase["ok"] = instance.send_SMuFF_request(smuff_core.CUT).ok and not instance.isJammed
+		except Exception as err:
+			self._log.error("Cutting in advance has thrown an exception:\n\t{0}".format(err))
+		phase["end"] = time.monotonic()
+
+	def pending(self, instance):
+		return instance in self._pending
+
+	#
+	# Called when @SMuFF LOAD is reached. Waits for the cut to finish and
+	# returns True if the filament has been cut, False if it has failed (the
+	# tool change command cuts on its own then).
+	#
+	def finish(self, instance, timeout):
+		with self._lock:
+			phase = self._pending.pop(instance, None)
+		if phase == None:
+			return False
+		loadStart = time.monotonic()
+		phase["thread"].join(timeout)
+		waited = time.monotonic()
+		if phase["end"] == None:
+			self._log.warning("Cutting in advance hasn't finished within {0} secs.".format(timeout))
+			phase["end"] = waited
+		ok = phase["ok"]
+		saved = max(0.0, min(phase["end"], loadStart) - phase["start"]) if ok else 0.0
+		with self._lock:
+			self.spans.append({ P_CUT: (phase["start"], phase["end"]), P_SCRIPT: (phase["start"], loadStart), P_WAIT: (loadStart, waited) })
+			if ok:
+				self.overlapped += 1
+				self.savedSecs += saved
+			else:
+				self.fallbacks += 1
+		self._log.info("Cut {0} after {1:.2f} secs., {2:.2f} secs. gained".format("done" if ok else "failed", phase["end"] - phase["start"], saved))
+		return ok
+
+	#
+	# Called when the job has ended (i.e. cancelled between PRECUT and LOAD).
+	# Drops the cuts pending, the next tool change mustn't rely on them.
+	#
+	def discard(self):
+		with self._lock:
+			phases = list(self._pending.values())
+			self._pending.clear()
+		if phases:
+			self._log.info("Dropped {0} pending cut(s) in advance".format(len(phases)))
+
+	def get_stats(self):
+		with self._lock:
+			return dict(
+				overlapped 	= self.overlapped,
+				fallbacks	= self.fallbacks,
+				savedSecs 	= round(self.savedSecs, 2),
+				avgSavedSecs= round(self.savedSecs / self.overlapped, 2) if self.overlapped else None
+			)
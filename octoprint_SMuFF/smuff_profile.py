@@ -0,0 +1,85 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF configuration profiles
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Applies a set of configuration parameters (a "profile") to a SMuFF in one
+# go: only the parameters that differ from the current configuration get
+# sent (pipelined M205 commands), the result gets verified by reading back
+# the configuration once (M503).
+
+import json
+import time
+
+from . import smuff_core
+
+DEF_WINDOW 		= 4 					# number of M205 commands in flight
+
+#
+# Compares a profile value with the value reported by the SMuFF
+#
+def _same(expected, actual):
+	if actual == None:
+		return False
+	try:
+		return float(expected) == float(actual)
+	except (TypeError, ValueError):
+		return str(expected).lower() == str(actual).lower()
+
+def _format_value(value):
+	if isinstance(value, bool):
+		return "1" if value else "0"
+	return str(value)
+
+#
+# Loads a profile from a JSON string or file (a dictionary is returned as is)
+#
+def load_profile(profile):
+	if isinstance(profile, dict):
+		return profile
+	if profile.lstrip().startswith(smuff_core.R_JSON):
+		return json.loads(profile)
+	with open(profile, "r") as f:
+		return json.load(f)
+
+#
+# Sends all parameters of the profile that have changed and verifies them.
+# Returns a report with the state of each parameter and the time elapsed.
+#
+def apply_profile(core, profile, window=DEF_WINDOW, force=False):
+	startTime = time.monotonic()
+	profile = load_profile(profile)
+	params = {}
+	pending = []
+	for name, value in profile.items():
+		previous = core.config.find(name)
+		mustSend = force or not _same(value, previous)
+		params[name] = dict(value=value, previous=previous, sent=mustSend, ack=None, actual=previous, ok=not mustSend)
+		if mustSend:
+			pending.append(name)
+
+	if len(pending):
+		acks = core.send_SMuFF_pipelined([ smuff_core.SETPARAM.format(name, _format_value(profile[name])) for name in pending ], window)
+		for name, ack in zip(pending, acks):
+			params[name]["ack"] = ack
+		# read back the whole configuration once and verify what has been sent
+		core.invalidate_cache()
+		core.send_SMuFF_and_wait(smuff_core.GETCONFIG_ALL)
+		for name in pending:
+			actual = core.config.find(name)
+			params[name]["actual"] = actual
+			params[name]["ok"] = params[name]["ack"] == True and _same(profile[name], actual)
+
+	failed = [ name for name, param in params.items() if not param["ok"] ]
+	return dict(
+		elapsed 	= round(time.monotonic() - startTime, 3),
+		sent		= len(pending),
+		skipped		= len(params) - len(pending),
+		failed		= failed,
+		success		= len(failed) == 0,
+		params 		= params
+	)
@@ -0,0 +1,118 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF purge matrix
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Computes the purge length for each (from, to) tool pair out of the
+# materials configured on the SMuFF (material, color, purge factor).
+# Swapping to a lighter color or to another kind of material needs more
+# purging, swapping to the same color and material almost none.
+# The matrix gets built once per configuration change.
+
+import re
+
+DEF_BASE 		= 60.0 					# purge length (in mm) for an average color change
+DEF_MIN 		= 5.0 					# minimum purge length (in mm)
+MATERIAL_FACTOR	= 1.5 					# applied when swapping between different kinds of material
+SAME_COLOR 		= 0.1 					# factor for the same color and material
+COLOR_BASE 		= 0.5 					# factor for two colors of the same lightness
+LIGHTER_FACTOR 	= 1.0 					# added per lightness step when swapping to a lighter color
+DARKER_FACTOR	= 0.25 					# added per lightness step when swapping to a darker color
+
+# Kinds of material which mix well with each other
+MATERIAL_CLASSES = {
+	"PLA": 	"PLA",	"PLA+": "PLA",	"PETG": "PETG",	"PET": "PETG",	"ABS": "ABS",	"ASA": "ABS",
+	"HIPS": "ABS",	"TPU": "TPU",	"TPE": "TPU",	"PA": "PA",		"NYLON": "PA",	"PC": "PC"
+}
+
+# Lightness (0 = black ... 1 = white) of some common color names
+COLOR_LIGHTNESS = {
+	"black": 0.0, 	"gray": 0.5, 	"grey": 0.5, 	"silver": 0.75,	"white": 1.0,	"natural": 0.9,
+	"transparent": 0.9, "clear": 0.9, "red": 0.45, 	"darkred": 0.25, "orange": 0.6, "yellow": 0.85,
+	"gold": 0.65,	"green": 0.45,	"darkgreen": 0.25, "lime": 0.75, "blue": 0.4,	"darkblue": 0.2,
+	"navy": 0.2, 	"lightblue": 0.75, "cyan": 0.75, "purple": 0.35, "violet": 0.55, "magenta": 0.6,
+	"pink": 0.8, 	"brown": 0.3, 	"beige": 0.85
+}
+
+#
+# Returns the lightness (0..1) of a color given by name or as #RRGGBB
+#
+def color_lightness(color):
+	if not color:
+		return 0.5
+	color = str(color).strip().lower()
+	match = re.match(r'^#?([0-9a-f]{6})$', color)
+	if match:
+		value = int(match.group(1), 16)
+		r, g, b = (value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff
+		return (max(r, g, b) + min(r, g, b)) / 510.0
+	return COLOR_LIGHTNESS.get(color.replace(" ", ""), 0.5)
+
+def material_class(material):
+	if not material:
+		return None
+	name = str(material).strip().upper()
+	return MATERIAL_CLASSES.get(name, name)
+
+class PurgeMatrix():
+
+	def __init__(self, base=DEF_BASE, minimum=DEF_MIN):
+		self.base 		= base		# purge length (in mm) for an average color change
+		self.minimum	= minimum	# minimum purge length (in mm)
+		self.matrix 	= []		# purge length per [from][to] tool
+		self._version 	= None		# config version the matrix has been built for
+
+	#
+	# Builds the matrix from a list of [ Material, Color, PFactor ] per tool
+	#
+	def build(self, materials, version=None):
+		tools = len(materials)
+		lightness = [ color_lightness(m[1]) for m in materials ]
+		classes = [ material_class(m[0]) for m in materials ]
+		colors = [ str(m[1]).strip().lower() for m in materials ]
+		pfactors = [ self._pfactor(m[2]) for m in materials ]
+		matrix = []
+		for src in range(tools):
+			row = []
+			for dst in range(tools):
+				if src == dst:
+					row.append(0.0)
+					continue
+				if colors[src] == colors[dst] and classes[src] == classes[dst]:
+					factor = SAME_COLOR
+				else:
+					delta = lightness[dst] - lightness[src]
+					factor = COLOR_BASE + (LIGHTER_FACTOR * delta if delta > 0 else DARKER_FACTOR * -delta)
+				if classes[src] != classes[dst]:
+					factor *= MATERIAL_FACTOR
+				row.append(round(max(self.minimum, self.base * factor * pfactors[dst]), 1))
+			matrix.append(row)
+		self.matrix = matrix
+		self._version = version
+		return matrix
+
+	#
+	# Rebuilds the matrix only if the configuration has changed since the last build
+	#
+	def update(self, materials, version):
+		if version != self._version or len(self.matrix) != len(materials):
+			self.build(materials, version)
+
+	#
+	# Returns the purge length for swapping from one tool to another
+	# (or None if one of the tools is unknown)
+	#
+	def get(self, src, dst):
+		if src < 0 or dst < 0 or src >= len(self.matrix) or dst >= len(self.matrix):
+			return None
+		return self.matrix[src][dst]
+
+	def _pfactor(self, value):
+		try:
+			return float(value) / 100.0
+		except (TypeError, ValueError):
+			return 1.0
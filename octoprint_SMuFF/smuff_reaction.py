@@ -0,0 +1,115 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF event reactions
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Reacts on signals sent by the SMuFF (//action:WAIT, CONTINUE, ABORT and
+# a feeder jam) by pausing, resuming or cancelling the print job right
+# away and keeps track of the latency between the signal having been
+# received and the printer having paused.
+
+from collections import deque
+from threading import Lock
+
+import time
+
+from . import smuff_core
+
+MAX_LATENCIES	= 100 					# number of latency measurements kept
+
+# Signals handed over from the SMuFF core
+SIG_WAIT		= smuff_core.ACTION_WAIT
+SIG_CONTINUE	= smuff_core.ACTION_CONTINUE
+SIG_ABORT		= smuff_core.ACTION_ABORT
+SIG_JAM 		= smuff_core.SIG_JAM
+SIG_JAM_CLEARED	= smuff_core.SIG_JAM_CLEARED
+
+class EventReactor():
+
+	def __init__(self, logger, printer):
+		self._log 			= logger
+		self._printer 		= printer
+		self._lock 			= Lock()
+		self.enabled 		= True 		# if False, signals will only be logged
+		self.pauseOnJam 	= True		# pause the print as soon as a jam gets reported
+		self.pausedBySmuff	= False 	# set when the current pause was caused by the SMuFF
+		self._pendingPause	= None		# time the signal causing the pending pause was received
+		self.dispatchLatencies 	= deque(maxlen=MAX_LATENCIES)	# signal received -> pause requested (in ms)
+		self.pauseLatencies 	= deque(maxlen=MAX_LATENCIES)	# signal received -> printer paused (in ms)
+
+	#
+	# Called from the serial reader thread of the SMuFF core
+	#
+	def on_signal(self, instance, signal, received):
+		self._log.info("SMuFF signal {0} received from {1}".format(signal, instance.serialPort))
+		if not self.enabled or self._printer == None:
+			return
+		try:
+			if signal == SIG_JAM and instance.isProcessing:
+				# a jam during a tool change is handled by the tool change retry policy
+				self._log.info("Jam reported while SMuFF is processing, leaving it to the retry policy")
+
+			elif signal == SIG_WAIT or (signal == SIG_JAM and self.pauseOnJam):
+				if self._printer.is_printing():
+					with self._lock:
+						self._pendingPause = received
+						self.pausedBySmuff = True
+					self._printer.pause_print()
+					self._add_latency(self.dispatchLatencies, received)
+
+			elif signal == SIG_CONTINUE:
+				if self.pausedBySmuff and self._printer.is_paused():
+					with self._lock:
+						self.pausedBySmuff = False
+						self._pendingPause = None
+					self._printer.resume_print()
+
+			elif signal == SIG_ABORT:
+				if self._printer.is_printing() or self._printer.is_paused() or self._printer.is_pausing():
+					with self._lock:
+						self.pausedBySmuff = False
+						self._pendingPause = None
+					self._printer.cancel_print()
+		except Exception as err:
+			self._log.error("Reacting on SMuFF signal {0} has thrown an exception:\n\t{1}".format(signal, err))
+
+	#
+	# Called when OctoPrint reports the print being paused
+	#
+	def on_paused(self):
+		with self._lock:
+			received = self._pendingPause
+			self._pendingPause = None
+		if received != None:
+			latency = self._add_latency(self.pauseLatencies, received)
+			self._log.info("Printer paused {0:.1f} ms after SMuFF signal".format(latency))
+
+	#
+	# Called when the print has been resumed, finished or cancelled from elsewhere
+	#
+	def on_released(self):
+		with self._lock:
+			self.pausedBySmuff = False
+			self._pendingPause = None
+
+	def _add_latency(self, latencies, received):
+		latency = (time.monotonic() - received) * 1000
+		with self._lock:
+			latencies.append(latency)
+		return latency
+
+	def get_stats(self):
+		with self._lock:
+			dispatch = sorted(self.dispatchLatencies)
+			pause = sorted(self.pauseLatencies)
+		return dict(
+			pausedBySmuff	= self.pausedBySmuff,
+			dispatchMaxMs	= dispatch[-1] if len(dispatch) else None,
+			pauseMedianMs	= pause[len(pause)//2] if len(pause) else None,
+			pauseMaxMs		= pause[-1] if len(pause) else None,
+			count			= len(pause)
+		)
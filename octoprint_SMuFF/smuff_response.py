@@ -0,0 +1,101 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF command responses
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# The response to a command sent to the SMuFF: the lines received before
+# the "ok", how it ended (ok / error / timeout) and how long it took.
+# The number of lines (and characters) kept is limited, so a lost "ok"
+# or a chatty firmware can't make it grow without bounds.
+
+import re
+import time
+
+MAX_LINES 		= 32 					# max. number of lines kept per response
+MAX_CHARS 		= 4096 					# max. number of characters kept per response
+
+# Response states
+RS_PENDING 		= "pending"				# still waiting for the "ok"
+RS_BUSY 		= "busy"				# still waiting, the SMuFF has reported being busy
+RS_OK 			= "ok"
+RS_ERROR 		= "error"
+RS_TIMEOUT 		= "timeout"
+RS_FAILED 		= "failed"				# couldn't be sent or the wait has been interrupted (i.e. serial error)
+
+_TOOL_RE 		= re.compile(r"^T\d+")
+
+class Response():
+	__slots__ = ("command", "lines", "status", "sent", "finished", "size", "dropped")
+
+	def __init__(self, command=None):
+		self.command 	= command 		# GCode sent (None for lines received w/o a command)
+		self.lines 		= []			# lines received before the "ok" (w/o the trailing newline)
+		self.status 	= RS_PENDING
+		self.sent 		= time.monotonic()
+		self.finished 	= None			# time the response has been completed
+		self.size 		= 0 			# number of characters kept
+		self.dropped 	= 0 			# number of lines dropped because of the limits
+
+	def add(self, line):
+		line = line.rstrip("\n")
+		if len(self.lines) >= MAX_LINES or self.size + len(line) > MAX_CHARS:
+			self.dropped += 1
+			return False
+		self.lines.append(line)
+		self.size += len(line)
+		return True
+
+	#
+	# Completes the response (only once, a late "ok" doesn't turn a timeout into success)
+	#
+	def finish(self, status):
+		if self.finished != None:
+			return False
+		self.status 	= status
+		self.finished 	= time.monotonic()
+		return True
+
+	@property
+	def done(self):
+		return self.finished != None
+
+	@property
+	def ok(self):
+		return self.status == RS_OK
+
+	@property
+	def duration(self):
+		return (self.finished if self.finished != None else time.monotonic()) - self.sent
+
+	#
+	# The lines as one string (like the SMuFF has sent them)
+	#
+	@property
+	def text(self):
+		return "\n".join(self.lines)
+
+	#
+	# The tool reported in the first line (i.e. "T3" for a tool change), None if there's none
+	#
+	@property
+	def tool(self):
+		if not self.lines:
+			return None
+		match = _TOOL_RE.match(self.lines[0])
+		return match.group(0) if match else None
+
+	def as_dict(self):
+		return dict(
+			command 	= self.command,
+			lines 		= list(self.lines),
+			status 		= self.status,
+			duration 	= round(self.duration, 3),
+			dropped 	= self.dropped
+		)
+
+	def __repr__(self):
+		return "<Response {0} {1} {2!r} ({3:.3f} secs.)>".format(self.command, self.status, self.text, self.duration)
@@ -0,0 +1,110 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF tool change retry policy
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Retries failed tool changes automatically (optionally after un-jamming
+# and unloading / reloading the filament) and escalates to a print pause
+# if all attempts have failed. Every attempt gets recorded.
+
+from collections import deque
+from threading import Lock
+
+import time
+
+from . import smuff_core
+
+MAX_ATTEMPTS_KEPT	= 100 				# number of attempt records kept
+
+# Outcome of a single attempt
+A_LOADED 		= "loaded"				# tool selected and filament loaded
+A_NOT_LOADED	= "not loaded"			# tool selected, but filament didn't make it
+A_WRONG_TOOL	= "wrong tool"			# SMuFF responded with a different tool
+A_ESCALATED		= "escalated"			# all retries failed, print has been paused
+
+# Recovery actions taken before a retry
+R_UNJAM 		= "unjam"
+R_RELOAD 		= "reload"
+R_RESEND 		= "resend"
+
+class ToolChangeRetry():
+
+	def __init__(self, logger):
+		self._log 			= logger
+		self._lock 			= Lock()
+		self.retries 		= 2 		# number of retries after the first attempt failed
+		self.unjam 			= True 		# send M562 before retrying (if jammed)
+		self.reload 		= True 		# unload (M701) / reload (M700) if the tool got selected but not loaded
+		self.backoff 		= 2.0 		# seconds to wait before the first retry (doubles with each retry)
+		self.pauseOnFail	= True		# pause the print when all retries have failed
+		self.attempts 		= deque(maxlen=MAX_ATTEMPTS_KEPT)	# record of all attempts
+		self.retryCount		= 0			# number of retries in total
+		self.escalations	= 0 		# number of escalations in total
+
+	#
+	# Returns the time to wait before the given retry (1..n)
+	#
+	def get_delay(self, retry):
+		return self.backoff * (2 ** (retry-1))
+
+	#
+	# Stores the outcome of an attempt
+	#
+	def record(self, instance, tool, attempt, outcome, action=None, duration=0.0):
+		rec = dict(
+			time 		= time.time(),
+			device		= instance.device,
+			tool 		= str(tool),
+			attempt		= attempt,
+			outcome		= outcome,
+			action		= action,
+			loadState	= instance.loadState,
+			jammed		= instance.isJammed,
+			duration	= round(duration, 2)
+		)
+		with self._lock:
+			self.attempts.append(rec)
+			if outcome == A_ESCALATED:
+				# not an attempt of its own, the last retry has been counted already
+				self.escalations += 1
+			elif attempt > 1:
+				self.retryCount += 1
+		self._log.info("Tool change attempt {0} for {1}: {2}{3}".format(attempt, tool, outcome, " (after {0})".format(action) if action else ""))
+		return rec
+
+	#
+	# Prepares the SMuFF for the next attempt and returns the recovery action
+	# taken. If the tool has been selected but not loaded, the filament gets
+	# unloaded and reloaded (which doesn't need the tool change to be resent).
+	#
+	def recover(self, instance, retry, outcome):
+		actions = []
+		if self.unjam and instance.isJammed:
+			instance.send_SMuFF_and_wait(smuff_core.UNJAM)
+			actions.append(R_UNJAM)
+		delay = self.get_delay(retry)
+		if delay > 0:
+			time.sleep(delay)
+		if outcome == A_NOT_LOADED and self.reload:
+			instance.send_SMuFF_and_wait(smuff_core.UNLOADFIL)
+			instance.send_SMuFF_and_wait(smuff_core.LOADFIL)
+			instance.wait_for_states()
+			actions.append(R_RELOAD)
+		else:
+			actions.append(R_RESEND)
+		return "+".join(actions)
+
+	def get_attempts(self, count=None):
+		with self._lock:
+			attempts = list(self.attempts)
+		return attempts if count == None else attempts[-count:]
+
+	def reset(self):
+		with self._lock:
+			self.attempts.clear()
+			self.retryCount = 0
+			self.escalations = 0
@@ -0,0 +1,175 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF tool routing (IDEX)
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# With two SMuFFs both holding the same material / color, a tool change
+# doesn't necessarily have to go to the SMuFF the tool number maps to.
+# The router picks the tool (on either SMuFF) with the same material and
+# color which is the cheapest to change to: one that's loaded already,
+# or the one with the shortest expected swap time on an idle SMuFF.
+# On a filament runout (T++ / T--) the failover picks the slot with the
+# same material and color having the most filament left.
+
+from threading import Lock
+
+from . import smuff_purge
+
+BUSY_PENALTY 	= 60.0 					# added to the expected swap time if the SMuFF is busy
+UNKNOWN_LEFT 	= -1.0 					# rank of a spool with unknown length (below any known length)
+
+#
+# Returns the key tools get grouped by: (material class, color)
+#
+def material_key(material):
+	return (smuff_purge.material_class(material[0]), str(material[1]).strip().lower())
+
+class ToolRouter():
+
+	def __init__(self, logger):
+		self._log 		= logger
+		self._lock 		= Lock()
+		self._index 	= {}			# (material class, color) -> [ (instance, slot), ... ]
+		self._tools 	= []			# (material class, color) per global tool number
+		self._version 	= None			# configuration versions the index has been built for
+		self.routed 	= 0 			# tool changes sent to another tool than requested
+		self.avoided 	= 0 			# tool changes avoided by routing
+
+	#
+	# Builds the index from the materials of both SMuFFs (only if they have changed)
+	#
+	def update(self, materialsA, materialsB, version):
+		with self._lock:
+			if version == self._version:
+				return
+			index = {}
+			tools = []
+			for inst, materials in (("A", materialsA), ("B", materialsB)):
+				for slot, material in enumerate(materials):
+					key = material_key(material)
+					index.setdefault(key, []).append((inst, slot))
+					tools.append(key)
+			self._index = index
+			self._tools = tools
+			self._version = version
+
+	def reset_stats(self):
+		with self._lock:
+			self.routed = 0
+			self.avoided = 0
+
+	#
+	# Returns the (instance, slot) to be used for the global tool number given.
+	# "cost" is a function (instance, slot) -> expected swap time, 0 if no swap is needed.
+	#
+	def route(self, tool, toolCountA, cost):
+		requested = ("A", tool) if tool < toolCountA else ("B", tool - toolCountA)
+		with self._lock:
+			if tool < 0 or tool >= len(self._tools):
+				return requested
+			candidates = self._index.get(self._tools[tool], [ requested ])
+		if len(candidates) < 2:
+			return requested
+		costs = { candidate: cost(*candidate) for candidate in candidates }
+		best = requested
+		for candidate in candidates:
+			if costs[candidate] < costs[best]:
+				best = candidate
+		if best != requested:
+			with self._lock:
+				self.routed += 1
+				if costs[best] == 0 and costs[requested] > 0:
+					self.avoided += 1
+			self._log.info("Routing T{0} to {1}:T{2} (expected {3:.1f} instead of {4:.1f} secs.)".format(tool, best[0], best[1], costs[best], costs[requested]))
+		return best
+
+class SpoolFailover():
+
+	def __init__(self, logger):
+		self._log 		= logger
+		self._lock 		= Lock()
+		self._keys 		= {}			# (instance, slot) -> material key
+		self._left 		= {}			# material key -> { (instance, slot): mm left }
+		self._best 		= {}			# material key -> the two slots with the most filament left
+		self._version 	= None			# configuration versions the index has been built for
+		self.staged 	= {}			# (instance, slot) running low -> slot to change to
+
+	#
+	# Builds the index from the materials of both SMuFFs (only if they have changed).
+	# "remaining" is a function (instance, slot) -> mm left or None if unknown.
+	#
+	def update(self, materialsA, materialsB, version, remaining):
+		with self._lock:
+			if version == self._version:
+				return
+			self._keys = {}
+			self._left = {}
+			for inst, materials in (("A", materialsA), ("B", materialsB)):
+				for slot, material in enumerate(materials):
+					key = material_key(material)
+					self._keys[(inst, slot)] = key
+					self._left.setdefault(key, {})[(inst, slot)] = self._rank(remaining(inst, slot))
+			self._best = { key: self._top(slots) for key, slots in self._left.items() }
+			self.staged = {}
+			self._version = version
+
+	#
+	# Called whenever the filament left on a spool has changed
+	#
+	def set_remaining(self, inst, slot, left):
+		with self._lock:
+			key = self._keys.get((inst, slot))
+			if key == None:
+				return
+			slots = self._left[key]
+			slots[(inst, slot)] = self._rank(left)
+			self._best[key] = self._top(slots)
+
+	#
+	# Returns the (instance, slot) to change to if the spool on the slot given runs out,
+	# None if there's no other slot with the same material and filament left.
+	#
+	def next(self, inst, slot):
+		with self._lock:
+			staged = self.staged.pop((inst, slot), None)
+			if staged != None and self._usable(self._left[self._keys[staged]].get(staged)):
+				return staged
+			return self._pick(inst, slot)
+
+	#
+	# Determines the slot to change to in advance (when the spool is running low)
+	#
+	def stage(self, inst, slot):
+		with self._lock:
+			target = self._pick(inst, slot)
+			if target != None:
+				self.staged[(inst, slot)] = target
+		if target != None:
+			self._log.info("Runout failover for {0}:T{1} staged to {2}:T{3}".format(inst, slot, target[0], target[1]))
+		return target
+
+	def _pick(self, inst, slot):
+		key = self._keys.get((inst, slot))
+		if key == None:
+			return None
+		for candidate in self._best.get(key, []):
+			if candidate != (inst, slot):
+				return candidate
+		return None
+
+	def _rank(self, left):
+		return UNKNOWN_LEFT if left == None else left
+
+	def _usable(self, left):
+		return left != None and (left > 0 or left == UNKNOWN_LEFT)
+
+	#
+	# The two slots with the most filament left (empty ones excluded)
+	#
+	def _top(self, slots):
+		ranked = sorted((left, candidate) for candidate, left in slots.items() if self._usable(left))
+		return [ candidate for _, candidate in reversed(ranked[-2:]) ]
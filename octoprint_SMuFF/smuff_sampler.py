@@ -0,0 +1,122 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF sampling profiler
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Samples the stacks of the SMuFF threads (serial reader, watchdog, API
+# workers, ...) and OctoPrint's comm threads (which run the GCode hooks)
+# for a given time, so slowdowns can be diagnosed on the live printer.
+# The samples are written as collapsed stacks ("thread;frame;frame count"
+# per line), which flamegraph.pl / speedscope can read. Nothing runs and
+# nothing is hooked in while the profiler is off.
+
+from collections import Counter
+from threading import Event, Lock, Thread
+
+import os
+import sys
+import threading
+import time
+
+DEF_RATE 		= 100 					# samples per second
+MAX_RATE 		= 1000
+MAX_SECS 		= 600 					# max. time a profiling run may take
+MAX_DEPTH 		= 64 					# max. number of frames per stack
+TOP_FUNCS 		= 5 					# number of functions listed in the summary
+
+# Names (prefixes) of the threads sampled by default
+THREADS 		= ( "TReader", "TWatchdog", "TConnect", "TReconnect", "TStatesMode", "TApi", "TUnload", "comm." )
+
+class StackSampler():
+
+	def __init__(self, logger):
+		self._log 		= logger
+		self._lock 		= Lock()
+		self._thread 	= None
+		self._stop 		= Event()
+		self.threads 	= THREADS
+		self.last 		= None			# result of the last run
+
+	@property
+	def running(self):
+		return self._thread != None and self._thread.is_alive()
+
+	#
+	# Starts sampling for 'seconds' in the background. doneCB gets called with
+	# the result when done. Returns False if a run is in progress already.
+	#
+	def start(self, seconds, rate=DEF_RATE, fileName=None, doneCB=None):
+		with self._lock:
+			if self.running:
+				return False
+			seconds = max(0.1, min(float(seconds), MAX_SECS))
+			rate = max(1, min(int(rate), MAX_RATE))
+			self._stop.clear()
+			self._thread = Thread(target=self._run, args=(seconds, rate, fileName, doneCB), name="TSampler")
+			self._thread.daemon = True
+			self._thread.start()
+		self._log.info("Profiling SMuFF threads for {0} secs. at {1} samples/sec.".format(seconds, rate))
+		return True
+
+	def stop(self):
+		self._stop.set()
+
+	def _run(self, seconds, rate, fileName, doneCB):
+		stacks = Counter()
+		own = Counter()
+		samples = 0
+		me = threading.get_ident()
+		start = time.monotonic()
+		cpuStart = time.process_time()
+		endTime = start + seconds
+		interval = 1.0 / rate
+		while not self._stop.is_set() and time.monotonic() < endTime:
+			names = { thread.ident: thread.name for thread in threading.enumerate() if thread.name.startswith(self.threads) }
+			for ident, frame in sys._current_frames().items():
+				name = names.get(ident)
+				if name == None or ident == me:
+					continue
+				stack = []
+				while frame != None and len(stack) < MAX_DEPTH:
+					code = frame.f_code
+					stack.append("{0}:{1}:{2}".format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+					frame = frame.f_back
+				if stack:
+					own[stack[0].rsplit(":", 1)[0]] += 1
+				stack.append(name)
+				stacks[";".join(reversed(stack))] += 1
+			frame = None 			# don't keep the frames alive until the next sample
+			samples += 1
+			self._stop.wait(interval)
+		elapsed = time.monotonic() - start
+		result = dict(
+			seconds 	= round(elapsed, 2),
+			samples 	= samples,
+			stacks 		= len(stacks),
+			# CPU usage of the whole process while sampling (the profiler included)
+			cpuPct 		= round((time.process_time() - cpuStart) / elapsed * 100, 1) if elapsed > 0 else None,
+			top 		= [ (func, count) for func, count in own.most_common(TOP_FUNCS) ],
+			fileName 	= None
+		)
+		if fileName and stacks:
+			try:
+				with open(fileName, "w") as f:
+					for stack, count in sorted(stacks.items()):
+						f.write("{0} {1}\n".format(stack, count))
+				result["fileName"] = fileName
+			except Exception as err:
+				self._log.error("Can't write profile to '{0}':\n\t{1}".format(fileName, err))
+		self.last = result
+		self._log.info("Profiling done: {0} samples, {1} stacks in {2} secs., written to {3}".format(samples, len(stacks), result["seconds"], result["fileName"]))
+		if doneCB:
+			try:
+				doneCB(result)
+			except Exception as err:
+				self._log.error("Profiler callback has thrown an exception:\n\t{0}".format(err))
+
+	def get_stats(self):
+		return dict(running=self.running, threads=list(self.threads), last=self.last)
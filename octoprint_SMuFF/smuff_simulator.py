@@ -0,0 +1,233 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF simulator
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Simulates a SMuFF on a pseudo terminal (pty), so the plugin can talk to
+# it like to the real device (through /dev/pts/n). Answers tool changes,
+# loads / unloads, configuration and firmware queries and sends the
+# periodical states. Tool changes take a configurable time and may fail
+# on purpose (filament not loaded) to exercise the retries. A hung SMuFF
+# can be simulated as well (the port opens, but nothing gets answered).
+#
+# Standalone (i.e. for testing with a terminal program):
+#	python -m octoprint_SMuFF.smuff_simulator [--tools 5] [--tc-secs 0.5]
+
+from threading import Lock, Event, Thread
+
+import argparse
+import os
+import queue
+import random
+import select
+import sys
+import time
+import tty
+
+from . import smuff_config
+
+FW_INFO 		= "FIRMWARE_NAME: Smart.Multi.Filament.Feeder (SMuFF) FIRMWARE_VERSION: 3.00 ELECTRONICS: SIMULATOR DATE: 2022-06-22 MODE: NORMAL OPTIONS: SIMULATED"
+STATES 			= "echo: states: T: {0} S: {1} R: off F: {2} F2: off TMC: -off SD: off SC: off LID: on I: {3} SPL: {4} JAM: off"
+
+# M503 S<n> categories
+CATEGORIES 		= {
+	1: smuff_config.C_BASIC,
+	2: smuff_config.C_STEPPERS,
+	3: smuff_config.C_TMC,
+	4: smuff_config.C_SERVOMAPS,
+	5: smuff_config.C_MATERIALS,
+	6: smuff_config.C_SWAPS,
+	8: smuff_config.C_FEEDSTATE
+}
+
+class SmuffSimulator():
+
+	def __init__(self, tools=5, tcSecs=0.5, cmdSecs=0.0, failRate=0.0, seed=None, hung=False):
+		self.tools 		= tools
+		self.tcSecs 	= tcSecs 		# duration of a tool change (in seconds)
+		self.cmdSecs 	= cmdSecs 		# duration of any other command
+		self.failRate 	= failRate 		# probability of a tool change not loading the filament
+		self.hung 		= hung 			# never answers (like a SMuFF that's stuck), the port opens though
+		self.port 		= None 			# name of the pty the plugin has to open
+		self.tool 		= 0
+		self.loaded 	= True
+		self.idle 		= True
+		self.interval 	= 0 			# periodical states interval (in seconds, 0 = off)
+		self.commands 	= 0 			# number of commands received
+		self.toolChanges= 0
+		self.failures 	= 0
+		self._random 	= random.Random(seed)
+		self._json 		= smuff_config._bench_json(tools)
+		self._master 	= None
+		self._slave 	= None
+		self._lock 		= Lock()
+		self._queue 	= queue.Queue()
+		self._stop 		= Event()
+		self._threads 	= []
+
+	def start(self):
+		self._master, self._slave = os.openpty()
+		tty.setraw(self._slave)
+		self.port = os.ttyname(self._slave)
+		self._stop.clear()
+		for target, name in [ (self._reader, "TSimReader"), (self._worker, "TSimWorker"), (self._states, "TSimStates") ]:
+			thread = Thread(target=target, name=name)
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+		return self.port
+
+	def stop(self):
+		self._stop.set()
+		self._queue.put(None)
+		for thread in self._threads:
+			thread.join(1.0)
+		self._threads = []
+		for fd in [ self._master, self._slave ]:
+			try:
+				os.close(fd)
+			except (OSError, TypeError):
+				pass
+		self._master = self._slave = None
+
+	def _write(self, *lines):
+		data = "".join([ line + "\n" for line in lines ]).encode("ascii")
+		with self._lock:
+			try:
+				os.write(self._master, data)
+			except (OSError, TypeError):
+				pass
+
+	def _send_states(self):
+		self._write(STATES.format(
+			"T{0}".format(self.tool) if self.tool >= 0 else "-1",
+			"on" if self.tool >= 0 else "off",
+			"on" if self.loaded else "off",
+			"on" if self.idle else "off",
+			2 if self.loaded else 0))
+
+	#
+	# Reads the commands sent by the plugin (line by line)
+	#
+	def _reader(self):
+		buffer = b""
+		while not self._stop.is_set():
+			try:
+				ready, _, _ = select.select([ self._master ], [], [], 0.2)
+				if not ready:
+					continue
+				data = os.read(self._master, 4096)
+			except (OSError, TypeError, ValueError):
+				break
+			if not data:
+				break
+			buffer += data
+			while b"\n" in buffer:
+				line, buffer = buffer.split(b"\n", 1)
+				line = line.decode("ascii", errors="ignore").strip()
+				if line and not self.hung:
+					self._queue.put(line)
+
+	#
+	# Processes the commands one after another, like the SMuFF does
+	#
+	def _worker(self):
+		while not self._stop.is_set():
+			line = self._queue.get()
+			if line == None:
+				break
+			self.commands += 1
+			try:
+				self._process(line)
+			except Exception as err:
+				self._write("error: {0}".format(err), "ok")
+
+	def _process(self, line):
+		if line.startswith("//action:"):
+			return
+		cmd = line.split(" ", 1)[0]
+		params = line[len(cmd):].strip()
+		if cmd.startswith("T"):
+			self._tool_change(cmd)
+			return
+		self._write(cmd)
+		if cmd == "M155":
+			interval = params[1:] if params.startswith("S") else "1"
+			self.interval = int(interval) if interval.isdigit() else 1
+		elif cmd == "M115":
+			self._write(FW_INFO)
+		elif cmd == "M503":
+			category = params[1:].rstrip("W") if params.startswith("S") else ""
+			categories = [ CATEGORIES[int(category)] ] if category.isdigit() and int(category) in CATEGORIES else CATEGORIES.values()
+			for name in categories:
+				self._write("/* {0} */".format(name), self._json[name])
+		elif cmd in ("M700", "M701"):
+			self._busy(self.tcSecs / 2)
+			self.loaded = cmd == "M700"
+			self._send_states()
+		else:
+			self._busy(self.cmdSecs)
+		self._write("ok")
+
+	def _tool_change(self, cmd):
+		try:
+			tool = int(cmd[1:])
+		except ValueError:
+			self._write("error: Unknown command: {0}".format(cmd), "ok")
+			return
+		if tool < 0 or tool >= self.tools:
+			self._write("error: Tool {0} exceeds {1} tools".format(tool, self.tools), "ok")
+			return
+		self.toolChanges += 1
+		self.loaded = False
+		self._send_states()
+		self._busy(self.tcSecs)
+		self.tool = tool
+		self.loaded = self._random.random() >= self.failRate
+		if not self.loaded:
+			self.failures += 1
+		self._send_states()
+		self._write(cmd, "ok")
+
+	def _busy(self, secs):
+		if secs <= 0:
+			return
+		self.idle = False
+		self._stop.wait(secs)
+		self.idle = True
+
+	#
+	# Sends the periodical states (if turned on by M155)
+	#
+	def _states(self):
+		while not self._stop.is_set():
+			if self.interval > 0:
+				self._send_states()
+				self._stop.wait(self.interval)
+			else:
+				self._stop.wait(0.2)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Simulate a SMuFF on a pseudo terminal")
+	parser.add_argument("--tools", type=int, default=5)
+	parser.add_argument("--tc-secs", type=float, default=0.5, help="duration of a tool change (in seconds)")
+	parser.add_argument("--fail-rate", type=float, default=0.0, help="probability of a failing tool change")
+	args = parser.parse_args(argv)
+
+	simulator = SmuffSimulator(args.tools, args.tc_secs, failRate=args.fail_rate)
+	print("SMuFF simulator listening on {0} (Ctrl-C to stop)".format(simulator.start()))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	simulator.stop()
+	print("{0} command(s), {1} tool change(s), {2} failure(s)".format(simulator.commands, simulator.toolChanges, simulator.failures))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,179 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF persistent device state
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Keeps the last known state of a SMuFF (tool, load state, configuration,
+# counters) in a file, so that it's known right after OctoPrint has been
+# restarted (i.e. mid-print) instead of waiting for the SMuFF to report.
+# The file only gets written if something has changed, always to a temp.
+# file first which then replaces the old one, so a crash can't leave a
+# half written file behind. Writing is done by a background thread which
+# collects the changes for a moment (a tool change flips the feeder and
+# load state several times), so the serial reader never waits for the
+# disk. The restored state is checked against the first periodical states
+# received from the SMuFF.
+
+from threading import Event, Lock, Thread
+
+import json
+import os
+import time
+
+# Attributes of a SmuffCore instance persisted
+FIELDS 			= ( "curTool", "preTool", "loadState", "feeder", "feeder2", "toolCount", "device", "fwInfo", "tcCount", "durationTotal" )
+DEBOUNCE 		= 1.0 					# time changes are collected before writing (in seconds)
+
+class DeviceState():
+
+	def __init__(self, logger, fileName):
+		self._log 		= logger
+		self._fileName 	= fileName
+		self._lock 		= Lock()
+		self._last 		= None			# snapshot last written
+		self._config 	= {}			# last JSON string per configuration category
+		self._configVersion = None		# version of the configuration in _config
+		self._pending 	= None			# data waiting to be written
+		self._wakeup 	= Event()
+		self._stop 		= Event()
+		self._writer 	= None
+		self.debounce 	= DEBOUNCE
+		self.extra 		= {}			# additional values (set by the plugin)
+		self.restored 	= None			# values restored, until they've been checked against the SMuFF
+		self.savedAt 	= None			# time (since the epoch) the state restored has been saved
+		self.writes 	= 0 			# number of times the file has been written
+
+	#
+	# Takes over the state saved into the instance (before connecting to the SMuFF).
+	# Returns True if there was a state to restore.
+	#
+	def restore(self, instance):
+		data = self._load()
+		if data == None:
+			return False
+		values = data.get("state", {})
+		for name in FIELDS:
+			if name in values:
+				setattr(instance, name, values[name])
+		for category, raw in data.get("config", {}).items():
+			try:
+				if instance.config.update(category, raw):
+					instance._apply_config(category)
+				self._config[category] = raw
+			except Exception as err:
+				self._log.error("Can't restore configuration category '{0}':\n\t{1}".format(category, err))
+		with self._lock:
+			self.extra 		= data.get("extra", {})
+			self.restored 	= values
+			self.savedAt 	= data.get("saved")
+		self._log.info("Restored SMuFF state from '{0}' (tool: {1}, load state: {2}, saved {3:.0f} secs. ago)".format(self._fileName, instance.curTool, instance.loadState, time.time() - (self.savedAt or time.time())))
+		return True
+
+	#
+	# Called on the first periodical states after the state has been restored
+	#
+	def reconcile(self, instance):
+		with self._lock:
+			restored = self.restored
+			self.restored = None
+		if restored == None:
+			return True
+		diffs = [ "{0}: {1} -> {2}".format(name, restored[name], getattr(instance, name)) for name in ("curTool", "loadState", "feeder", "feeder2") if name in restored and restored[name] != getattr(instance, name) ]
+		if diffs:
+			self._log.warning("SMuFF state has changed while OctoPrint was down ({0})".format(", ".join(diffs)))
+		else:
+			self._log.info("Restored SMuFF state confirmed (tool: {0})".format(instance.curTool))
+		self.update(instance)
+		return not diffs
+
+	#
+	# Hands the state of the instance over to the writer if it has changed since the
+	# last time. Cheap enough to be called on each periodical states received.
+	#
+	def update(self, instance):
+		version = instance.config.version
+		snapshot = tuple([ getattr(instance, name) for name in FIELDS ]) + (version,)
+		with self._lock:
+			snapshot += tuple(sorted(self.extra.items()))
+			if snapshot == self._last:
+				return False
+			self._last = snapshot
+			if version != self._configVersion:
+				# the configuration is missing while it's being queried again, keep the last one
+				self._config.update(instance.config.get_raw())
+				self._configVersion = version
+			self._pending = dict(
+				saved 	= time.time(),
+				state 	= { name: getattr(instance, name) for name in FIELDS },
+				config 	= dict(self._config),
+				extra 	= dict(self.extra)
+			)
+			if self._writer == None:
+				self._writer = Thread(target=self._write_loop, name="TStateWriter")
+				self._writer.daemon = True
+				self._writer.start()
+		self._wakeup.set()
+		return True
+
+	def set_extra(self, instance, **values):
+		with self._lock:
+			self.extra.update(values)
+		return self.update(instance)
+
+	#
+	# Writes the pending state (the last one, if it has changed again meanwhile)
+	#
+	def _write_loop(self):
+		while not self._stop.is_set():
+			self._wakeup.wait()
+			self._stop.wait(self.debounce)
+			self._wakeup.clear()
+			with self._lock:
+				data, self._pending = self._pending, None
+			if data != None:
+				self._write(json.dumps(data))
+
+	#
+	# Stops the writer, the pending state gets written before
+	#
+	def stop(self):
+		self._stop.set()
+		self._wakeup.set()
+		if self._writer:
+			self._writer.join(2.0)
+		with self._lock:
+			data, self._pending = self._pending, None
+		if data != None:
+			self._write(json.dumps(data))
+
+	#
+	# Write to a temp. file first, then replace the old one
+	#
+	def _write(self, data):
+		try:
+			tmpName = self._fileName + ".tmp"
+			with open(tmpName, "w") as f:
+				f.write(data)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmpName, self._fileName)
+			self.writes += 1
+			return True
+		except Exception as err:
+			self._log.error("Can't save SMuFF state to '{0}':\n\t{1}".format(self._fileName, err))
+		return False
+
+	def _load(self):
+		if not self._fileName or not os.path.isfile(self._fileName):
+			return None
+		try:
+			with open(self._fileName, "r") as f:
+				data = json.load(f)
+			return data if isinstance(data, dict) else None
+		except Exception as err:
+			self._log.error("Can't load SMuFF state from '{0}':\n\t{1}".format(self._fileName, err))
+		return None
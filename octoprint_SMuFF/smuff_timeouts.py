@@ -0,0 +1,144 @@
+#---------------------------------------------------------------------------------------------
+# SMuFF adaptive command timeouts
+#---------------------------------------------------------------------------------------------
+#
+# Copyright (C) 2020-2022 Technik Gegg <technik.gegg@gmail.com>
+#
+# This file may be distributed under the terms of the GNU AGPLv3 license.
+#
+#
+# Keeps track of the latencies the SMuFF shows for each class of command
+# (tool changes, M503, G12, ...) and derives a deadline from the observed
+# p99 latency, so that a hung command gets detected as early as the
+# collected data allows.
+
+from collections import deque
+from threading import Lock
+
+import json
+import math
+import os
+
+TC_CLASS 		= "T"					# command class used for all tool changes
+MAX_SAMPLES 	= 200 					# number of samples kept per command class
+MIN_SAMPLES 	= 20 					# number of samples needed before adapting the timeout
+DEF_FACTOR 		= 2.0 					# safety factor applied to the p99 latency
+FLOOR_CMD 		= 5.0 					# lowest timeout for commands (in seconds)
+FLOOR_TC 		= 20.0 					# lowest timeout for tool changes (in seconds)
+SAVE_EVERY 		= 10 					# persist the samples after this many new samples
+
+class AdaptiveTimeouts():
+
+	def __init__(self, logger, fileName=None, factor=DEF_FACTOR):
+		self._log 		= logger
+		self._fileName 	= fileName		# file the samples are persisted in
+		self._lock 		= Lock()
+		self._samples 	= {}			# deque of latencies (in seconds) per command class
+		self._unsaved 	= 0 			# number of samples not persisted yet
+		self.factor 	= factor		# safety factor applied to the p99 latency
+		self.enabled 	= True 			# if False, the static timeouts will be used
+		self.load()
+
+	#
+	# Returns the command class of the GCode sent to the SMuFF (i.e. "T", "M503", "G12")
+	#
+	def get_class(self, data):
+		if data.startswith(TC_CLASS):
+			return TC_CLASS
+		return data.split(" ", 1)[0].upper()
+
+	#
+	# Returns the p-th percentile (0..100) of the samples of a command class
+	# or None if there are not enough samples yet
+	#
+	def percentile(self, cmdClass, p=99):
+		with self._lock:
+			samples = self._samples.get(cmdClass)
+			if samples == None or len(samples) < MIN_SAMPLES:
+				return None
+			ordered = sorted(samples)
+		index = min(len(ordered)-1, int(math.ceil(p / 100.0 * len(ordered))) - 1)
+		return ordered[max(index, 0)]
+
+	#
+	# Returns the timeout to be used for the command class given.
+	# The static timeout acts as the ceiling (and as the fallback as long
+	# as there's not enough data for the command class).
+	#
+	def get_timeout(self, cmdClass, static):
+		if not self.enabled:
+			return static
+		p99 = self.percentile(cmdClass)
+		if p99 == None:
+			return static
+		floor = FLOOR_TC if cmdClass == TC_CLASS else FLOOR_CMD
+		return min(static, max(floor, p99 * self.factor))
+
+	#
+	# Adds the latency (in seconds) of a successfully finished command
+	#
+	def add_sample(self, cmdClass, latency):
+		with self._lock:
+			samples = self._samples.get(cmdClass)
+			if samples == None:
+				samples = deque(maxlen=MAX_SAMPLES)
+				self._samples[cmdClass] = samples
+			samples.append(round(latency, 3))
+			self._unsaved += 1
+			mustSave = self._unsaved >= SAVE_EVERY
+		if mustSave:
+			self.save()
+
+	#
+	# Returns a summary (count, p50, p99) for each command class
+	#
+	def get_stats(self):
+		with self._lock:
+			classes = list(self._samples.keys())
+		stats = {}
+		for cmdClass in classes:
+			stats[cmdClass] = dict(
+				count 	= len(self._samples[cmdClass]),
+				p50 	= self.percentile(cmdClass, 50),
+				p99 	= self.percentile(cmdClass, 99)
+			)
+		return stats
+
+	def reset(self):
+		with self._lock:
+			self._samples = {}
+			self._unsaved = 0
+		self.save()
+
+	#
+	# Loads the persisted samples (if any)
+	#
+	def load(self):
+		if not self._fileName or not os.path.isfile(self._fileName):
+			return
+		try:
+			with open(self._fileName, "r") as f:
+				data = json.load(f)
+			with self._lock:
+				for cmdClass, samples in data.items():
+					self._samples[cmdClass] = deque(samples, maxlen=MAX_SAMPLES)
+			self._log.info("Loaded command latencies for {0} command classes".format(len(data)))
+		except Exception as err:
+			self._log.error("Can't load command latencies from '{0}':\n\t{1}".format(self._fileName, err))
+
+	#
+	# Persists the samples (write to a temp. file first, then replace the old one)
+	#
+	def save(self):
+		if not self._fileName:
+			return
+		with self._lock:
+			data = { cmdClass: list(samples) for cmdClass, samples in self._samples.items() }
+			self._unsaved = 0
+		try:
+			tmpName = self._fileName + ".tmp"
+			with open(tmpName, "w") as f:
+				json.dump(data, f)
+			os.replace(tmpName, self._fileName)
+		except Exception as err:
+			self._log.error("Can't save command latencies to '{0}':\n\t{1}".format(self._fileName, err))